@@ -1,527 +1,717 @@
             
 import streamlit as st
 import google.generativeai as genai
+import functools
+import logging
 import random
-import json
 import urllib.parse
-import re
 import time
+import os
+import uuid
+from client_modello import ClientModello, Interruttore, ModelloNonDisponibile
+import dadi
+import motore
+import narratore
+from motore import calcola_mod
+from oggetti import etichette
+from memoria import Consolidatore
+from immagini import PipelineImmagini, aggiungi_a_gallery
+from salvataggi import ArchivioLocale, ErroreSalvataggio, Storico, deserializza, serializza
+from cache_risposte import CacheRisposte, BackendSQLite
+from meccaniche import GENERATION_CONFIG_NATIVA, ISTRUZIONI_NATIVE, dividi_risposta_nativa, formatta_blocco
+from contesto import ISTRUZIONI, assicura_display, nuovo_messaggio, stima_token, BUDGET_DEFAULT
+from metriche import METRICHE, ContatoreLog, Cronometro, avvia_server
+from orchestratore import Turno, TurnoAnnullato, TurnoScaduto
+from party import ErroreTavolo, Registro
 
 # --- CONFIGURAZIONE CORE ---
 st.set_page_config(page_title="D&D Legend Engine 2026", layout="wide", initial_sidebar_state="expanded")
+cron = Cronometro(METRICHE)   # tempi di questo rerun, fase per fase
+log = logging.getLogger("app")
 
 # --- 🎨 UPGRADE GRAFICO (CSS & STILE) ---
-st.markdown("""
-    <style>
-    /* Importazione Font Fantasy 'Cinzel' e 'Lato' */
-    @import url('https://fonts.googleapis.com/css2?family=Cinzel:wght@400;700&family=Lato:wght@400;700&display=swap');
-    
-    /* Titoli in stile Fantasy Dorato */
-    h1, h2, h3, .stExpander p {
-        font-family: 'Cinzel', serif !important;
-        color: #DAA520 !important; /* Goldenrod */
-        text-shadow: 2px 2px 4px #000000;
-    }
-    
-    /* Nasconde menu standard Streamlit per immersione */
-    #MainMenu {visibility: hidden;}
-    footer {visibility: hidden;}
-    #header {visibility: hidden;}
-    
-    /* Stile Badge Inventario */
-    .inventory-item {
-        display: inline-block;
-        background-color: #2b2b2b;
-        border: 1px solid #DAA520;
-        border-radius: 5px;
-        padding: 5px 10px;
-        margin: 3px;
-        font-size: 0.9em;
-        color: #e0e0e0;
-        font-family: 'Lato', sans-serif;
-    }
-    
-    /* Stile Toast Personalizzato */
-    div[data-testid="stToast"] {
-        background-color: #1e1e1e !important;
-        border: 1px solid #DAA520 !important;
-        color: white !important;
-    }
-    </style>
-    """, unsafe_allow_html=True)
+@st.cache_resource
+def get_css():
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "stile.css"), encoding="utf-8") as f:
+        return f"<style>\n{f.read()}</style>"
+
+st.markdown(get_css(), unsafe_allow_html=True)
 
 # Configurazione API Gemini
-if "GEMINI_API_KEY" in st.secrets:
-    genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
-else:
+if "GEMINI_API_KEY" not in st.secrets:
     st.error("Configura GEMINI_API_KEY nei Secrets!")
 
 # Recupero chiave Pollinations (Opzionale)
 POLL_KEY = st.secrets.get("POLLINATIONS_API_KEY", None)
+POLL_URL = st.secrets.get("POLLINATIONS_BASE_URL", "https://gen.pollinations.ai/image")
 
-# CORE MODEL: Gemini 2.5 Flash Lite
-model = genai.GenerativeModel('gemini-2.5-flash-lite')
-
-# --- 1. DATI & REGOLE 5E ---
-
-SKILL_MAP = {
-    "Atletica": "Forza", "Furtività": "Destrezza", "Rapidità di mano": "Destrezza", "Acrobazia": "Destrezza",
-    "Arcano": "Intelligenza", "Storia": "Intelligenza", "Indagare": "Intelligenza", "Natura": "Intelligenza", "Religione": "Intelligenza",
-    "Percezione": "Saggezza", "Intuizione": "Saggezza", "Sopravvivenza": "Saggezza", "Medicina": "Saggezza", "Addestrare Animali": "Saggezza",
-    "Persuasione": "Carisma", "Inganno": "Carisma", "Intimidire": "Carisma", "Intrattenere": "Carisma"
-}
-
-COMPETENZE_CLASSE = {
-    "Guerriero": ["Atletica", "Percezione", "Intimidire"],
-    "Mago": ["Arcano", "Storia", "Indagare"],
-    "Ladro": ["Furtività", "Rapidità di mano", "Indagare", "Inganno"],
-    "Ranger": ["Sopravvivenza", "Percezione", "Natura"],
-    "Chierico": ["Religione", "Intuizione", "Storia"]
-}
-
-EQUIP_AVANZATO = {
-    "Guerriero": ["Cotta di Maglia (CA 16)", "Spada Lunga (1d8)", "Scudo (+2 CA)", "Arco Lungo (1d8)"],
-    "Mago": ["Bastone Arcano (1d6)", "Libro Incantesimi", "Vesti del Mago", "Daga (1d4)"],
-    "Ladro": ["Daga (1d4) x2", "Arco Corto (1d6)", "Armatura di Cuoio (CA 11)", "Arnesi da Scasso"],
-    "Ranger": ["Armatura di Cuoio (CA 11)", "Spada Corta (1d6) x2", "Arco Lungo (1d8)"],
-    "Chierico": ["Mazza (1d6)", "Scudo (+2 CA)", "Simbolo Sacro", "Cotta di Maglia (CA 16)"]
-}
-
-MAGIE_INIZIALI = {
-    "Mago": ["Dardo Incantato", "Mano Magica", "Raggio di Gelo", "Armatura Magica", "Scudo"],
-    "Chierico": ["Guida", "Fiamma Sacra", "Cura Ferite", "Dardo Guida", "Benedizione"],
-    "Guerriero": [], "Ladro": [], "Ranger": ["Marchio del Cacciatore"]
-}
-
-HIT_DICE_MAP = {"Guerriero": 10, "Ranger": 10, "Ladro": 8, "Chierico": 8, "Mago": 6}
-XP_LEVELS = {1: 0, 2: 300, 3: 900, 4: 2700, 5: 6500}
-SPELL_SLOTS_TABLE = {1: {1: 2}, 2: {1: 3}, 3: {1: 4, 2: 2}, 4: {1: 4, 2: 3}, 5: {1: 4, 2: 3, 3: 2}}
+# Narrazione in streaming (token per token). Disattivabile dai Secrets.
+STREAMING = st.secrets.get("STREAMING_NARRAZIONE", True)
 
-# --- 2. FUNZIONI TECNICHE ---
+# Modalità JSON nativa di Gemini per la meccanica (niente streaming della narrazione)
+MECCANICA_NATIVA = st.secrets.get("MECCANICA_NATIVA", False)
 
-def tira_dado(formula):
-    try:
-        formula = formula.lower().replace(" ", "")
-        bonus = 0
-        if "+" in formula:
-            parts = formula.split("+")
-            formula = parts[0]
-            bonus = int(parts[1])
-        elif "-" in formula:
-            parts = formula.split("-")
-            formula = parts[0]
-            bonus = -int(parts[1])
-        if "d" in formula:
-            num, faces = map(int, formula.split("d"))
-            tiri = [random.randint(1, faces) for _ in range(num)]
-            return sum(tiri) + bonus, tiri
-        else:
-            return int(formula), []
-    except: return 0, []
+# Budget (in token stimati) per storia, diario e riassunti nel prompt del DM
+PROMPT_BUDGET = int(st.secrets.get("PROMPT_BUDGET_TOKEN", BUDGET_DEFAULT))
+
+# Scadenza della narrazione (secondi) e dei riassunti in background
+TIMEOUT_TURNO = float(st.secrets.get("TIMEOUT_TURNO", 90))
+TIMEOUT_RIASSUNTO = float(st.secrets.get("TIMEOUT_RIASSUNTO", 120))
 
-def tira_statistica():
-    dadi = [random.randint(1, 6) for _ in range(4)]
-    dadi.sort()
-    return sum(dadi[1:])
+# Modalità party: finestra (secondi) per raccogliere le azioni del round e ogni quanto
+# le sessioni al tavolo controllano se c'è un round nuovo da mostrare
+FINESTRA_PARTY = float(st.secrets.get("FINESTRA_PARTY", 8))
+AGGIORNA_PARTY = float(st.secrets.get("AGGIORNA_PARTY", 2))
 
-def calcola_mod(punteggio):
-    return (punteggio - 10) // 2
+# CORE MODEL: Gemini 2.5 Flash Lite
+MODELLO = 'gemini-2.5-flash-lite'
+
+# Un solo client per processo, condiviso da tutte le sessioni: concorrenza limitata,
+# slot equi tra i tavoli, backoff sugli errori ritentabili e interruttore verso il DM di riserva
+@st.cache_resource
+def get_client():
+    if "GEMINI_API_KEY" in st.secrets: genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
+    return ClientModello(genai.GenerativeModel(MODELLO),
+                         max_concorrenti=int(st.secrets.get("MAX_CHIAMATE_CONCORRENTI", 8)),
+                         max_per_sessione=int(st.secrets.get("MAX_CHIAMATE_PER_SESSIONE", 2)),
+                         interruttore=Interruttore(soglia=int(st.secrets.get("CIRCUITO_SOGLIA", 5)),
+                                                   pausa=float(st.secrets.get("CIRCUITO_PAUSA", 60))))
+
+client = get_client()
+if "sessione_id" not in st.session_state: st.session_state.sessione_id = uuid.uuid4().hex
+SESSIONE = st.session_state.sessione_id
+
+# Cache delle risposte (intro, riassunti): una per processo, SQLite opzionale condiviso tra worker
+@st.cache_resource
+def get_cache_risposte():
+    db = st.secrets.get("CACHE_RISPOSTE_DB", None)
+    return CacheRisposte(max_voci=int(st.secrets.get("CACHE_RISPOSTE_MAX", 256)),
+                         ttl=int(st.secrets.get("CACHE_RISPOSTE_TTL", 6 * 3600)),
+                         backend=BackendSQLite(db) if db else None)
+
+cache_risposte = get_cache_risposte()
+SEGNAPOSTO_PG = "⟪PG⟫"
+
+# Immagini scaricate in background e servite come miniature dalla cache su disco
+@st.cache_resource
+def get_pipeline_immagini():
+    return PipelineImmagini(st.secrets.get("CACHE_IMMAGINI_DIR", ".cache_immagini"))
+
+pipeline_img = get_pipeline_immagini()
+
+# Autosalvataggio incrementale su disco, un log per personaggio
+@st.cache_resource
+def get_archivio():
+    return ArchivioLocale(st.secrets.get("SALVATAGGI_DIR", ".salvataggi"))
+
+archivio = get_archivio()
+
+# Proprietario degli autosalvataggi: l'utente se l'app ha il login, altrimenti un token
+# nell'URL (chi conserva il link ritrova le sue partite, gli altri non le vedono).
+# `st.user` esiste da Streamlit 1.42: prima si usa sempre il token
+UTENTE = getattr(st, "user", None)
+LOGIN = bool(getattr(UTENTE, "is_logged_in", False))
+if "proprietario" not in st.session_state:
+    st.session_state.proprietario = (f"utente:{UTENTE.get('email')}" if LOGIN
+                                     else st.query_params.get("giocatore") or uuid.uuid4().hex)
+PROPRIETARIO = st.session_state.proprietario
+if not LOGIN and st.query_params.get("giocatore") != PROPRIETARIO:
+    st.query_params["giocatore"] = PROPRIETARIO
+
+# Voci uscite dai buffer di sessione (diario, trascrizione, bestiario), lette solo su richiesta
+@st.cache_resource
+def get_storico():
+    return Storico(archivio.cartella)
+
+storico = get_storico()
+LIMITI_SESSIONE = {"messages": int(st.secrets.get("LIMITE_TRASCRIZIONE", motore.LIMITI["messages"])),
+                   "journal": int(st.secrets.get("LIMITE_DIARIO", motore.LIMITI["journal"])),
+                   "bestiary": motore.LIMITI["bestiary"], "ricordi": motore.LIMITI["ricordi"]}
+# Tetto (KB) delle liste in memoria per sessione; 0 = solo i limiti per numero di voci
+TETTO_SESSIONE = int(st.secrets.get("MEMORIA_SESSIONE_KB", 256)) * 1024
+PAGINA_DIARIO = 20
+MESSAGGI_VISIBILI = 20
+
+# Log strutturati e metriche di processo: tab di debug e endpoint Prometheus opzionali
+DEBUG_METRICHE = st.secrets.get("DEBUG_METRICHE", False)
+
+@st.cache_resource
+def get_metriche():
+    logging.basicConfig(level=st.secrets.get("LOG_LEVEL", "INFO"), format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    logging.getLogger().addHandler(ContatoreLog(METRICHE))
+    METRICHE.aggiungi_sorgente("client", client.statistiche)
+    METRICHE.aggiungi_sorgente("cache", cache_risposte.statistiche)
+    porta = st.secrets.get("METRICHE_PORTA", None)
+    if porta:
+        try: avvia_server(int(porta))
+        except OSError as e: log.warning("Endpoint metriche non avviato sulla porta %s: %s", porta, e)
+    return METRICHE
+
+get_metriche()
+
+# Tavoli della modalità party: mondo condiviso tra le sessioni del processo
+@st.cache_resource
+def get_registro():
+    return Registro()
+
+registro = get_registro()
+cron.sessione = SESSIONE
+cron.segna("avvio")
+
+# --- 1. DATI & REGOLE 5E (nel motore headless, motore.py) ---
+from regole import CLASSI, SKILL_MAP, caratteristiche, livello_incantesimo
+
+# --- 2. FUNZIONI TECNICHE ---
+
+def rerun():
+    cron.chiudi()
+    st.rerun()
+
+def frammento(nome, **opzioni):
+    """`st.fragment` che registra nelle metriche il tempo di ogni suo rendering."""
+    def decora(funzione):
+        @st.fragment(**opzioni)
+        @functools.wraps(funzione)
+        def avvolta(*args, **kwargs):
+            t0 = time.perf_counter()
+            try: return funzione(*args, **kwargs)
+            finally: METRICHE.osserva(f"frammento_{nome}", time.perf_counter() - t0)
+        return avvolta
+    return decora
+
+def con_ttft(risposta):
+    """Passa i chunk invariati registrando il tempo al primo (time to first token)."""
+    t0, primo = time.perf_counter(), True
+    for chunk in risposta:
+        if primo:
+            cron.registra("modello_ttft", time.perf_counter() - t0)
+            primo = False
+        yield chunk
+
+def mostra_debug():
+    miei = [t for t in METRICHE.ultimi_turni() if t["sessione"] == SESSIONE]
+    if miei:
+        st.write("**Ultimo turno**")
+        st.json(miei[-1])
+    stats = METRICHE.statistiche()
+    st.write("**Fasi (processo)**")
+    st.dataframe([{"fase": f, **v} for f, v in sorted(stats["fasi"].items())], hide_index=True)
+    st.write("**Contatori**")
+    st.json({**stats["contatori"], **stats["gauge"]})
+    with st.expander("Prometheus"): st.code(METRICHE.prometheus(), language="text")
+
+def mostra(eventi):
+    """Rende a schermo gli eventi restituiti dal motore."""
+    for tipo, testo, icona in eventi:
+        if tipo == "errore": st.error(testo)
+        else: st.toast(testo, icon=icona)
+
+def esegui(risultato):
+    """Adatta un'azione del motore alla sidebar. I pannelli sono frammenti: un'azione per
+    il DM fa ripartire l'app, che la trova in `pending_action` e la aggiunge alla chat."""
+    azione, eventi = risultato
+    mostra(eventi)
+    if azione:
+        stato.pending_action = azione
+        rerun()
 
 def genera_img(descrizione, tipo):
     try:
         seed = random.randint(1, 99999)
         prompt_base = f"Dungeons and Dragons realistic high fantasy, {tipo}: {descrizione}, cinematic lighting, 8k, masterpiece, no text"
         prompt_encoded = urllib.parse.quote(prompt_base)
-        base_url = f"https://gen.pollinations.ai/image/{prompt_encoded}"
+        base_url = f"{POLL_URL}/{prompt_encoded}"
         params = ["width=1024", "height=1024", f"seed={seed}", "nologo=true", "model=flux"]
         if POLL_KEY: params.append(f"key={POLL_KEY}")
         url = f"{base_url}?{'&'.join(params)}"
-        if "gallery" not in st.session_state: st.session_state.gallery = []
-        if not st.session_state.gallery or st.session_state.gallery[0]['url'] != url:
-            st.session_state.gallery.insert(0, {"url": url, "desc": descrizione})
+        if "gallery" not in stato: stato.gallery = []
+        aggiungi_a_gallery(stato.gallery, url, descrizione)
+        pipeline_img.prefetch(url)
         return url
     except: return None
 
-def genera_loot(rarita="Comune"):
-    tabella = {
-        "Comune": ["Pozione di Guarigione", "Pergamena di Dardo Incantato", "Olio per Affilare", "Torcia", "Razioni", "Corda di Seta"],
-        "Non Comune": ["Spada +1", "Anello di Protezione", "Mantello del Saltimpalo", "Borsa Conservante", "Stivali Alati"],
-        "Raro": ["Armatura di Piastre +1", "Bacchetta delle Palle di Fuoco", "Pozione di Forza del Gigante"]
-    }
-    # Se rarità è il nome diretto dell'oggetto (fallback)
-    if rarita not in tabella:
-        scelta = rarita
-    else:
-        scelta = random.choice(tabella.get(rarita, tabella["Comune"]))
-        
-    if scelta not in st.session_state.inventario:
-        st.session_state.inventario.append(scelta)
-        aggiorna_diario(f"Trovato oggetto: {scelta}")
-        st.toast(f"Trovato: {scelta}", icon="🎁")
-    return scelta
-
-def aggiorna_diario(evento):
-    if "journal" not in st.session_state: st.session_state.journal = []
-    st.session_state.journal.append(f"- {evento}")
-    if len(st.session_state.journal) > 50: st.session_state.journal.pop(0)
+def stream_narrazione(risposta, pezzi):
+    """Rende il testo del DM man mano che arriva, trattenendo il blocco ```json finale.
+    Tutti i chunk (blocco incluso) vengono accumulati in `pezzi` per il parsing a fine stream."""
+    buf, mostrato, nascosto = "", 0, False
+    for chunk in risposta:
+        try: testo = chunk.text
+        except ValueError: continue # chunk senza parti (es. finish_reason di safety)
+        pezzi.append(testo)
+        if nascosto: continue
+        buf += testo
+        idx = buf.find("```json", mostrato)
+        if idx >= 0:
+            nascosto = True
+            if idx > mostrato: yield buf[mostrato:idx]
+            continue
+        # Gli ultimi caratteri potrebbero essere l'inizio del fence: li teniamo in sospeso
+        sicuro = len(buf) - (len("```json") - 1)
+        if sicuro > mostrato:
+            yield buf[mostrato:sicuro]
+            mostrato = sicuro
+    if not nascosto and len(buf) > mostrato: yield buf[mostrato:]
+
+def riassumi(prompt):
+    return cache_risposte.genera(prompt, MODELLO, lambda: client.testo(prompt, SESSIONE))
 
 def gestisci_memoria():
-    if len(st.session_state.messages) > 15:
-        st.toast("🧠 Consolidamento memoria...", icon="💾")
-        try:
-            old_msgs = st.session_state.messages[1:-5]
-            txt_to_sum = "\n".join([f"{m['role']}: {m['content']}" for m in old_msgs if m['role'] != 'system'])
-            summary_prompt = f"Riassumi i seguenti eventi di D&D in 3 frasi concise mantenendo nomi e fatti chiave:\n{txt_to_sum}"
-            summary = model.generate_content(summary_prompt).text
-            st.session_state.summary_history += f"\n{summary}"
-            st.session_state.messages = [st.session_state.messages[0]] + st.session_state.messages[-5:]
-        except Exception as e: print(f"Errore memoria: {e}")
-
-def calcola_ca_avanzata():
-    stats = st.session_state.personaggio.get('stats', {})
-    mod_des = calcola_mod(stats.get('Destrezza', 10))
-    inv = st.session_state.inventario
-    ca_base = 10 + mod_des 
-    has_heavy, has_medium, has_light = False, False, False
-    base_armor = 0
-    
-    for item in inv:
-        if "Cotta di Maglia" in item or "Piastre" in item:
-            has_heavy = True
-            base_armor = max(base_armor, 16 if "Cotta" in item else 18)
-        elif "Giaco di Maglia" in item or "Corazza a Scaglie" in item:
-            has_medium = True
-            base_armor = max(base_armor, 13 if "Giaco" in item else 14)
-        elif "Cuoio" in item:
-            has_light = True
-            base_armor = max(base_armor, 11) 
-
-    if has_heavy: ca_finale = base_armor
-    elif has_medium: ca_finale = base_armor + min(mod_des, 2)
-    elif has_light: ca_finale = base_armor + mod_des
-    else: ca_finale = 10 + mod_des
-
-    if any("Scudo" in item for item in inv): ca_finale += 2
-    if any("Anello di Protezione" in item for item in inv): ca_finale += 1
-    st.session_state.ca = ca_finale
+    # Il riassunto gira in background: qui si raccoglie quello pronto e, se serve, se ne avvia un altro
+    if "consolidatore" not in st.session_state:
+        st.session_state.consolidatore = Consolidatore(riassumi, timeout=TIMEOUT_RIASSUNTO)
+    cons = st.session_state.consolidatore
+    esito = cons.raccogli()
+    if esito:
+        summary, n_riassunti = esito
+        # Swap atomico: solo i messaggi effettivamente riassunti escono dalla finestra
+        if summary: archivia("messages", motore.applica_riassunto(stato, summary, n_riassunti))
+    avvia_consolidamento()
+
+def avvia_consolidamento(anticipo=0):
+    """`anticipo`: messaggi che il turno in corso sta per aggiungere, per riassumere mentre il DM narra."""
+    cons = st.session_state.consolidatore
+    if len(stato.messages) + anticipo > 15 and not cons.occupato:
+        if cons.avvia(stato.messages[1:-5]):
+            st.toast("🧠 Consolidamento memoria...", icon="💾")
+
+def regola(funzione, *args, **kwargs):
+    """Le regole del motore che leggono e riscrivono lo stato. Al tavolo girano intere sotto
+    il lock, così non si intrecciano col round che un'altra sessione sta concludendo."""
+    if tavolo: return tavolo.applica(SESSIONE, funzione, *args, **kwargs)
+    return funzione(stato, *args, **kwargs)
+
+def archivia(campo, voci):
+    if voci: storico.scarica(stato.personaggio, campo, voci)
+
+def autosalva():
+    # Al tavolo si salva una copia presa sotto lock: il mondo può cambiare per mano di un'altra sessione
+    archivio.autosalva(tavolo.istantanea(SESSIONE) if tavolo else stato, PROPRIETARIO)
+
+def limita_sessione():
+    # Con un riassunto in volo la trascrizione non si tocca: gli indici del consolidamento devono restare validi
+    cons = st.session_state.get("consolidatore")
+    limiti = {k: v for k, v in LIMITI_SESSIONE.items() if k != "messages" or not (cons and cons.occupato)}
+    motore.limita(stato, limiti, archivia, TETTO_SESSIONE)
+
+def opzioni_tavolo():
+    """Un tavolo nuovo ha il suo consolidatore; le voci che escono dalla memoria vanno
+    nello storico su disco di chi lo apre."""
+    p = st.session_state.personaggio
+    return {"finestra": FINESTRA_PARTY, "consolidatore": Consolidatore(riassumi, timeout=TIMEOUT_RIASSUNTO),
+            "limiti": LIMITI_SESSIONE, "scarica": lambda campo, voci: storico.scarica(p, campo, voci)}
+
+def gioca_round(t):
+    """Una sola chiamata al DM per tutte le azioni del round; l'esito arriva a ogni sessione al tavolo."""
+    opzioni = {"request_options": {"timeout": TIMEOUT_TURNO}}
+    t0 = time.perf_counter()
+    with st.spinner("🧙‍♂️ Il DM narra il round..."):
+        try: res = t.esegui_round(lambda prompt: client.testo(prompt, SESSIONE, **opzioni),
+                                  immagine=lambda scena: genera_img(scena, "Scene"), budget=PROMPT_BUDGET)
+        except Exception as e:
+            METRICHE.incrementa("errori_api", tipo=type(e).__name__)
+            log.warning("Errore API nel round del tavolo %s (%s): %s", t.codice, type(e).__name__, e)
+            st.error(f"Errore API: {e}")
+            return
+    if res is None: return   # round non ancora chiuso, o lo sta giocando un'altra sessione
+    METRICHE.osserva("round_party", time.perf_counter() - t0)
+    METRICHE.incrementa("round_party")
+    rerun()
+
+@frammento("round", run_every=AGGIORNA_PARTY)
+def pannello_round():
+    """Gira da solo ogni pochi secondi: gioca il round appena è pronto e ridisegna la
+    pagina quando il tavolo è cambiato (round nuovo, qualcuno arriva o se ne va)."""
+    t = registro.trova(st.session_state.get("tavolo"))
+    if not t: return
+    if t.versione != st.session_state.get("versione_tavolo"): st.rerun()
+    if t.pronto(): gioca_round(t)
+    inviate, mancanti, rimanente = t.situazione()
+    if t.in_corso: st.caption("🧙‍♂️ Il DM sta narrando il round...")
+    elif inviate: st.caption(f"⏳ Round {t.round + 1}: hanno agito {', '.join(inviate)}"
+                             f"{'; in attesa di ' + ', '.join(mancanti) if mancanti else ''} ({rimanente:.0f}s)")
+    else: st.caption(f"🎭 Tavolo {t.codice}, round {t.round + 1}: tocca a voi.")
+
+# La stima sta davanti alla chiamata al modello: per una riga di suggerimento bastano poche
+# migliaia di prove (errore sulle percentuali sotto l'1%), non le 100k della simulazione piena
+PROVE_SUGGERIMENTO = int(st.secrets.get("PROVE_SUGGERIMENTO", 10_000))
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _simula(hp, ca, bonus_attacco, dice, mod_danno, iniziativa, nemico_hp, nemico_hp_max, nemico_ca):
+    pg = {"hp": hp, "ca": ca, "bonus_attacco": bonus_attacco, "dice": dice, "mod_danno": mod_danno, "iniziativa": iniziativa}
+    return dadi.simula_combattimento(pg, {"hp": nemico_hp, "hp_max": nemico_hp_max, "ca": nemico_ca}, prove=PROVE_SUGGERIMENTO)
+
+def suggerimento_combattimento():
+    """Stima Monte Carlo dello scontro col nemico attivo, con l'arma dal danno medio più alto."""
+    nemico = stato.nemico_corrente
+    if not nemico or stato.hp <= 0: return None
+    stats = stato.personaggio['stats']
+    arma = max(motore.derivati_pg(stato)["armi"],
+               key=lambda a: dadi.compila(a['dice']).media() + calcola_mod(stats[a['stat']]) + a['magico'])
+    mod = calcola_mod(stats[arma['stat']]) + arma['magico']
+    esito = _simula(stato.hp, stato.ca, mod + stato.bonus_competenza, arma['dice'], mod,
+                    calcola_mod(stats.get('Destrezza', 10)), nemico['hp'], nemico.get('hp_max', nemico['hp']), nemico.get('ca', 10))
+    return dadi.suggerimento_incontro(esito)
+
 # --- 3. STATO INIZIALE ---
-if "messages" not in st.session_state:
-    st.session_state.update({
-        "messages": [], "game_phase": "creazione",
-        "personaggio": {"nome": "", "classe": "", "razza": "", "stats": {}, "competenze": [], "magie": []},
-        "hp": 20, "hp_max": 20, "oro": 10, "xp": 0, "livello": 1, "bonus_competenza": 2,
-        "inventario": [],
-        "spell_slots": {1: 0, 2: 0, 3: 0}, "spell_slots_max": {1: 0, 2: 0, 3: 0},
-        "hit_dice_max": 1, "hit_dice_curr": 1, 
-        "ultimo_tiro": None, "temp_stats": {}, "ca": 10,
-        "nemico_corrente": None,
-        "gallery": [], "bestiary": [], "journal": ["- Inizio dell'avventura"],
-        "summary_history": "", "pending_action": None
-    })
-
-def check_level_up():
-    prossimo_liv = XP_LEVELS.get(st.session_state.livello + 1, 999999)
-    if st.session_state.xp >= prossimo_liv:
-        st.session_state.livello += 1
-        st.session_state.bonus_competenza = 2 + ((st.session_state.livello - 1) // 4)
-        st.session_state.hit_dice_max = st.session_state.livello
-        st.session_state.hit_dice_curr += 1
-        aggiorna_diario(f"Level Up! Raggiunto livello {st.session_state.livello}")
-        st.toast(f"✨ LIVELLO {st.session_state.livello}!", icon="⚔️")
-        p_class = st.session_state.personaggio.get("classe", "")
-        if p_class in ["Mago", "Chierico"]:
-            slots = SPELL_SLOTS_TABLE.get(st.session_state.livello, {1: 2})
-            for lvl, qty in slots.items():
-                st.session_state.spell_slots_max[lvl] = qty
-                st.session_state.spell_slots[lvl] = qty
-        elif p_class == "Ranger" and st.session_state.livello >= 2:
-             st.session_state.spell_slots_max[1] = 2
-             st.session_state.spell_slots[1] = 2
-
-check_level_up()
+if "messages" not in st.session_state: st.session_state.update(motore.stato_iniziale())
+
+# Al tavolo lo stato di gioco è la vista sul mondo condiviso; da soli è la sessione stessa
+tavolo = registro.trova(st.session_state.get("tavolo"))
+if tavolo and SESSIONE not in tavolo.eroi: tavolo = None
+stato = tavolo.vista(SESSIONE) if tavolo else st.session_state
+if tavolo:
+    st.session_state.versione_tavolo = tavolo.versione
+    mostra(tavolo.eventi(SESSIONE))
+
+mostra(regola(motore.check_level_up))
 
 # --- 4. SIDEBAR RISTRUTTURATA (GRAFICA) ---
+# Ogni pannello è un frammento: un click al suo interno (arma, pagina del diario, livello
+# degli incantesimi) ridisegna solo quel pannello. Le azioni che vanno al DM fanno ripartire
+# l'app, e delle schede si calcola solo quella aperta.
+SCHEDE = ["📈 Stats", "🎯 Skill", "✨ Magia", "🎒 Zaino", "📜 Diario"] + (["🛠️ Debug"] if DEBUG_METRICHE else [])
+
+@frammento("eroe")
+def pannello_eroe():
+    p = stato.personaggio
+    st.subheader(f"{p['nome']}")
+    st.caption(f"Lv. {stato.livello} {p['razza']} {p['classe']} | XP: {stato.xp}")
+
+    hp_pct = max(0.0, min(1.0, stato.hp / stato.hp_max))
+    st.write(f"**HP: {stato.hp}/{stato.hp_max}**")
+    st.progress(hp_pct)
+
+    c_ca, c_hd = st.columns(2)
+    c_ca.metric("🛡️ CA", stato.ca)
+    c_hd.metric("🎲 Dadi Vita", f"{stato.hit_dice_curr}/{stato.hit_dice_max}")
+
+    st.write("---")
+    if st.button("🎲 Tira d20 Puro", use_container_width=True): esegui(regola(motore.dado_puro))
+
+    # COMBATTIMENTO
+    c1, c2 = st.columns(2)
+    with c1:
+        weapons_found = motore.derivati_pg(stato)["armi"]
+        selected_weapon = st.selectbox("Scegli Arma", weapons_found, format_func=lambda x: x["label"], label_visibility="collapsed")
+        if st.button("⚔️ Attacca"): esegui(regola(motore.attacca, selected_weapon))
+
+    with c2:
+        rest_type = st.selectbox("Riposo", ["Breve (1 HD)", "Lungo"], label_visibility="collapsed")
+        if st.button("💤 Dormi"):
+            if "Lungo" in rest_type: esegui(regola(motore.riposo_lungo))
+            else: esegui(regola(motore.riposo_breve))
+
+    if stato.ultimo_tiro: st.info(f"Esito: **{stato.ultimo_tiro}**")
+
+@frammento("stats")
+def pannello_stats():
+    for stat, val in stato.personaggio['stats'].items():
+        mod = calcola_mod(val)
+        st.text(f"{stat[:3].upper()}: {val} ({'+' if mod >=0 else ''}{mod})")
+    capacita = caratteristiche(stato.personaggio['classe'], stato.livello)
+    if capacita:
+        st.write("**Capacità di classe**")
+        st.caption(" · ".join(capacita))
+
+@frammento("skill")
+def pannello_skill():
+    for skill in SKILL_MAP:
+        bonus = motore.bonus_abilita(stato, skill)
+        if st.button(f"{skill} ({'+' if bonus >=0 else ''}{bonus})", key=f"btn_{skill}"):
+            esegui(regola(motore.prova_abilita, skill))
+
+@frammento("magia")
+def pannello_magia():
+    p = stato.personaggio
+    if not p['magie']:
+        st.caption("Nessuna capacità magica.")
+        return
+    slot_levs = sorted([k for k,v in stato.spell_slots_max.items() if v > 0])
+    if not slot_levs:
+        st.caption("Nessuno slot disponibile.")
+        return
+    # Solo il livello scelto viene disegnato
+    liv = st.segmented_control("Livello", [f"L{i}" for i in slot_levs] + ["Cantrip"], default="Cantrip",
+                               key="livello_magia", label_visibility="collapsed")
+    if liv == "Cantrip":
+        for c in [m for m in p['magie'] if livello_incantesimo(m) == 0]:
+            if st.button(f"✨ {c}", key=f"cast_{c}"): esegui(regola(motore.lancia_incantesimo, c))
+    elif liv:
+        liv = int(liv[1:])
+        curr, mx = stato.spell_slots.get(liv, 0), stato.spell_slots_max.get(liv, 0)
+        st.write(f"**Slot:** {curr}/{mx}")
+        st.progress(curr/mx if mx > 0 else 0)
+        # Uno slot lancia anche gli incantesimi di livello inferiore (a livello superiore)
+        for s in [m for m in p['magie'] if 0 < livello_incantesimo(m) <= liv]:
+            if st.button(f"🔮 {s}", key=f"cast_{s}_l{liv}"): esegui(regola(motore.lancia_incantesimo, s, liv))
+
+@frammento("zaino")
+def pannello_zaino(): # ZAINO GRAFICO (CSS)
+    st.write(f"**💰 Oro:** {stato.oro} mo")
+    inv_html = ""
+    for i in etichette(stato.inventario, stato.get("oggetti_custom")):
+        inv_html += f"<div class='inventory-item'>{i}</div>"
+    st.markdown(inv_html, unsafe_allow_html=True)
+
+@frammento("diario")
+def pannello_diario():
+    p = stato.personaggio
+    st.write("### 📜 Diario")
+    if stato.journal:
+        for entry in reversed(stato.journal): st.caption(entry)
+    # Le voci più vecchie sono su disco: si leggono a pagine, solo se il giocatore scorre
+    archiviate = storico.conta(p, "journal")
+    mostrate = min(st.session_state.get("diario_mostrate", 0), archiviate)
+    for entry in reversed(storico.ultime(p, "journal", mostrate)): st.caption(entry)
+    if archiviate > mostrate and st.button(f"⬇️ Voci precedenti ({archiviate - mostrate})", use_container_width=True):
+        st.session_state.diario_mostrate = mostrate + PAGINA_DIARIO
+        st.rerun(scope="fragment")
+    st.divider()
+    st.write("### 👹 Bestiario")
+    if stato.bestiary:
+        for b in stato.bestiary: st.error(f"**{b['nome']}** (HP: {b['hp']}/{b['hp_max']})")
+
+PANNELLI = dict(zip(SCHEDE, [pannello_stats, pannello_skill, pannello_magia, pannello_zaino, pannello_diario, frammento("debug")(mostra_debug)]))
+
+@frammento("schede")
+def pannello_schede():
+    # Selettore e scheda aperta nello stesso frammento: cambiare scheda non riesegue l'app
+    scheda = st.segmented_control("Scheda", SCHEDE, default=SCHEDE[0], key="scheda", label_visibility="collapsed")
+    if scheda: PANNELLI[scheda]()
+
+@frammento("salvataggio")
+def pannello_salvataggio():
+    # Serializzazione solo su richiesta: il download viene preparato al click
+    if st.button("💾 Prepara Salvataggio", use_container_width=True):
+        st.download_button("⬇️ Scarica Eroe", data=serializza(stato), file_name=f"{stato.personaggio['nome']}.dnd",
+                           mime="application/octet-stream", use_container_width=True)
+
+@frammento("party")
+def pannello_party():
+    # PARTY: più giocatori sullo stesso mondo, un DM per round
+    with st.expander("🎭 Party", expanded=bool(tavolo)):
+        if tavolo:
+            st.write(f"Tavolo **{tavolo.codice}**")
+            for g, nome, classe, hp, hp_max in tavolo.membri():
+                st.caption(f"{'⭐ ' if g == SESSIONE else ''}{nome} ({classe}) · HP {hp}/{hp_max}")
+            if st.button("🚪 Lascia il tavolo", use_container_width=True):
+                solo = registro.lascia(tavolo.codice, SESSIONE)
+                st.session_state.pop("tavolo", None)
+                st.session_state.pop("consolidatore", None)
+                if solo: st.session_state.update(solo)
+                rerun()
+        else:
+            codice = st.text_input("Codice tavolo", max_chars=8, placeholder="vuoto = nuovo codice")
+            c_apri, c_entra = st.columns(2)
+            try:
+                if c_apri.button("Apri", use_container_width=True):
+                    st.session_state.tavolo = registro.apri(SESSIONE, st.session_state, codice, **opzioni_tavolo()).codice
+                    rerun()
+                if c_entra.button("Unisciti", use_container_width=True):
+                    scelto = registro.trova(codice)
+                    if not scelto: raise ErroreTavolo(f"Nessun tavolo {codice.strip().upper()}")
+                    scelto.unisciti(SESSIONE, st.session_state)
+                    st.session_state.tavolo = scelto.codice
+                    rerun()
+            except ErroreTavolo as e: st.error(str(e))
+
 with st.sidebar:
     st.title("🧝 D&D Engine")
     
-    if st.session_state.personaggio.get("nome"):
-        p = st.session_state.personaggio
-        calcola_ca_avanzata()
-        if isinstance(st.session_state.spell_slots, int): # Migration Fix
-            st.session_state.spell_slots = {1: st.session_state.spell_slots}
-            st.session_state.spell_slots_max = {1: st.session_state.spell_slots_max}
-
-        # TAB PRINCIPALI
-        main_tabs = st.tabs(["📊 Eroe", "📚 Diario"])
-        
-        with main_tabs[0]:
-            st.subheader(f"{p['nome']}")
-            st.caption(f"Lv. {st.session_state.livello} {p['razza']} {p['classe']} | XP: {st.session_state.xp}")
-            
-            hp_pct = max(0.0, min(1.0, st.session_state.hp / st.session_state.hp_max))
-            st.write(f"**HP: {st.session_state.hp}/{st.session_state.hp_max}**")
-            st.progress(hp_pct)
-            
-            c_ca, c_hd = st.columns(2)
-            c_ca.metric("🛡️ CA", st.session_state.ca)
-            c_hd.metric("🎲 Dadi Vita", f"{st.session_state.hit_dice_curr}/{st.session_state.hit_dice_max}")
-
-            st.write("---")
-            if st.button("🎲 Tira d20 Puro", use_container_width=True): 
-                res = random.randint(1, 20)
-                st.session_state.ultimo_tiro = res
-                st.session_state.pending_action = f"[DADO PURO: {res}]"
-            
-            # COMBATTIMENTO
-            c1, c2 = st.columns(2)
-            with c1:
-                weapons_found = []
-                for item in st.session_state.inventario:
-                    if any(x in item for x in ["Spada", "Mazza", "Ascia", "Martello", "Bastone"]):
-                         dice = "1d8" if "Lunga" in item or "Ascia" in item else ("1d4" if "Daga" in item else "1d6")
-                         weapons_found.append({"label": item, "stat": "Forza", "dice": dice})
-                    elif any(x in item for x in ["Arco", "Daga", "Balestra", "Fionda"]):
-                         dice = "1d8" if "Lungo" in item or "Balestra" in item else ("1d4" if "Daga" in item else "1d6")
-                         weapons_found.append({"label": item, "stat": "Destrezza", "dice": dice})
-                if not weapons_found: weapons_found.append({"label": "Pugno", "stat": "Forza", "dice": "1d4"})
-                
-                selected_weapon = st.selectbox("Scegli Arma", weapons_found, format_func=lambda x: x["label"].split('(')[0], label_visibility="collapsed")
-                if st.button(f"⚔️ Attacca"):
-                    mod = calcola_mod(p['stats'][selected_weapon['stat']])
-                    tiro_atk = random.randint(1, 20)
-                    tot_atk = tiro_atk + mod + st.session_state.bonus_competenza
-                    danno, _ = tira_dado(selected_weapon['dice'])
-                    danno_tot = max(1, danno + mod)
-                    action_str = (f"[AZIONE_COMBAT: Attacco con {selected_weapon['label'].split('(')[0]} | TxC: {tot_atk} | Danni: {danno_tot}]")
-                    st.session_state.pending_action = action_str
-                    st.session_state.ultimo_tiro = f"Atk: {tot_atk} | Dmg: {danno_tot}"
-
-            with c2:
-                rest_type = st.selectbox("Riposo", ["Breve (1 HD)", "Lungo"], label_visibility="collapsed")
-                if st.button("💤 Dormi"):
-                    if "Lungo" in rest_type:
-                        st.session_state.hp = st.session_state.hp_max
-                        for k, v in st.session_state.spell_slots_max.items(): st.session_state.spell_slots[k] = v
-                        st.session_state.hit_dice_curr = max(1, st.session_state.hit_dice_max // 2)
-                        aggiorna_diario("Riposo Lungo completato.")
-                        st.session_state.pending_action = "[AZIONE: Riposo Lungo completato]"
-                    else: 
-                        if st.session_state.hit_dice_curr > 0:
-                            dice_face = HIT_DICE_MAP.get(p['classe'], 8)
-                            roll = random.randint(1, dice_face)
-                            con_mod = calcola_mod(p['stats']['Costituzione'])
-                            heal = max(1, roll + con_mod)
-                            st.session_state.hp = min(st.session_state.hp_max, st.session_state.hp + heal)
-                            st.session_state.hit_dice_curr -= 1
-                            aggiorna_diario(f"Riposo Breve: Curati {heal} HP")
-                            st.session_state.pending_action = f"[AZIONE: Riposo Breve. Curati {heal} HP.]"
-                        else: st.error("Nessun Dado Vita!")
-
-            if st.session_state.ultimo_tiro: st.info(f"Esito: **{st.session_state.ultimo_tiro}**")
-            
-            sub_tab1, sub_tab2, sub_tab3, sub_tab4 = st.tabs(["Stats", "Skill", "Magia", "Zaino"])
-            with sub_tab1:
-                for stat, val in p['stats'].items():
-                    mod = calcola_mod(val)
-                    st.text(f"{stat[:3].upper()}: {val} ({'+' if mod >=0 else ''}{mod})")
-            with sub_tab2:
-                for skill, stat_ref in SKILL_MAP.items():
-                    is_prof = skill in p['competenze']
-                    mod_stat = calcola_mod(p['stats'][stat_ref])
-                    bonus = mod_stat + (st.session_state.bonus_competenza if is_prof else 0)
-                    if st.button(f"{skill} ({'+' if bonus >=0 else ''}{bonus})", key=f"btn_{skill}"):
-                        dado = random.randint(1, 20)
-                        tot = dado + bonus
-                        st.session_state.pending_action = f"[PROVA_ABILITA: {skill} | Totale: {tot}]"
-            with sub_tab3: 
-                if p['magie']:
-                    slot_levs = sorted([k for k,v in st.session_state.spell_slots_max.items() if v > 0])
-                    if slot_levs:
-                        tabs_lev = st.tabs([f"L{i}" for i in slot_levs] + ["Cantrip"])
-                        with tabs_lev[-1]:
-                            cantrips = [m for m in p['magie'] if m in ["Guida", "Fiamma Sacra", "Raggio di Gelo", "Mano Magica", "Prestidigitazione"]]
-                            for c in cantrips:
-                                if st.button(f"✨ {c}", key=f"cast_{c}"): st.session_state.pending_action = f"[LANCIO_INCANTESIMO: {c} (Trucchetto)]"
-                        for idx, liv in enumerate(slot_levs):
-                            with tabs_lev[idx]:
-                                curr, mx = st.session_state.spell_slots.get(liv, 0), st.session_state.spell_slots_max.get(liv, 0)
-                                st.write(f"**Slot:** {curr}/{mx}")
-                                st.progress(curr/mx if mx > 0 else 0)
-                                spells_lev = [m for m in p['magie'] if m not in ["Guida", "Fiamma Sacra", "Raggio di Gelo", "Mano Magica", "Prestidigitazione"]]
-                                for s in spells_lev:
-                                    if st.button(f"🔮 {s}", key=f"cast_{s}_l{liv}"):
-                                        if curr > 0:
-                                            st.session_state.spell_slots[liv] -= 1
-                                            st.session_state.pending_action = f"[LANCIO_INCANTESIMO: {s} (Slot Liv {liv})]"
-                                        else: st.error("Slot esauriti!")
-                    else: st.caption("Nessuno slot disponibile.")
-                else: st.caption("Nessuna capacità magica.")
-            with sub_tab4: # ZAINO GRAFICO (CSS)
-                st.write(f"**💰 Oro:** {st.session_state.oro} mo")
-                inv_html = ""
-                for i in st.session_state.inventario:
-                    inv_html += f"<div class='inventory-item'>{i}</div>"
-                st.markdown(inv_html, unsafe_allow_html=True)
-
-        with main_tabs[1]:
-            st.write("### 📜 Diario")
-            if st.session_state.journal:
-                for entry in reversed(st.session_state.journal): st.caption(entry)
-            st.divider()
-            st.write("### 👹 Bestiario")
-            if st.session_state.bestiary:
-                for b in st.session_state.bestiary: st.error(f"**{b['nome']}** (HP: {b['hp']}/{b['hp_max']})")
+    if stato.personaggio.get("nome"):
+        regola(motore.calcola_ca)
+        pannello_eroe()
+        pannello_schede()
         st.divider()
-        sd = {k: v for k, v in st.session_state.items() if k != "temp_stats"}
-        st.download_button("💾 Salva Eroe", data=json.dumps(sd, default=str), file_name="hero_evolved.json")
+        pannello_salvataggio()
+        pannello_party()
+
+cron.segna("sidebar")
 
 # --- 5. LOGICA DI GIOCO ---
-if st.session_state.game_phase == "creazione":
+if stato.game_phase == "creazione":
     st.title("🧙 Legend Engine 2026")
     with st.expander("📂 Carica Personaggio"):
-        f = st.file_uploader("Upload .json", type="json")
+        f = st.file_uploader("Upload .dnd / .json", type=["dnd", "json"])
+        dati_caricati = None
         if f:
-            st.session_state.update(json.load(f))
-            st.rerun()
-
-    if not st.session_state.temp_stats:
+            try: dati_caricati = deserializza(f.getvalue())
+            except ErroreSalvataggio as e: st.error(f"Salvataggio non valido: {e}")
+        salvati = archivio.elenco(PROPRIETARIO)
+        if salvati:
+            scelta = st.selectbox("Autosalvataggi", salvati, format_func=lambda f: f.split("-", 1)[1].removesuffix(".log"))
+            if st.button("▶️ Riprendi"):
+                try: dati_caricati = archivio.carica_di(scelta, PROPRIETARIO)
+                except (OSError, ErroreSalvataggio) as e: st.error(f"Autosalvataggio non valido: {e}")
+        if dati_caricati:
+            st.session_state.pop("consolidatore", None) # un riassunto in volo non vale per la nuova partita
+            st.session_state.pop("diario_mostrate", None)
+            st.session_state.update(dati_caricati)
+            st.session_state.update({"pending_action": None, "temp_stats": {}, "ultimo_tiro": None})
+            rerun()
+
+    if not stato.temp_stats:
         if st.button("🎲 Genera Statistiche"):
-            st.session_state.temp_stats = {s: tira_statistica() for s in ["Forza", "Destrezza", "Costituzione", "Intelligenza", "Saggezza", "Carisma"]}
-            st.rerun()
+            stato.temp_stats = motore.tira_statistiche()
+            rerun()
     else:
         st.write("### Risultati dadi")
         cs = st.columns(6)
-        for i, (s, v) in enumerate(st.session_state.temp_stats.items()):
+        for i, (s, v) in enumerate(stato.temp_stats.items()):
             mod = calcola_mod(v)
             cs[i].metric(s, f"{v}", f"{'+' if mod >=0 else ''}{mod}")
         if st.button("🔄 Reroll"):
-            st.session_state.temp_stats = {s: tira_statistica() for s in ["Forza", "Destrezza", "Costituzione", "Intelligenza", "Saggezza", "Carisma"]}
-            st.rerun()
+            stato.temp_stats = motore.tira_statistiche()
+            rerun()
 
         with st.form("f_crea"):
             n = st.text_input("Nome")
             r = st.selectbox("Razza", ["Umano", "Elfo", "Nano", "Tiefling", "Mezzelfo"])
-            c = st.selectbox("Classe", ["Guerriero", "Mago", "Ladro", "Ranger", "Chierico"])
+            c = st.selectbox("Classe", list(CLASSI))
             if st.form_submit_button("Inizia Avventura"):
                 if n:
-                    mod_c = calcola_mod(st.session_state.temp_stats["Costituzione"])
-                    hd = HIT_DICE_MAP.get(c, 8)
-                    hp = hd + mod_c
-                    s_max = {1: 0, 2: 0, 3: 0}
-                    if c in ["Mago", "Chierico"]: s_max[1] = 2
-                    st.session_state.update({
-                        "personaggio": {"nome": n, "classe": c, "razza": r, "stats": st.session_state.temp_stats, "competenze": COMPETENZE_CLASSE[c], "magie": MAGIE_INIZIALI[c]},
-                        "hp": hp, "hp_max": hp, 
-                        "hit_dice_max": 1, "hit_dice_curr": 1,
-                        "inventario": EQUIP_AVANZATO[c], "game_phase": "playing",
-                        "spell_slots_max": s_max, "spell_slots": s_max.copy()
-                    })
-                    aggiorna_diario(f"Inizia l'avventura di {n}.")
-                    st.session_state.messages.append({"role": "system", "content": "START_INTRO"})
-                    st.rerun()
+                    motore.crea_personaggio(stato, n, r, c, stato.temp_stats)
+                    autosalva()
+                    rerun()
 
 else:
     st.title("🛡️ Avventura")
-    if st.session_state.messages and st.session_state.messages[-1]["content"] == "START_INTRO":
-        p = st.session_state.personaggio
-        res = model.generate_content(
-            f"Sei il DM. Inizia avventura per {p['nome']} ({p['razza']} {p['classe']}). Descrizione evocativa. Alla fine includi un blocco JSON nascosto per settare la scena."
-        ).text
-        st.session_state.messages[-1] = {"role": "assistant", "content": res}
-        st.rerun()
+    if stato.messages and stato.messages[-1]["content"] == "START_INTRO":
+        p = stato.personaggio
+        intro = ("Sei il DM. Inizia avventura per {nome} ({razza} {classe}). Chiama il personaggio sempre e solo {nome}. "
+                 "Descrizione evocativa. Alla fine includi un blocco JSON nascosto per settare la scena.")
+        # Il modello riceve il segnaposto al posto del nome: la risposta è riusabile così com'è
+        # per chiunque abbia stessa razza e classe, e il nome vero entra solo alla fine
+        prompt_intro = intro.format(nome=SEGNAPOSTO_PG, razza=p['razza'], classe=p['classe'])
+        try:
+            with cron.fase("intro"): res = cache_risposte.genera(
+                prompt_intro, MODELLO, lambda: client.testo(prompt_intro, SESSIONE)).replace(SEGNAPOSTO_PG, p['nome'])
+        except ModelloNonDisponibile as e:
+            log.warning("Intro di riserva (%s): %s", type(e).__name__, e)
+            res = narratore.intro(p)
+        stato.messages[-1] = nuovo_messaggio("assistant", res)
+        autosalva()
+        rerun()
 
     # LOGICA AVATAR
     def get_avatar(role):
         if role == "assistant": return "🧙‍♂️"
-        pc_class = st.session_state.personaggio.get("classe", "")
-        if pc_class == "Guerriero": return "🛡️"
-        if pc_class == "Mago": return "🔮"
-        if pc_class == "Ladro": return "🗡️"
-        if pc_class == "Ranger": return "🏹"
-        if pc_class == "Chierico": return "☀️"
-        return "👤"
-
-    for msg in st.session_state.messages:
-        if msg["role"] != "system":
+        if tavolo: return "👥"   # al tavolo i messaggi del giocatore sono le azioni di tutto il gruppo
+        return CLASSI.get(stato.personaggio.get("classe", ""), {}).get("icona", "👤")
+
+    if tavolo:
+        # Il tavolo gestisce da sé la memoria condivisa; ognuno salva la propria copia a ogni round
+        if st.session_state.get("round_salvato") != tavolo.round:
+            autosalva()
+            st.session_state.round_salvato = tavolo.round
+    else: gestisci_memoria()
+    cron.segna("memoria")
+
+    @frammento("trascrizione")
+    def trascrizione():
+        # Solo gli ultimi messaggi: il costo del rendering non cresce con la campagna
+        messaggi = [m for m in list(stato.messages) if m["role"] != "system"]
+        mostrati = st.session_state.get("messaggi_mostrati", MESSAGGI_VISIBILI)
+        if len(messaggi) > mostrati and st.button(f"⬆️ Messaggi precedenti ({len(messaggi) - mostrati})", use_container_width=True):
+            st.session_state.messaggi_mostrati = mostrati + MESSAGGI_VISIBILI
+            st.rerun(scope="fragment")
+        for msg in messaggi[-mostrati:]:
             with st.chat_message(msg["role"], avatar=get_avatar(msg["role"])):
-                display_content = re.sub(r'```json.*?```', '', msg["content"], flags=re.DOTALL).strip()
-                st.write(display_content)
-                if msg.get("image_url"): st.image(msg["image_url"])
+                st.write(assicura_display(msg))
+                if msg.get("image_url"): st.image(pipeline_img.leggi(msg["image_url"]) or msg["image_url"])
 
-    gestisci_memoria()
+    trascrizione()
+    cron.segna("trascrizione")
 
     prompt = st.chat_input("Cosa fai?")
-    input_to_process = st.session_state.pending_action if st.session_state.pending_action else prompt
-    st.session_state.pending_action = None 
-
-    if input_to_process:
-        display_text = input_to_process.replace("[AZIONE_COMBAT:", "⚔️").replace("[LANCIO_INCANTESIMO:", "✨").replace("]", "")
-        st.session_state.messages.append({"role": "user", "content": display_text})
-        
-        p = st.session_state.personaggio
-        journal_str = "\n".join(st.session_state.journal[-10:])
-        msgs_to_include = st.session_state.messages[-6:] 
-        history_text = st.session_state.summary_history + "\n"
-        for m in msgs_to_include:
-            if m["role"] != "system":
-                c_clean = re.sub(r'```json.*?```', '', m["content"], flags=re.DOTALL).strip()
-                history_text += f"{m['role'].upper()}: {c_clean}\n"
-
-        sys = (f"Sei il DM (5e). PG: {p['nome']} {p['classe']}. HP:{st.session_state.hp}/{st.session_state.hp_max}. "
-               f"Diario: {journal_str}. Nemico Attivo: {st.session_state.nemico_corrente}. "
-               f"\n--- STORIA ---\n{history_text}\n"
-               f"--- ISTRUZIONI CRITICHE ---\n"
-               f"1. Rispondi narrativamente come un DM esperto.\n"
-               f"2. ALLA FINE, INSERISCI BLOCCO JSON PURO PER MECCANICA.\n"
-               f"3. FORMATO JSON:\n"
-               f"```json\n"
-               f"{{\n"
-               f"  'enemy_update': {{'name': '...', 'hp': ..., 'ac': ...}} (o null),\n"
-               f"  'damage_to_player': int (0 se nullo),\n"
-               f"  'xp_gain': int, 'gold_gain': int,\n"
-               f"  'loot_found': 'nome_oggetto' (o null),\n"
-               f"  'location_visual': 'descrizione per immagine' (o null)\n"
-               f"}}\n"
-               f"```")
+    input_to_process = stato.pending_action if stato.pending_action else prompt
+    stato.pending_action = None 
+
+    if tavolo:
+        if input_to_process:
+            try: tavolo.invia(SESSIONE, input_to_process)
+            except ErroreTavolo as e: st.error(str(e))
+        pannello_round()
+    elif input_to_process:
+        # Un turno ancora in volo (la sua esecuzione è stata interrotta dall'azione nuova) viene chiuso
+        precedente = st.session_state.get("turno_in_corso")
+        if precedente and not precedente.chiuso:
+            precedente.annulla()
+            cron.conta("turni_annullati")
+        turno = st.session_state.turno_in_corso = Turno(TIMEOUT_TURNO)
+        cron.segna("input")
+        # Il suggerimento è facoltativo: un oggetto malformato non deve bloccare ogni turno
+        try: note = suggerimento_combattimento()
+        except (ValueError, KeyError) as e:
+            log.warning("Suggerimento di combattimento saltato (%s): %s", type(e).__name__, e)
+            note = None
+        cron.segna("simulazione")
+        full_prompt = motore.prepara_turno(stato, input_to_process, budget=PROMPT_BUDGET,
+                                           istruzioni=ISTRUZIONI_NATIVE if MECCANICA_NATIVA else ISTRUZIONI, note=note)
+        cron.conta("prompt_caratteri", len(full_prompt))
+        cron.conta("prompt_token", stima_token(full_prompt))
+        cron.segna("prompt")
+        # Il riassunto parte adesso, in parallelo alla narrazione, se questo turno supererà la soglia
+        avvia_consolidamento(anticipo=2)
+        opzioni = {"request_options": {"timeout": TIMEOUT_TURNO}}
         
         try:
-            full_prompt = sys + "\n\nAZIONE: " + input_to_process
-            res = model.generate_content(full_prompt).text
-            
-            img_url = None
-            json_match = re.search(r'```json\s*({.*?})\s*```', res, re.DOTALL)
-            if json_match:
+            data, riparazioni = None, []
+            with cron.fase("modello"):
                 try:
-                    data = json.loads(json_match.group(1).replace("'", '"')) 
-                    if data.get("enemy_update"):
-                        e_data = data["enemy_update"]
-                        st.session_state.nemico_corrente = {"nome": e_data["name"], "hp": e_data["hp"], "hp_max": e_data.get("hp_max", e_data["hp"]), "ca": e_data.get("ac", 10)}
-                        if not any(b['nome'] == e_data['name'] for b in st.session_state.bestiary):
-                             st.session_state.bestiary.append(st.session_state.nemico_corrente)
-                        if st.session_state.nemico_corrente["hp"] <= 0:
-                            aggiorna_diario(f"Sconfitto: {st.session_state.nemico_corrente['nome']}")
-                            st.session_state.nemico_corrente = None
-                            st.toast("Nemico sconfitto!", icon="💀")
-                    dmg = data.get("damage_to_player", 0)
-                    if dmg > 0:
-                        st.session_state.hp = max(0, st.session_state.hp - dmg)
-                        aggiorna_diario(f"Subiti {dmg} danni")
-                        st.toast(f"-{dmg} HP", icon="🩸")
-                    if data.get("xp_gain"): 
-                        st.session_state.xp += data["xp_gain"]
-                        aggiorna_diario(f"+{data['xp_gain']} XP")
-                    if data.get("gold_gain"): st.session_state.oro += data["gold_gain"]
-                    if data.get("loot_found"): genera_loot(data["loot_found"]) 
-                    if data.get("location_visual"): img_url = genera_img(data["location_visual"], "Scene")
-                except Exception as e: print(f"JSON Error: {e}")
-
-            if "[[LUOGO:" in res and not img_url:
-                 try: img_url = genera_img(res.split("[[LUOGO:")[1].split("]]")[0], "Scene")
-                 except: pass
-
-            st.session_state.messages.append({"role": "assistant", "content": res, "image_url": img_url})
-            st.session_state.ultimo_tiro = None
-            st.rerun()
+                    if STREAMING and not MECCANICA_NATIVA:
+                        with st.chat_message("user", avatar=get_avatar("user")): st.write(motore.testo_azione(input_to_process))
+                        with st.chat_message("assistant", avatar=get_avatar("assistant")):
+                            pezzi = []
+                            # L'immagine della scena parte appena il luogo compare nello stream
+                            flusso = turno.flusso(con_ttft(client.genera_stream(full_prompt, SESSIONE, **opzioni)),
+                                                  su_scena=lambda scena: genera_img(scena, "Scene"))
+                            st.write_stream(stream_narrazione(flusso, pezzi))
+                        res = "".join(pezzi)
+                    else:
+                        attesa = st.empty()
+                        battito = lambda secondi: attesa.caption(f"⏳ Il DM sta pensando... {secondi:.0f}s")
+                        if MECCANICA_NATIVA:
+                            risposta = turno.chiama(client.testo, full_prompt, SESSIONE, battito=battito,
+                                                    generation_config=GENERATION_CONFIG_NATIVA, **opzioni)
+                            narrazione, data, riparazioni = dividi_risposta_nativa(risposta)
+                            res = narrazione + (f"\n{formatta_blocco(data)}" if data else "")
+                        else: res = turno.chiama(client.testo, full_prompt, SESSIONE, battito=battito, **opzioni)
+                        attesa.empty()
+                except ModelloNonDisponibile as e:
+                    # Gemini non risponde: il turno lo narra il DM di riserva con le stesse regole
+                    cron.conta("turni_riserva", tipo=type(e).__name__)
+                    log.warning("DM di riserva (%s): %s", type(e).__name__, e)
+                    res, data = narratore.narra_turno(stato, input_to_process), None
+            # Senza `data` il motore analizza il blocco JSON in coda alla risposta
+            def immagine(scena):
+                # Fase a sé: il tempo dell'immagine non finisce in "meccanica" né in "salvataggio"
+                cron.segna("meccanica")
+                url = turno.anticipo if scena == turno.scena else genera_img(scena, "Scene")
+                cron.segna("immagine")
+                return url
+            scena, eventi, rip = motore.concludi_turno(stato, res, data, immagine=immagine)
+            riparazioni += rip
+            if riparazioni:
+                log.info("Meccanica riparata/scartata: %s", riparazioni)
+                cron.conta("meccanica_riparata")
+            cron.segna("meccanica")
+            mostra(eventi)
+            limita_sessione()
+            autosalva()
+            cron.segna("salvataggio")
+            turno.chiudi()
+            rerun()
             
-        except Exception as e: st.error(f"Errore API: {e}")
-                    
+        except (TurnoAnnullato, TurnoScaduto) as e:
+            turno.chiudi()
+            cron.conta("turni_interrotti", tipo=type(e).__name__)
+            log.warning("Turno interrotto: %s", e)
+            st.warning(f"⌛ {e}. Riprova l'azione.")
+        except Exception as e:
+            turno.chiudi()
+            cron.conta("errori_api", tipo=type(e).__name__)
+            log.warning("Errore API (%s): %s", type(e).__name__, e)
+            st.error(f"Errore API: {e}")
+
+cron.chiudi()
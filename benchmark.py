@@ -0,0 +1,310 @@
+"""Benchmark riproducibile del ciclo di gioco.
+
+Un copione di azioni (creazione, intro, attacchi, riposi, incantesimi, abbastanza turni
+da far scattare il consolidamento della memoria) viene giocato contro un modello finto
+con latenza configurabile e un server immagini locale, con RNG a seed fisso. A parità
+di seed le risposte, i prompt e lo stato finale sono identici: cambiano solo i tempi.
+
+    python benchmark.py --seed 1 --latenza 0.05 > risultati.json
+    python benchmark.py --ui          # anche i tempi di rerun dell'app (AppTest)
+"""
+import hashlib
+import json
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import motore
+from client_modello import ClientModello
+from contesto import nuovo_messaggio, stima_token
+from immagini import PipelineImmagini
+from memoria import Consolidatore
+from salvataggi import estrai, serializza
+
+SESSIONE = "benchmark"
+INTRO = "Sei il DM. Inizia avventura per Bench (Elfo Mago). Descrizione evocativa."
+
+# Copione di default: (tipo, argomento). Due giri superano i 15 messaggi della memoria.
+COPIONE = [
+    ("attacca", None), ("testo", "Mi guardo intorno nella taverna."), ("abilita", "Percezione"),
+    ("attacca", None), ("incantesimo", 1), ("incantesimo", None), ("riposo", "breve"),
+    ("attacca", None), ("testo", "Chiedo all'oste del goblin."), ("riposo", "lungo"),
+]
+
+RISPOSTA_INTRO = ("Benvenuto, eroe. La taverna del Drago Zoppo è fumosa e rumorosa.\n"
+                  "```json\n{'location_visual': 'taverna fumosa illuminata da candele'}\n```")
+RISPOSTE_TURNO = [
+    ("Un goblin sbuca da dietro il bancone, coltello in pugno!\n"
+     "```json\n{'enemy_update': {'name': 'Goblin', 'hp': 7, 'ac': 13}, 'damage_to_player': 1, 'xp_gain': 0, "
+     "'gold_gain': 0, 'loot_found': null, 'location_visual': null}\n```"),
+    ("Il colpo va a segno e il goblin crolla a terra.\n"
+     "```json\n{'enemy_update': {'name': 'Goblin', 'hp': 0, 'ac': 13}, 'damage_to_player': 0, 'xp_gain': 50, "
+     "'gold_gain': 4, 'loot_found': 'Comune', 'location_visual': null}\n```"),
+    "Una scala scende verso le cantine umide. [[LUOGO:cantina di pietra con botti e ragnatele]]",
+    # blocco sporco: passa dal percorso di riparazione del parser
+    ("L'oste borbotta qualcosa e torna a pulire i boccali.\n"
+     "```json\n{'enemy_update': None, 'damage_to_player': 0, xp_gain: 10, 'gold_gain': 1,}\n```"),
+]
+RISPOSTA_RIASSUNTO = "L'eroe ha sconfitto un goblin nella taverna. Ha esplorato le cantine. Ha parlato con l'oste."
+
+# GIF 1x1: abbastanza per il percorso download -> miniatura -> cache su disco
+PIXEL = bytes.fromhex("47494638396101000100800000000000ffffff21f90401000000002c00000000010001000002024401003b")
+
+
+class Chunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class ModelloFinto:
+    """Stessa interfaccia di `genai.GenerativeModel` per quello che usa l'app: risposte
+    fisse (a rotazione, quindi deterministiche) e latenza simulata."""
+
+    def __init__(self, latenza=0.0, latenza_chunk=0.0, dim_chunk=16):
+        self.latenza = latenza
+        self.latenza_chunk = latenza_chunk
+        self.dim_chunk = dim_chunk
+        self.chiamate = 0
+        self._turno = 0
+        self._lock = threading.Lock()
+
+    def risposta(self, prompt):
+        if prompt.startswith("Riassumi"): return RISPOSTA_RIASSUNTO
+        if "Inizia avventura" in prompt: return RISPOSTA_INTRO
+        with self._lock:
+            self._turno += 1
+            return RISPOSTE_TURNO[(self._turno - 1) % len(RISPOSTE_TURNO)]
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        with self._lock: self.chiamate += 1
+        testo = self.risposta(prompt)
+        time.sleep(self.latenza)
+        if not stream: return Chunk(testo)
+        return self._stream(testo)
+
+    def _stream(self, testo):
+        for i in range(0, len(testo), self.dim_chunk):
+            if self.latenza_chunk: time.sleep(self.latenza_chunk)
+            yield Chunk(testo[i:i + self.dim_chunk])
+
+
+class _GestoreImmagini(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "image/gif")
+        self.send_header("Content-Length", str(len(PIXEL)))
+        self.end_headers()
+        self.wfile.write(PIXEL)
+
+    def log_message(self, *args):
+        pass
+
+
+class ServerImmagini:
+    """Finto Pollinations su una porta locale libera."""
+
+    def __enter__(self):
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _GestoreImmagini)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}/image"
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def sintesi(valori):
+    if not valori: return None
+    ordinati = sorted(valori)
+    return {"media": round(statistics.fmean(ordinati), 6), "p50": round(ordinati[len(ordinati) // 2], 6),
+            "p95": round(ordinati[min(len(ordinati) - 1, int(len(ordinati) * 0.95))], 6), "max": round(ordinati[-1], 6)}
+
+
+def impronta(stato, url_server):
+    # La porta del server immagini cambia a ogni esecuzione: fuori dall'impronta
+    testo = json.dumps(estrai(stato), sort_keys=True, ensure_ascii=False).replace(url_server, "")
+    return hashlib.sha256(testo.encode("utf-8")).hexdigest()[:16]
+
+
+def copione(turni):
+    return [COPIONE[i % len(COPIONE)] for i in range(turni)]
+
+
+def _azione(stato, passo, rng):
+    tipo, arg = passo
+    magie = stato["personaggio"]["magie"]
+    if tipo == "attacca": return motore.attacca(stato, motore.derivati_pg(stato)["armi"][0], rng)[0]
+    if tipo == "abilita": return motore.prova_abilita(stato, arg, rng)[0]
+    if tipo == "incantesimo": return motore.lancia_incantesimo(stato, magie[0] if arg else magie[1], arg)[0]
+    if tipo == "riposo": return motore.riposo_lungo(stato)[0] if arg == "lungo" else motore.riposo_breve(stato, rng)[0]
+    return arg
+
+
+def esegui_headless(passi, seed=0, latenza=0.0, latenza_chunk=0.0, stream=True):
+    """Gioca il copione sul motore headless con il client e la memoria veri."""
+    rng = random.Random(seed)
+    modello = ModelloFinto(latenza, latenza_chunk)
+    client = ClientModello(modello)
+    cons = Consolidatore(lambda prompt: client.testo(prompt, SESSIONE))
+    stato = motore.stato_iniziale()
+    motore.crea_personaggio(stato, "Bench", "Elfo", "Mago", motore.tira_statistiche(rng))
+    stato["personaggio"]["id"] = f"benchmark-{seed}"
+    t0 = time.perf_counter()
+    stato["messages"][-1] = nuovo_messaggio("assistant", client.testo(INTRO, SESSIONE))
+    intro_s = time.perf_counter() - t0
+    turni, urls = [], []
+
+    with ServerImmagini() as server, tempfile.TemporaryDirectory() as cartella:
+        pipeline = PipelineImmagini(cartella)
+
+        def immagine(scena):
+            url = f"{server.url}/{urllib.parse.quote(scena)}?seed={rng.randint(1, 99999)}"
+            pipeline.prefetch(url)
+            urls.append(url)
+            return url
+
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        for n, passo in enumerate(passi, 1):
+            misura = {"n": n, "passo": passo[0], "consolidamento": False}
+            t0 = time.perf_counter()
+            # Come gestisci_memoria nell'app, ma sincrono: il riassunto entra sempre allo stesso turno
+            esito = cons.raccogli()
+            if esito and esito[0]: motore.applica_riassunto(stato, *esito)
+            if len(stato["messages"]) > 15 and not cons.occupato and cons.avvia(stato["messages"][1:-5]):
+                cons.attendi()
+                misura["consolidamento"] = True
+
+            def genera(prompt):
+                misura["token_prompt"] = stima_token(prompt)
+                t_modello = time.perf_counter()
+                if not stream: return client.testo(prompt, SESSIONE)
+                pezzi = []
+                for chunk in client.genera_stream(prompt, SESSIONE):
+                    if not pezzi: misura["primo_chunk_s"] = round(time.perf_counter() - t_modello, 6)
+                    pezzi.append(chunk.text)
+                return "".join(pezzi)
+
+            azione = _azione(stato, passo, rng)
+            if azione: motore.turno(stato, azione, genera, immagine, rng)
+            misura["secondi"] = round(time.perf_counter() - t0, 6)
+            misura["memoria_kb"] = round((tracemalloc.get_traced_memory()[0] - base) / 1024, 1)
+            misura["stato_bytes"] = len(serializza(stato))
+            misura["messaggi"] = len(stato["messages"])
+            turni.append(misura)
+        picco = tracemalloc.get_traced_memory()[1] - base
+        tracemalloc.stop()
+
+        t0 = time.perf_counter()
+        for url in urls: pipeline.attendi(url, timeout=30)
+        immagini = {"richieste": len(urls), "pronte": sum(pipeline.pronta(u) for u in urls),
+                    "attesa_finale_s": round(time.perf_counter() - t0, 6)}
+
+    return {
+        "intro_s": round(intro_s, 6),
+        "turni": turni,
+        "sintesi": {
+            "secondi": sintesi([t["secondi"] for t in turni]),
+            "primo_chunk_s": sintesi([t["primo_chunk_s"] for t in turni if "primo_chunk_s" in t]),
+            "token_prompt": sintesi([t["token_prompt"] for t in turni if "token_prompt" in t]),
+            "crescita_memoria_kb": turni[-1]["memoria_kb"] if turni else 0,
+            "picco_memoria_kb": round(picco / 1024, 1),
+            "crescita_stato_bytes": turni[-1]["stato_bytes"] - turni[0]["stato_bytes"] if turni else 0,
+            "consolidamenti": sum(t["consolidamento"] for t in turni),
+        },
+        "immagini": immagini,
+        "chiamate_modello": modello.chiamate,
+        "riassunti": len(stato["summary_history"]),
+        # Uguale a parità di seed e copione: se cambia, sono cambiate le regole o i prompt
+        "impronta_stato": impronta(stato, server.url),
+    }
+
+
+def _clicca(at, etichetta):
+    [b for b in at.button if etichetta in b.label][0].click()
+
+
+def _scheda(at, nome, livello=None):
+    """La barra laterale disegna solo la scheda aperta: la si apre prima di cliccare."""
+    [w for w in at.get("button_group") if w.key == "scheda"][0].set_value(nome).run()
+    if livello: [w for w in at.get("button_group") if w.key == "livello_magia"][0].set_value(livello).run()
+
+
+def esegui_ui(passi, seed=0, latenza=0.0, latenza_chunk=0.0):
+    """Stesso copione attraverso l'app vera con AppTest: tempo di ogni turno e di un rerun a vuoto."""
+    import google.generativeai as genai
+    from streamlit.testing.v1 import AppTest
+
+    modello = ModelloFinto(latenza, latenza_chunk)
+    genai.GenerativeModel = lambda *args, **kwargs: modello
+    genai.configure = lambda **kwargs: None
+    random.seed(seed)
+    turni = []
+    with ServerImmagini() as server, tempfile.TemporaryDirectory() as cartella:
+        at = AppTest.from_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py"), default_timeout=60)
+        at.secrets.update({"GEMINI_API_KEY": "benchmark", "POLLINATIONS_BASE_URL": server.url,
+                           "CACHE_IMMAGINI_DIR": os.path.join(cartella, "img"), "SALVATAGGI_DIR": os.path.join(cartella, "salvataggi")})
+        t0 = time.perf_counter()
+        at.run()
+        avvio_s = time.perf_counter() - t0
+        _clicca(at, "Genera")
+        at.run()
+        at.text_input[0].input("Bench")
+        [s for s in at.selectbox if s.label == "Classe"][0].select("Mago")
+        _clicca(at, "Inizia")
+        t0 = time.perf_counter()
+        at.run()
+        intro_s = time.perf_counter() - t0
+        for n, (tipo, arg) in enumerate(passi, 1):
+            if tipo == "testo": at.chat_input[0].set_value(arg)
+            elif tipo == "attacca": _clicca(at, "Attacca")
+            elif tipo == "abilita":
+                _scheda(at, "🎯 Skill")
+                _clicca(at, arg)
+            elif tipo == "incantesimo":
+                _scheda(at, "✨ Magia", f"L{arg}" if arg else "Cantrip")
+                _clicca(at, "🔮" if arg else "✨")
+            elif tipo == "riposo":
+                _scheda(at, "🎯 Skill")
+                [s for s in at.selectbox if s.label == "Riposo"][0].select("Lungo" if arg == "lungo" else "Breve (1 HD)")
+                _clicca(at, "Dormi")
+            t0 = time.perf_counter()
+            at.run()
+            turno_s = time.perf_counter() - t0
+            if at.exception: raise RuntimeError(f"Eccezione al turno {n}: {at.exception}")
+            t0 = time.perf_counter()
+            at.run()
+            turni.append({"n": n, "passo": tipo, "secondi": round(turno_s, 6),
+                          "rerun_s": round(time.perf_counter() - t0, 6), "messaggi": len(at.session_state.messages)})
+    return {"avvio_s": round(avvio_s, 6), "intro_s": round(intro_s, 6), "turni": turni,
+            "sintesi": {"secondi": sintesi([t["secondi"] for t in turni]), "rerun_s": sintesi([t["rerun_s"] for t in turni])},
+            "chiamate_modello": modello.chiamate}
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark del ciclo di gioco con modello e immagini finti.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--turni", type=int, default=2 * len(COPIONE))
+    parser.add_argument("--latenza", type=float, default=0.0, help="secondi prima della risposta del modello")
+    parser.add_argument("--latenza-chunk", type=float, default=0.0, help="secondi tra un chunk e l'altro in streaming")
+    parser.add_argument("--no-stream", action="store_true")
+    parser.add_argument("--ui", action="store_true", help="misura anche i rerun dell'app Streamlit")
+    parser.add_argument("--output", help="file JSON (default: stdout)")
+    args = parser.parse_args()
+    passi = copione(args.turni)
+    risultati = {"config": {"seed": args.seed, "turni": args.turni, "latenza": args.latenza,
+                            "latenza_chunk": args.latenza_chunk, "stream": not args.no_stream},
+                 "headless": esegui_headless(passi, args.seed, args.latenza, args.latenza_chunk, not args.no_stream)}
+    if args.ui: risultati["ui"] = esegui_ui(passi, args.seed, args.latenza, args.latenza_chunk)
+    testo = json.dumps(risultati, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f: f.write(testo + "\n")
+    else: print(testo)
@@ -0,0 +1,111 @@
+"""Cache delle risposte del modello per le chiamate quasi deterministiche (intro, riassunti).
+
+La chiave è il prompt normalizzato più il nome del modello. In memoria c'è un LRU con
+limite di voci e TTL; opzionalmente un file SQLite condiviso tra i worker Streamlit.
+"""
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+SPAZI_RE = re.compile(r'\s+')
+
+
+def normalizza(prompt):
+    return SPAZI_RE.sub(" ", prompt).strip().lower()
+
+
+def chiave(prompt, modello):
+    return hashlib.sha256(f"{modello}\x00{normalizza(prompt)}".encode("utf-8")).hexdigest()
+
+
+class BackendSQLite:
+    """Secondo livello su disco. Una connessione per operazione: più processi possono
+    condividere lo stesso file."""
+
+    def __init__(self, path):
+        self.path = path
+        with self._conn() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS risposte (chiave TEXT PRIMARY KEY, testo TEXT NOT NULL, ts REAL NOT NULL)")
+
+    def _conn(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def leggi(self, k):
+        with self._conn() as conn:
+            return conn.execute("SELECT testo, ts FROM risposte WHERE chiave = ?", (k,)).fetchone()
+
+    def scrivi(self, k, testo, ts):
+        with self._conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO risposte VALUES (?, ?, ?)", (k, testo, ts))
+
+    def pulisci_scaduti(self, limite_ts):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM risposte WHERE ts < ?", (limite_ts,))
+
+
+class CacheRisposte:
+    def __init__(self, max_voci=256, ttl=6 * 3600, backend=None):
+        self.max_voci = max_voci
+        self.ttl = ttl
+        self.backend = backend
+        self._lru = OrderedDict()   # chiave -> (testo, ts)
+        self._lock = threading.Lock()
+        self.hit = self.miss = self.hit_disco = 0
+        if backend and ttl: backend.pulisci_scaduti(time.time() - ttl)
+
+    def _valida(self, ts):
+        return self.ttl is None or time.time() - ts <= self.ttl
+
+    def _metti(self, k, testo, ts):
+        self._lru[k] = (testo, ts)
+        self._lru.move_to_end(k)
+        while len(self._lru) > self.max_voci: self._lru.popitem(last=False)
+
+    def leggi(self, prompt, modello):
+        k = chiave(prompt, modello)
+        with self._lock:
+            voce = self._lru.get(k)
+            if voce and self._valida(voce[1]):
+                self._lru.move_to_end(k)
+                self.hit += 1
+                return voce[0]
+            self._lru.pop(k, None)
+        voce = None
+        if self.backend:
+            try: voce = self.backend.leggi(k)
+            except sqlite3.Error as e: log.warning("Errore cache su disco: %s", e)
+        with self._lock:
+            if voce and self._valida(voce[1]):
+                self._metti(k, *voce)
+                self.hit += 1
+                self.hit_disco += 1
+                return voce[0]
+            self.miss += 1
+        return None
+
+    def scrivi(self, prompt, modello, testo):
+        k, ts = chiave(prompt, modello), time.time()
+        with self._lock: self._metti(k, testo, ts)
+        if self.backend:
+            try: self.backend.scrivi(k, testo, ts)
+            except sqlite3.Error as e: log.warning("Errore cache su disco: %s", e)
+
+    def genera(self, prompt, modello, genera_fn):
+        """Ritorna la risposta in cache o chiama `genera_fn()` e la memorizza."""
+        testo = self.leggi(prompt, modello)
+        if testo is None:
+            testo = genera_fn()
+            self.scrivi(prompt, modello, testo)
+        return testo
+
+    def statistiche(self):
+        tot = self.hit + self.miss
+        return {"hit": self.hit, "miss": self.miss, "hit_disco": self.hit_disco,
+                "hit_rate": round(self.hit / tot, 3) if tot else 0.0, "voci": len(self._lru)}
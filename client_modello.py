@@ -0,0 +1,207 @@
+"""Client condiviso dal processo per le chiamate a Gemini.
+
+Limita le chiamate concorrenti, le distribuisce in modo equo tra le sessioni (nessun
+tavolo può occupare più di `max_per_sessione` slot, e chi ha meno chiamate in volo
+passa per primo) e rallenta tutto il processo quando arriva un rate limit.
+
+Gli errori sono classificati: i rate limit (429) fermano tutto il processo per il backoff,
+gli errori transitori (5xx, timeout, rete) si ritentano con backoff esponenziale e jitter,
+quelli permanenti (richiesta non valida, chiave, contenuto bloccato) risalgono subito.
+Quando i tentativi falliscono di fila l'interruttore di processo si apre e le chiamate
+successive falliscono subito con `ModelloNonDisponibile`: l'app passa al DM di riserva.
+"""
+import itertools
+import logging
+import random
+import re
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+TRANSITORI = ("InternalServerError", "ServiceUnavailable", "DeadlineExceeded", "GatewayTimeout", "BadGateway",
+              "Aborted", "Unknown", "RetryError", "ServerError")
+CODICE_5XX_RE = re.compile(r'\b5\d\d\b')
+
+
+class ModelloNonDisponibile(Exception):
+    """Il modello non risponde: tentativi esauriti su errori ritentabili o interruttore aperto."""
+
+
+class CircuitoAperto(ModelloNonDisponibile):
+    pass
+
+
+def e_rate_limit(e):
+    nome = type(e).__name__
+    return nome in ("ResourceExhausted", "TooManyRequests") or "429" in str(e)
+
+
+def classifica(e):
+    """'rate_limit', 'transitorio' o 'permanente'."""
+    if e_rate_limit(e): return "rate_limit"
+    codice = getattr(e, "code", None)   # le eccezioni di google.api_core portano lo stato HTTP
+    if isinstance(codice, int) and 500 <= codice < 600: return "transitorio"
+    if type(e).__name__ in TRANSITORI or isinstance(e, (TimeoutError, ConnectionError)): return "transitorio"
+    if CODICE_5XX_RE.search(str(e)): return "transitorio"
+    return "permanente"
+
+
+class Interruttore:
+    """Circuit breaker di processo. Dopo `soglia` chiamate fallite di fila resta aperto per
+    `pausa` secondi, poi lascia passare una sola chiamata di prova: se va bene si richiude,
+    se fallisce si riapre per un'altra pausa."""
+
+    def __init__(self, soglia=5, pausa=60.0):
+        self.soglia = soglia
+        self.pausa = pausa
+        self._lock = threading.Lock()
+        self._fallimenti = 0
+        self._aperto_fino = 0.0
+        self._prova = 0.0          # inizio della chiamata di prova in volo (0 = nessuna)
+        self.aperture = 0
+
+    @property
+    def aperto(self):
+        with self._lock: return self._fallimenti >= self.soglia
+
+    def controlla(self):
+        with self._lock:
+            if self._fallimenti < self.soglia: return
+            ora = time.monotonic()
+            if ora < self._aperto_fino: raise CircuitoAperto(f"Modello in pausa per altri {self._aperto_fino - ora:.0f}s")
+            # Una prova rimasta appesa (stream abbandonato) scade dopo una pausa
+            if self._prova and ora - self._prova < self.pausa: raise CircuitoAperto("Chiamata di prova in corso")
+            self._prova = ora
+
+    def successo(self):
+        with self._lock:
+            if self._fallimenti >= self.soglia: log.info("Interruttore del modello richiuso")
+            self._fallimenti = 0
+            self._prova = 0.0
+
+    def fallimento(self):
+        with self._lock:
+            self._fallimenti += 1
+            self._prova = 0.0
+            if self._fallimenti < self.soglia: return
+            if time.monotonic() >= self._aperto_fino:
+                self.aperture += 1
+                log.warning("Interruttore del modello aperto per %ss dopo %d fallimenti", self.pausa, self._fallimenti)
+            self._aperto_fino = time.monotonic() + self.pausa
+
+
+class ClientModello:
+    def __init__(self, model, max_concorrenti=8, max_per_sessione=2, tentativi=4, backoff_base=1.0, backoff_max=30.0,
+                 interruttore=None):
+        self.model = model
+        self.interruttore = interruttore or Interruttore()
+        self.max_concorrenti = max_concorrenti
+        self.max_per_sessione = max_per_sessione
+        self.tentativi = tentativi
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._cond = threading.Condition()
+        self._attivi = {}          # sessione -> chiamate in volo
+        self._in_volo = 0
+        self._attesa = []          # (ordine, sessione) in attesa di uno slot
+        self._ordine = itertools.count()
+        self._pausa_fino = 0.0     # backoff condiviso dopo un 429
+        self.chiamate = self.rate_limit = 0
+        self.errori = {}           # classe d'errore -> conteggio
+
+    # --- scheduling equo ---
+    def _prossimo(self):
+        idonei = [(self._attivi.get(s, 0), o, s) for o, s in self._attesa
+                  if self._attivi.get(s, 0) < self.max_per_sessione]
+        return min(idonei)[1] if idonei else None
+
+    def _acquisisci(self, sessione):
+        with self._cond:
+            ticket = next(self._ordine)
+            self._attesa.append((ticket, sessione))
+            while True:
+                pausa = self._pausa_fino - time.monotonic()
+                if pausa <= 0 and self._in_volo < self.max_concorrenti and self._prossimo() == ticket: break
+                self._cond.wait(timeout=pausa if pausa > 0 else None)
+            self._attesa.remove((ticket, sessione))
+            self._attivi[sessione] = self._attivi.get(sessione, 0) + 1
+            self._in_volo += 1
+            self.chiamate += 1
+
+    def _rilascia(self, sessione):
+        with self._cond:
+            self._in_volo -= 1
+            self._attivi[sessione] -= 1
+            if not self._attivi[sessione]: del self._attivi[sessione]
+            self._cond.notify_all()
+
+    def _backoff(self, tentativo):
+        return min(self.backoff_max, self.backoff_base * 2 ** tentativo) * random.uniform(0.5, 1.0)
+
+    def _dopo_errore(self, e, tentativo):
+        """Decide dopo un errore (a slot già rilasciato): ritorna dopo il backoff se si ritenta,
+        altrimenti solleva l'errore originale o `ModelloNonDisponibile`."""
+        tipo = classifica(e)
+        with self._cond: self.errori[tipo] = self.errori.get(tipo, 0) + 1
+        if tipo == "permanente":
+            self.interruttore.successo()   # il servizio ha risposto: l'errore è della richiesta
+            raise e
+        if tentativo == self.tentativi - 1:
+            self.interruttore.fallimento()
+            raise ModelloNonDisponibile(f"{type(e).__name__}: {e}") from e
+        attesa = self._backoff(tentativo)
+        if tipo == "rate_limit":
+            # Il rate limit vale per tutto il processo: nessuno riparte prima della fine della pausa
+            with self._cond:
+                self.rate_limit += 1
+                self._pausa_fino = max(self._pausa_fino, time.monotonic() + attesa)
+                self._cond.notify_all()
+        else: time.sleep(attesa)
+
+    # --- API ---
+    def genera(self, prompt, sessione=None, **kwargs):
+        """Come `model.generate_content`, con slot equi e retry sugli errori ritentabili."""
+        self.interruttore.controlla()
+        for tentativo in range(self.tentativi):
+            self._acquisisci(sessione)
+            errore = None
+            try: risposta = self.model.generate_content(prompt, **kwargs)
+            except Exception as e: errore = e
+            finally: self._rilascia(sessione)
+            if errore is None:
+                self.interruttore.successo()
+                return risposta
+            self._dopo_errore(errore, tentativo)
+
+    def genera_stream(self, prompt, sessione=None, **kwargs):
+        """Generatore di chunk in streaming. Lo slot resta occupato finché lo stream
+        non è consumato; il retry vale solo prima del primo chunk."""
+        self.interruttore.controlla()
+        for tentativo in range(self.tentativi):
+            self._acquisisci(sessione)
+            ricevuto, errore = False, None
+            try:
+                for chunk in self.model.generate_content(prompt, stream=True, **kwargs):
+                    ricevuto = True
+                    yield chunk
+            except Exception as e:
+                if ricevuto:
+                    if classifica(e) != "permanente": self.interruttore.fallimento()
+                    raise
+                errore = e
+            finally: self._rilascia(sessione)
+            if errore is None:
+                self.interruttore.successo()
+                return
+            self._dopo_errore(errore, tentativo)
+
+    def testo(self, prompt, sessione=None, **kwargs):
+        return self.genera(prompt, sessione, **kwargs).text
+
+    def statistiche(self):
+        with self._cond:
+            return {"in_volo": self._in_volo, "in_attesa": len(self._attesa), "chiamate": self.chiamate,
+                    "rate_limit": self.rate_limit, "sessioni_attive": len(self._attivi),
+                    "circuito_aperto": int(self.interruttore.aperto), "aperture_circuito": self.interruttore.aperture,
+                    **{f"errori_{tipo}": n for tipo, n in self.errori.items()}}
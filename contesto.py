@@ -0,0 +1,127 @@
+"""Assemblaggio del prompt del DM entro un budget di token.
+
+Ogni segmento (messaggio, voce di diario, riassunto) porta con sé il testo già
+ripulito e una stima dei token, calcolati una sola volta quando viene creato.
+"""
+import re
+
+JSON_BLOCK_RE = re.compile(r'```json.*?```', re.DOTALL)
+LUOGO_RE = re.compile(r'\[\[LUOGO:(.*?)\]\]', re.DOTALL)
+FINE_FRASE_RE = re.compile(r'(?<=[.!?])\s')
+
+BUDGET_DEFAULT = 3000     # token per la parte variabile del prompt (storia, diario, riassunti)
+MAX_RIASSUNTI = 12        # oltre questa soglia i riassunti più vecchi vengono compressi
+MAX_TOKEN_RIASSUNTI = 1200
+RIASSUNTI_RECENTI = 2     # con il recupero dei ricordi, solo gli ultimi riassunti entrano sempre
+
+ISTRUZIONI = (
+    "--- ISTRUZIONI CRITICHE ---\n"
+    "1. Rispondi narrativamente come un DM esperto.\n"
+    "2. ALLA FINE, INSERISCI BLOCCO JSON PURO PER MECCANICA.\n"
+    "3. FORMATO JSON:\n"
+    "```json\n"
+    "{\n"
+    "  'enemy_update': {'name': '...', 'hp': ..., 'ac': ...} (o null),\n"
+    "  'damage_to_player': int (0 se nullo),\n"
+    "  'xp_gain': int, 'gold_gain': int,\n"
+    "  'loot_found': 'nome_oggetto' (o null),\n"
+    "  'location_visual': 'descrizione per immagine' (o null)\n"
+    "}\n"
+    "```"
+)
+
+
+def stima_token(testo):
+    # ~4 caratteri per token: abbastanza per un budget, senza dipendere dal tokenizer
+    return (len(testo) + 3) // 4
+
+
+def pulisci(testo):
+    return JSON_BLOCK_RE.sub('', testo).strip()
+
+
+def nuovo_messaggio(role, content, **extra):
+    """Crea un messaggio della chat con testo ripulito e stima token precalcolati."""
+    display = pulisci(content)
+    return {"role": role, "content": content, "display_content": display, "tok": stima_token(display), **extra}
+
+
+def assicura_display(msg):
+    """Migrazione pigra dei salvataggi vecchi: calcola il testo ripulito la prima volta
+    che il messaggio viene mostrato e lo memorizza nel messaggio stesso."""
+    if "display_content" not in msg:
+        msg["display_content"] = pulisci(msg["content"])
+        msg["tok"] = stima_token(msg["display_content"])
+    return msg["display_content"]
+
+
+def _riassunto(testo, compresso=False):
+    return {"testo": testo, "tok": stima_token(testo), "compresso": compresso}
+
+
+def comprimi(testo):
+    """Compressione senza LLM: tiene solo la prima frase."""
+    return FINE_FRASE_RE.split(testo.strip(), maxsplit=1)[0]
+
+
+def migra_riassunti(summary_history):
+    """Converte il vecchio `summary_history` (stringa concatenata) nella lista di segmenti."""
+    if isinstance(summary_history, list): return summary_history
+    return [_riassunto(r.strip()) for r in (summary_history or "").split("\n") if r.strip()]
+
+
+def aggiungi_riassunto(riassunti, testo):
+    """Aggiunge un riassunto e mantiene limitata la memoria: i più vecchi vengono prima
+    compressi, poi scartati."""
+    riassunti.append(_riassunto(testo.strip()))
+    totale = sum(r["tok"] for r in riassunti)
+    for i, r in enumerate(riassunti[:-1]):
+        if len(riassunti) <= MAX_RIASSUNTI and totale <= MAX_TOKEN_RIASSUNTI: break
+        if not r["compresso"]:
+            riassunti[i] = _riassunto(comprimi(r["testo"]), compresso=True)
+            totale += riassunti[i]["tok"] - r["tok"]
+    while len(riassunti) > 1 and (len(riassunti) > MAX_RIASSUNTI or totale > MAX_TOKEN_RIASSUNTI):
+        totale -= riassunti.pop(0)["tok"]
+    return riassunti
+
+
+def _entro_budget(segmenti, budget):
+    """Prende i segmenti dal più recente al più vecchio finché stanno nel budget.
+    Ritorna (segmenti scelti in ordine cronologico, token usati)."""
+    scelti, usati = [], 0
+    for testo, tok in reversed(segmenti):
+        if usati + tok > budget: break
+        scelti.append(testo)
+        usati += tok
+    return scelti[::-1], usati
+
+
+def costruisci_prompt(p, hp, hp_max, nemico, journal, riassunti, messages, azione, budget=BUDGET_DEFAULT, istruzioni=ISTRUZIONI,
+                      note=None, ricordi=None):
+    """Ritorna (prompt completo, token stimati).
+
+    Priorità nel budget: ultimi messaggi, poi diario recente, poi riassunti, poi ricordi;
+    a parità di tipo si scartano per primi i segmenti più vecchi (o meno pertinenti).
+    Con `ricordi` (dal più al meno pertinente) entrano solo gli ultimi riassunti: il resto
+    della campagna arriva dal recupero, e il prompt non cresce con la partita.
+    """
+    storia = [(f"{m['role'].upper()}: {assicura_display(m)}", m["tok"]) for m in messages[-6:] if m["role"] != "system"]
+    storia, usati = _entro_budget(storia, budget)
+    diario, tok_diario = _entro_budget([(j, stima_token(j)) for j in journal[-10:]], budget - usati)
+    usati += tok_diario
+    if ricordi is not None: riassunti = riassunti[-RIASSUNTI_RECENTI:]
+    memoria, tok_memoria = _entro_budget([(r["testo"], r["tok"]) for r in riassunti], budget - usati)
+    usati += tok_memoria
+    richiamati, tok_ricordi = _entro_budget([(r, stima_token(r)) for r in reversed(ricordi or [])], budget - usati)
+    usati += tok_ricordi
+
+    journal_str = "\n".join(diario)
+    history_text = "\n".join(memoria) + "\n" + "".join(f"{h}\n" for h in storia)
+    sys = (f"Sei il DM (5e). PG: {p['nome']} {p['classe']}. HP:{hp}/{hp_max}. "
+           f"Diario: {journal_str}. Nemico Attivo: {nemico}. "
+           f"{'Ricordi della campagna: ' + '; '.join(richiamati) + '. ' if richiamati else ''}"
+           f"{note + ' ' if note else ''}"
+           f"\n--- STORIA ---\n{history_text}\n"
+           f"{istruzioni}")
+    full_prompt = sys + "\n\nAZIONE: " + azione
+    return full_prompt, stima_token(full_prompt)
@@ -0,0 +1,169 @@
+"""Motore dei dadi e simulatore Monte Carlo dei combattimenti.
+
+Le formule ("2d6+1d4+3", "4d6kh3", "d20adv", "2d20kl1-1") vengono compilate una volta
+sola e poi tirate singolarmente (random) o in blocco (NumPy).
+"""
+import random
+import re
+from functools import lru_cache
+
+import numpy as np
+
+TERMINE_RE = re.compile(r'([+-]?)(?:(\d*)d(\d+)(?:(kh|kl)(\d+)|(adv|dis))?|(\d+))')
+
+
+class ErroreFormula(ValueError):
+    pass
+
+
+class Formula:
+    """Somma di termini: (segno, n_dadi, facce, tieni, quanti) per i dadi, più una costante."""
+
+    def __init__(self, testo, termini, costante):
+        self.testo = testo
+        self.termini = termini
+        self.costante = costante
+
+    def __repr__(self):
+        return f"Formula({self.testo!r})"
+
+    def _dadi(self, critico):
+        for segno, n, facce, tieni, quanti in self.termini:
+            # Critico 5e: si raddoppiano i dadi tirati, non i modificatori
+            if critico and tieni is None: n *= 2
+            yield segno, n, facce, tieni, quanti
+
+    def tira(self, critico=False, rng=random):
+        """Ritorna (totale, lista dei dadi tenuti)."""
+        totale, tenuti = self.costante, []
+        for segno, n, facce, tieni, quanti in self._dadi(critico):
+            tiri = [rng.randint(1, facce) for _ in range(n)]
+            if tieni:
+                tiri = sorted(tiri, reverse=(tieni == "kh"))[:quanti]
+            totale += segno * sum(tiri)
+            tenuti.extend(tiri)
+        return totale, tenuti
+
+    def tira_blocco(self, n_prove, rng=None, critico=False, solo_dadi=False):
+        """Array NumPy di `n_prove` totali indipendenti."""
+        rng = rng if rng is not None else np.random.default_rng()
+        totale = np.zeros(n_prove, dtype=np.int64) if solo_dadi else np.full(n_prove, self.costante, dtype=np.int64)
+        for segno, n, facce, tieni, quanti in self._dadi(critico):
+            tiri = rng.integers(1, facce + 1, size=(n_prove, n))
+            if tieni:
+                tiri = np.sort(tiri, axis=1)
+                tiri = tiri[:, -quanti:] if tieni == "kh" else tiri[:, :quanti]
+            totale += segno * tiri.sum(axis=1)
+        return totale
+
+    def media(self):
+        tot = self.costante
+        for segno, n, facce, tieni, quanti in self.termini:
+            tot += segno * (quanti if tieni else n) * (facce + 1) / 2   # approssimata per kh/kl
+        return tot
+
+
+@lru_cache(maxsize=512)
+def compila(formula):
+    testo = formula.lower().replace(" ", "")
+    if not testo: raise ErroreFormula("formula vuota")
+    termini, costante, pos = [], 0, 0
+    for m in TERMINE_RE.finditer(testo):
+        if m.start() != pos or (pos and not m.group(1)): raise ErroreFormula(f"formula non valida: {formula!r}")
+        pos = m.end()
+        segno = -1 if m.group(1) == "-" else 1
+        if m.group(7) is not None:
+            costante += segno * int(m.group(7))
+            continue
+        n, facce = int(m.group(2) or 1), int(m.group(3))
+        tieni, quanti = m.group(4), int(m.group(5)) if m.group(5) else None
+        if m.group(6):   # vantaggio/svantaggio: due dadi, si tiene il migliore/peggiore
+            n, tieni, quanti = max(n, 2), ("kh" if m.group(6) == "adv" else "kl"), 1
+        if facce < 1 or n < 1 or (quanti is not None and not 1 <= quanti <= n):
+            raise ErroreFormula(f"formula non valida: {formula!r}")
+        termini.append((segno, n, facce, tieni, quanti))
+    if pos != len(testo): raise ErroreFormula(f"formula non valida: {formula!r}")
+    return Formula(formula, tuple(termini), costante)
+
+
+def tira(formula, critico=False, rng=random):
+    return compila(formula).tira(critico, rng)
+
+
+# --- simulatore di combattimento ---
+
+# Statistiche offensive medie per grado di sfida (DMG cap. 9), indicizzate per PF del mostro:
+# (PF massimi, bonus attacco, danno medio per round)
+OFFESA_PER_PF = [(6, 3, 1), (35, 3, 3), (49, 3, 5), (70, 3, 8), (85, 3, 12), (100, 3, 18),
+                 (115, 4, 24), (130, 5, 30), (145, 6, 36), (160, 6, 42), (175, 6, 48)]
+
+
+def offesa_stimata(nemico):
+    """Bonus d'attacco e danno medio del nemico: dai dati espliciti se ci sono, altrimenti dai PF."""
+    hp = nemico.get("hp_max") or nemico.get("hp") or 1
+    atk, dmg = next(((a, d) for soglia, a, d in OFFESA_PER_PF if hp <= soglia), OFFESA_PER_PF[-1][1:])
+    if "danno" in nemico: return nemico.get("attacco", atk), str(nemico["danno"])
+    # danno medio -> formula con una varianza plausibile (circa 70% dai d6)
+    n_d6 = max(1, round(dmg * 0.7 / 3.5))
+    fisso = round(dmg - n_d6 * 3.5)
+    return nemico.get("attacco", atk), f"{n_d6}d6{fisso:+d}" if fisso else f"{n_d6}d6"
+
+
+def _attacco(rng, n, bonus, ca, formula, mod_danno):
+    d20 = rng.integers(1, 21, size=n)
+    critico = d20 == 20
+    colpito = critico | ((d20 != 1) & (d20 + bonus >= ca))
+    danno = formula.tira_blocco(n, rng) + mod_danno
+    danno += np.where(critico, formula.tira_blocco(n, rng, solo_dadi=True), 0)
+    return np.where(colpito, np.maximum(1, danno), 0)
+
+
+def simula_combattimento(pg, nemico, prove=100_000, max_round=20, seed=None):
+    """Monte Carlo di uno scontro uno contro uno fino alla sconfitta di uno dei due.
+
+    pg: {"hp", "ca", "bonus_attacco", "dice", "mod_danno", "iniziativa"}
+    nemico: come `nemico_corrente` ({"hp", "hp_max", "ca"}), con "attacco"/"danno" opzionali.
+    """
+    rng = np.random.default_rng(seed)
+    f_pg = compila(pg["dice"])
+    atk_nem, dmg_nem = offesa_stimata(nemico)
+    f_nem = compila(str(dmg_nem))
+    hp_pg = np.full(prove, pg["hp"], dtype=np.int64)
+    hp_nem = np.full(prove, nemico["hp"], dtype=np.int64)
+    inflitto = np.zeros(prove, dtype=np.int64)
+    round_fine = np.full(prove, max_round, dtype=np.int64)
+    pg_primo = rng.integers(1, 21, size=prove) + pg.get("iniziativa", 0) >= rng.integers(1, 21, size=prove)
+
+    for r in range(max_round):
+        vivi = (hp_pg > 0) & (hp_nem > 0)
+        if not vivi.any(): break
+        colpo_pg = np.where(vivi, _attacco(rng, prove, pg["bonus_attacco"], nemico.get("ca", 10), f_pg, pg.get("mod_danno", 0)), 0)
+        colpo_nem = np.where(vivi, _attacco(rng, prove, atk_nem, pg["ca"], f_nem, 0), 0)
+        # chi agisce per secondo colpisce solo se è ancora in piedi
+        hp_nem_dopo = hp_nem - colpo_pg
+        colpo_nem = np.where(pg_primo & (hp_nem_dopo <= 0), 0, colpo_nem)
+        hp_pg_dopo = hp_pg - colpo_nem
+        colpo_pg = np.where(~pg_primo & (hp_pg_dopo <= 0), 0, colpo_pg)
+        inflitto += np.minimum(colpo_pg, np.maximum(hp_nem, 0))
+        hp_nem -= colpo_pg
+        hp_pg -= colpo_nem
+        finiti = vivi & ((hp_pg <= 0) | (hp_nem <= 0))
+        round_fine[finiti] = r + 1
+
+    vittorie = (hp_nem <= 0) & (hp_pg > 0)
+    return {
+        "vittoria": float(vittorie.mean()),
+        "sconfitta": float((hp_pg <= 0).mean()),
+        "danno_inflitto_medio": float(inflitto.mean()),
+        "danno_subito_medio": float((pg["hp"] - np.maximum(hp_pg, 0)).mean()),
+        "round_medi": float(round_fine.mean()),
+        "prove": prove,
+    }
+
+
+def suggerimento_incontro(esito):
+    """Riga compatta per il prompt del DM."""
+    p = esito["vittoria"]
+    livello = "facile" if p >= 0.9 else "equilibrato" if p >= 0.65 else "difficile" if p >= 0.35 else "mortale"
+    return (f"Bilanciamento (simulato): scontro {livello}, vittoria PG {p:.0%}, "
+            f"danno subito medio {esito['danno_subito_medio']:.0f}, ~{esito['round_medi']:.1f} round.")
@@ -0,0 +1,124 @@
+"""Pipeline immagini: download in background, miniature e cache locale su disco.
+
+Le immagini vengono scaricate da un pool di worker appena la scena è nota, ridotte a
+miniatura e salvate per contenuto (sha256 dei byte). Un file indice per URL punta al
+contenuto, così la stessa immagine non viene riscaricata né duplicata su disco.
+"""
+import hashlib
+import io
+import logging
+import os
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:   # senza Pillow si salvano i byte originali
+    Image = None
+
+log = logging.getLogger(__name__)
+LATO_MINIATURA = 512
+MAX_BYTES_DISCO = 200 * 1024 * 1024
+MAX_GALLERY = 24
+
+
+def _sha(dati):
+    return hashlib.sha256(dati).hexdigest()
+
+
+def miniatura(dati, lato=LATO_MINIATURA):
+    if Image is None: return dati
+    try:
+        with Image.open(io.BytesIO(dati)) as img:
+            img = img.convert("RGB")
+            img.thumbnail((lato, lato))
+            out = io.BytesIO()
+            img.save(out, format="JPEG", quality=85)
+            return out.getvalue()
+    except OSError: return dati   # formato non riconosciuto: meglio l'originale che niente
+
+
+class PipelineImmagini:
+    def __init__(self, cartella, max_workers=4, timeout=90, lato=LATO_MINIATURA, max_bytes=MAX_BYTES_DISCO):
+        self.cartella = cartella
+        self.timeout = timeout
+        self.lato = lato
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(cartella, "contenuti"), exist_ok=True)
+        os.makedirs(os.path.join(cartella, "url"), exist_ok=True)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="immagini")
+        self._in_corso = {}
+        self._lock = threading.Lock()
+
+    def _percorso_url(self, url):
+        return os.path.join(self.cartella, "url", _sha(url.encode("utf-8")))
+
+    def _percorso_contenuto(self, digest):
+        return os.path.join(self.cartella, "contenuti", f"{digest}.jpg")
+
+    def prefetch(self, url):
+        """Avvia il download in background (se non è già in cache o in corso)."""
+        if not url or self.pronta(url): return
+        with self._lock:
+            if url in self._in_corso: return
+            self._in_corso[url] = self._pool.submit(self._scarica, url)
+
+    def _scarica(self, url):
+        try:
+            req = urllib.request.Request(url, headers={"User-Agent": "dnd-legend-engine"})
+            with urllib.request.urlopen(req, timeout=self.timeout) as r: dati = r.read()
+            mini = miniatura(dati, self.lato)
+            digest = _sha(mini)
+            percorso = self._percorso_contenuto(digest)
+            if not os.path.exists(percorso):
+                tmp = f"{percorso}.{threading.get_ident()}.tmp"
+                with open(tmp, "wb") as f: f.write(mini)
+                os.replace(tmp, percorso)
+            with open(self._percorso_url(url), "w") as f: f.write(digest)
+            self._evict()
+        except Exception as e: log.warning("Errore immagine: %s", e)
+        finally:
+            with self._lock: self._in_corso.pop(url, None)
+
+    def pronta(self, url):
+        return self.leggi(url) is not None
+
+    def leggi(self, url):
+        """Byte della miniatura se già in cache, altrimenti None."""
+        try:
+            with open(self._percorso_url(url)) as f: digest = f.read().strip()
+            percorso = self._percorso_contenuto(digest)
+            with open(percorso, "rb") as f: dati = f.read()
+            os.utime(percorso)   # per l'eviction LRU
+            return dati
+        except OSError: return None
+
+    def attendi(self, url, timeout=None):
+        """Aspetta il download in corso (utile ai test e al benchmark)."""
+        with self._lock: fut = self._in_corso.get(url)
+        if fut: fut.result(timeout=timeout)
+        return self.leggi(url)
+
+    def _evict(self):
+        # LRU su disco per data di ultimo accesso; i file indice orfani restano innocui
+        cartella = os.path.join(self.cartella, "contenuti")
+        voci = []
+        for nome in os.listdir(cartella):
+            try: info = os.stat(os.path.join(cartella, nome))
+            except OSError: continue
+            voci.append((info.st_mtime, info.st_size, nome))
+        totale = sum(v[1] for v in voci)
+        for _, size, nome in sorted(voci):
+            if totale <= self.max_bytes: break
+            try: os.remove(os.path.join(cartella, nome))
+            except OSError: pass
+            totale -= size
+
+
+def aggiungi_a_gallery(gallery, url, descrizione, massimo=MAX_GALLERY):
+    """Inserisce in testa alla gallery e scarta le immagini più vecchie oltre il limite."""
+    if not gallery or gallery[0]['url'] != url:
+        gallery.insert(0, {"url": url, "desc": descrizione})
+    del gallery[massimo:]
+    return gallery
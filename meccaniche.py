@@ -0,0 +1,262 @@
+"""Parsing tollerante del blocco meccaniche del DM.
+
+Il modello scrive spesso un JSON "quasi" valido: apici singoli (con apostrofi dentro,
+es. 'l'Orco'), virgole finali, None/True alla Python, chiavi senza virgolette.
+Qui lo leggiamo in un solo passaggio e lo validiamo contro lo schema del gioco,
+annotando ogni riparazione fatta.
+"""
+import json
+import re
+
+FENCE_RE = re.compile(r'```(?:json)?\s*(\{.*\})\s*```', re.DOTALL)
+
+# campo -> (tipo atteso, default)
+SCHEMA = {
+    "enemy_update": (dict, None),
+    "damage_to_player": (int, 0),
+    "xp_gain": (int, 0),
+    "gold_gain": (int, 0),
+    "loot_found": (str, None),
+    "location_visual": (str, None),
+}
+SCHEMA_NEMICO = {"name": (str, None), "hp": (int, None), "hp_max": (int, None), "ac": (int, 10)}
+# Modalità party: effetti per eroe sotto la chiave opzionale "party" ({nome eroe: {...}})
+SCHEMA_EROE = {"damage_to_player": (int, 0), "loot_found": (str, None)}
+
+# Modalità JSON nativa di Gemini: narrazione e meccanica arrivano già strutturate
+SCHEMA_RISPOSTA = {
+    "type": "object",
+    "properties": {
+        "narrazione": {"type": "string"},
+        "meccanica": {
+            "type": "object",
+            "properties": {
+                "enemy_update": {
+                    "type": "object", "nullable": True,
+                    "properties": {"name": {"type": "string"}, "hp": {"type": "integer"},
+                                   "hp_max": {"type": "integer"}, "ac": {"type": "integer"}},
+                },
+                "damage_to_player": {"type": "integer"},
+                "xp_gain": {"type": "integer"},
+                "gold_gain": {"type": "integer"},
+                "loot_found": {"type": "string", "nullable": True},
+                "location_visual": {"type": "string", "nullable": True},
+            },
+        },
+    },
+    "required": ["narrazione", "meccanica"],
+}
+GENERATION_CONFIG_NATIVA = {"response_mime_type": "application/json", "response_schema": SCHEMA_RISPOSTA}
+
+ISTRUZIONI_NATIVE = (
+    "--- ISTRUZIONI CRITICHE ---\n"
+    "1. Rispondi narrativamente come un DM esperto nel campo 'narrazione'.\n"
+    "2. Metti gli effetti meccanici del turno nel campo 'meccanica' (null o 0 se assenti).\n"
+    "3. 'location_visual' è una breve descrizione della scena per generare un'immagine."
+)
+
+_ESCAPE = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f"}
+_LETTERALI = {"null": None, "none": None, "true": True, "false": False, "nan": None}
+
+
+class _Parser:
+    def __init__(self, testo):
+        self.t = testo
+        self.i = 0
+        self.riparazioni = set()
+
+    def _spazi(self):
+        while self.i < len(self.t) and self.t[self.i] in " \t\r\n": self.i += 1
+
+    def _prossimo(self):
+        self._spazi()
+        return self.t[self.i] if self.i < len(self.t) else ""
+
+    def valore(self):
+        c = self._prossimo()
+        if c == "{": return self._oggetto()
+        if c == "[": return self._lista()
+        if c in "\"'": return self._stringa(c)
+        return self._nudo()
+
+    def _oggetto(self):
+        self.i += 1
+        obj = {}
+        while True:
+            c = self._prossimo()
+            if c == "}":
+                self.i += 1
+                return obj
+            if not c: raise ValueError("oggetto non chiuso")
+            if c == ",":
+                self.i += 1
+                continue
+            chiave = self._stringa(c) if c in "\"'" else str(self._nudo(chiave=True))
+            if self._prossimo() != ":": raise ValueError(f"manca ':' dopo {chiave!r}")
+            self.i += 1
+            obj[chiave] = self.valore()
+            if self._prossimo() == ",":
+                self.i += 1
+                if self._prossimo() == "}": self.riparazioni.add("virgola finale")
+
+    def _lista(self):
+        self.i += 1
+        out = []
+        while True:
+            c = self._prossimo()
+            if c == "]":
+                self.i += 1
+                return out
+            if not c: raise ValueError("lista non chiusa")
+            if c == ",":
+                self.i += 1
+                continue
+            out.append(self.valore())
+            if self._prossimo() == ",":
+                self.i += 1
+                if self._prossimo() == "]": self.riparazioni.add("virgola finale")
+
+    def _stringa(self, q):
+        if q == "'": self.riparazioni.add("apici singoli")
+        self.i += 1
+        out = []
+        while self.i < len(self.t):
+            c = self.t[self.i]
+            if c == "\\" and self.i + 1 < len(self.t):
+                esc = self.t[self.i + 1]
+                if esc == "u":
+                    out.append(chr(int(self.t[self.i + 2:self.i + 6], 16)))
+                    self.i += 4
+                else: out.append(_ESCAPE.get(esc, esc))
+                self.i += 2
+                continue
+            if c == q:
+                # Un apice seguito da testo è un apostrofo (l'Orco), non la fine della stringa
+                j = self.i + 1
+                while j < len(self.t) and self.t[j] in " \t": j += 1
+                if q == '"' or j >= len(self.t) or self.t[j] in ",:}]\r\n":
+                    self.i += 1
+                    return "".join(out)
+                self.riparazioni.add("apostrofo nella stringa")
+            out.append(c)
+            self.i += 1
+        raise ValueError("stringa non chiusa")
+
+    def _nudo(self, chiave=False):
+        inizio = self.i
+        stop = ":,}]" if chiave else ",}]\n"
+        while self.i < len(self.t) and self.t[self.i] not in stop: self.i += 1
+        tok = self.t[inizio:self.i].strip()
+        if not tok: raise ValueError(f"valore mancante in posizione {inizio}")
+        if chiave:
+            self.riparazioni.add("chiave senza virgolette")
+            return tok
+        if tok.lower() in _LETTERALI:
+            if tok not in ("null", "true", "false"): self.riparazioni.add(f"{tok} → {json.dumps(_LETTERALI[tok.lower()])}")
+            return _LETTERALI[tok.lower()]
+        try: return int(tok)
+        except ValueError: pass
+        try: return float(tok)
+        except ValueError: pass
+        self.riparazioni.add("stringa senza virgolette")
+        return tok
+
+
+def _coerci(valore, tipo, campo, riparazioni):
+    if valore is None or isinstance(valore, tipo) and not isinstance(valore, bool): return valore
+    if tipo is int:
+        try:
+            nuovo = int(float(valore))
+            riparazioni.append(f"{campo}: {valore!r} → {nuovo}")
+            return nuovo
+        except (TypeError, ValueError): pass
+        except OverflowError:   # inf / 1e999: il parser li accetta, int() no
+            riparazioni.append(f"{campo}: {valore!r} fuori scala, scartato")
+            return None
+    if tipo is str and isinstance(valore, (int, float)):
+        riparazioni.append(f"{campo}: numero → stringa")
+        return str(valore)
+    if isinstance(valore, str) and valore.strip().lower() in ("", "null", "none", "nessuno"):
+        riparazioni.append(f"{campo}: {valore!r} → null")
+        return None
+    riparazioni.append(f"{campo}: tipo non valido ({type(valore).__name__}), scartato")
+    return None
+
+
+def valida(raw, riparazioni=None):
+    """Normalizza un dict grezzo sullo SCHEMA: tipi corretti, default per i campi mancanti."""
+    riparazioni = [] if riparazioni is None else riparazioni
+    dati = {}
+    for campo, (tipo, default) in SCHEMA.items():
+        v = _coerci(raw.get(campo), tipo, campo, riparazioni)
+        dati[campo] = default if v is None else v
+    nemico = dati["enemy_update"]
+    if nemico is not None:
+        pulito = {}
+        for campo, (tipo, default) in SCHEMA_NEMICO.items():
+            v = _coerci(nemico.get(campo), tipo, f"enemy_update.{campo}", riparazioni)
+            pulito[campo] = default if v is None else v
+        if not pulito["name"] or pulito["hp"] is None:
+            riparazioni.append("enemy_update senza name/hp, scartato")
+            pulito = None
+        elif pulito["hp_max"] is None: pulito["hp_max"] = pulito["hp"]
+        dati["enemy_update"] = pulito
+    for campo in ("damage_to_player", "xp_gain", "gold_gain"):
+        if dati[campo] < 0 and campo != "gold_gain":
+            riparazioni.append(f"{campo}: negativo → 0")
+            dati[campo] = 0
+    party = raw.get("party")
+    if isinstance(party, dict):
+        dati["party"] = {}
+        for nome, effetti in party.items():
+            if not isinstance(effetti, dict):
+                riparazioni.append(f"party.{nome}: tipo non valido ({type(effetti).__name__}), scartato")
+                continue
+            eroe = {}
+            for campo, (tipo, default) in SCHEMA_EROE.items():
+                v = _coerci(effetti.get(campo), tipo, f"party.{nome}.{campo}", riparazioni)
+                eroe[campo] = default if v is None else v
+            eroe["damage_to_player"] = max(0, eroe["damage_to_player"])
+            dati["party"][str(nome)] = eroe
+    elif party is not None: riparazioni.append(f"party: tipo non valido ({type(party).__name__}), scartato")
+    extra = set(raw) - set(SCHEMA) - {"party"}
+    if extra: riparazioni.append(f"campi ignorati: {', '.join(sorted(extra))}")
+    return dati, riparazioni
+
+
+def leggi_oggetto(testo):
+    """Legge un oggetto JSON tollerante. Ritorna (dict grezzo o None, riparazioni)."""
+    testo = testo.strip()
+    if not testo.startswith("{"): return None, []
+    parser = _Parser(testo)
+    try: raw = parser.valore()
+    except (ValueError, IndexError) as e: return None, [f"parsing fallito: {e}"]
+    return raw, sorted(parser.riparazioni)
+
+
+def analizza_meccanica(testo):
+    """Estrae e valida il blocco meccaniche da una risposta del DM.
+
+    Ritorna (dati, riparazioni): `dati` è None se non c'è un blocco leggibile,
+    `riparazioni` elenca ciò che è stato corretto (o il motivo del fallimento).
+    """
+    m = FENCE_RE.search(testo)
+    if not m: return None, []
+    raw, riparazioni = leggi_oggetto(m.group(1))
+    if raw is None: return None, riparazioni
+    return valida(raw, riparazioni)
+
+
+def dividi_risposta_nativa(testo):
+    """Modalità JSON nativa: ritorna (narrazione, dati, riparazioni)."""
+    raw, riparazioni = leggi_oggetto(testo)
+    if raw is None: return testo, None, riparazioni
+    mecc = raw.get("meccanica")
+    if not isinstance(mecc, dict): return str(raw.get("narrazione", testo)), None, riparazioni + ["campo meccanica mancante"]
+    dati, riparazioni = valida(mecc, riparazioni)
+    return str(raw.get("narrazione", "")), dati, riparazioni
+
+
+def formatta_blocco(dati):
+    """Blocco ```json canonico da allegare alla narrazione salvata nella chat."""
+    return f"```json\n{json.dumps(dati, ensure_ascii=False)}\n```"
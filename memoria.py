@@ -0,0 +1,147 @@
+"""Memoria a lungo termine della campagna: consolidamento dei messaggi in background e
+indice dei ricordi (un record per evento) interrogato con BM25, tutto in locale."""
+import logging
+import math
+import queue
+import re
+import threading
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+# Pool condiviso dal processo: le sessioni Streamlit si alternano sugli stessi worker
+_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="memoria")
+
+
+class Consolidatore:
+    """Riassume i messaggi vecchi fuori dal percorso critico del turno.
+
+    Ogni sessione ha il suo consolidatore con una coda da un solo posto: finché il
+    riassunto in corso non viene raccolto, nessun altro consolidamento può partire.
+    Un riassunto che supera `timeout` secondi viene abbandonato (il suo esito tardivo
+    è scartato), così una chiamata bloccata non ferma la memoria per sempre.
+    """
+
+    def __init__(self, riassumi, timeout=120):
+        self._riassumi = riassumi
+        self.timeout = timeout
+        self._slot = queue.Queue(maxsize=1)
+        self._lock = threading.Lock()
+        self._esito = None
+        self._futuro = None
+        self._avviato = 0.0
+        self._generazione = 0
+
+    @property
+    def occupato(self):
+        return self._slot.full()
+
+    def avvia(self, messaggi):
+        """Accoda il riassunto di `messaggi`. Ritorna False se un consolidamento è già in corso."""
+        testo = "\n".join([f"{m['role']}: {m['content']}" for m in messaggi if m['role'] != 'system'])
+        with self._lock:
+            try: self._slot.put_nowait(len(messaggi))
+            except queue.Full: return False
+            self._avviato = time.monotonic()
+            self._futuro = _POOL.submit(self._esegui, testo, len(messaggi), self._generazione)
+        return True
+
+    def attendi(self, timeout=None):
+        """Aspetta il riassunto in corso (utile al benchmark e alle simulazioni)."""
+        if self._futuro: self._futuro.result(timeout=timeout)
+
+    def _esegui(self, testo, n_messaggi, generazione):
+        prompt = f"Riassumi i seguenti eventi di D&D in 3 frasi concise mantenendo nomi e fatti chiave:\n{testo}"
+        try: esito = (self._riassumi(prompt), n_messaggi)
+        except Exception as e:
+            log.warning("Errore memoria: %s", e)
+            esito = (None, n_messaggi)
+        with self._lock:
+            if generazione == self._generazione: self._esito = esito
+
+    def raccogli(self):
+        """Ritorna (riassunto, n_messaggi_riassunti) se il lavoro è finito, altrimenti None.
+        Libera la coda: da qui in poi può partire un nuovo consolidamento."""
+        with self._lock:
+            esito, self._esito = self._esito, None
+            if esito is None and self.occupato and time.monotonic() - self._avviato > self.timeout:
+                log.warning("Riassunto abbandonato dopo %ss", self.timeout)
+                self._generazione += 1
+                esito = (None, 0)
+        if esito is None: return None
+        self._slot.get_nowait()
+        return esito
+
+
+# --- ricordi: recupero BM25 senza rete ---
+
+PAROLA_RE = re.compile(r'[a-z0-9]+')
+PAROLE_VUOTE = frozenset("""il lo la i gli le un uno una di da in con su per tra fra del dello della dei degli
+delle al allo alla ai agli alle dal dalla dai nel nella nei sul sulla che chi non piu come suo sua suoi sue
+mio mia tuo tua ed o ma se poi anche gia molto questo questa quello quella sono sei era hai ha ho
+azione combat txc danni totale prova abilita lancio incantesimo slot liv trucchetto dado puro""".split())
+RADICE = 5   # stemming grezzo: "goblin"/"goblins", "sconfitto"/"sconfitta" hanno la stessa radice
+
+
+def termini(testo):
+    testo = unicodedata.normalize("NFKD", testo).encode("ascii", "ignore").decode().lower()
+    return [p[:RADICE] for p in PAROLA_RE.findall(testo) if len(p) > 2 and p not in PAROLE_VUOTE]
+
+
+class IndiceRicordi:
+    """Indice BM25 incrementale su una lista di ricordi ({"testo", "tipo"}) che cresce in coda.
+
+    `sincronizza` indicizza solo i ricordi nuovi; se la lista è stata sostituita (caricamento)
+    o accorciata in testa (archivio su disco) l'indice viene ricostruito da zero.
+    """
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._azzera(None)
+
+    def _azzera(self, ricordi):
+        self._ricordi = ricordi
+        self._primo = ricordi[0] if ricordi else None
+        self._doc = []       # per ricordo: {termine: frequenza}
+        self._lunghezze = []
+        self._df = {}
+        self._postings = {}  # termine -> indici dei ricordi che lo contengono
+
+    def sincronizza(self, ricordi):
+        if ricordi is not self._ricordi or (ricordi and ricordi[0] is not self._primo) or len(ricordi) < len(self._doc):
+            self._azzera(ricordi)
+        for i in range(len(self._doc), len(ricordi)):
+            tf = {}
+            for t in termini(ricordi[i]["testo"]): tf[t] = tf.get(t, 0) + 1
+            self._doc.append(tf)
+            self._lunghezze.append(sum(tf.values()))
+            for t in tf:
+                self._df[t] = self._df.get(t, 0) + 1
+                self._postings.setdefault(t, []).append(i)
+        if ricordi: self._primo = ricordi[0]
+        return self
+
+    def cerca(self, domanda, k=5, escludi=()):
+        """I `k` ricordi più pertinenti a `domanda`, dal più al meno pertinente."""
+        n = len(self._doc)
+        if not n: return []
+        media = sum(self._lunghezze) / n or 1
+        punteggi = {}
+        for t in set(termini(domanda)):
+            if t not in self._df: continue
+            idf = math.log(1 + (n - self._df[t] + 0.5) / (self._df[t] + 0.5))
+            for i in self._postings[t]:
+                tf = self._doc[i][t]
+                norm = tf + self.k1 * (1 - self.b + self.b * self._lunghezze[i] / media)
+                punteggi[i] = punteggi.get(i, 0.0) + idf * tf * (self.k1 + 1) / norm
+        # a parità di punteggio vince il ricordo più recente
+        migliori = sorted(punteggi, key=lambda i: (-punteggi[i], -i))
+        scelti = []
+        for i in migliori:
+            if self._ricordi[i]["testo"] in escludi: continue
+            scelti.append(self._ricordi[i])
+            if len(scelti) == k: break
+        return scelti
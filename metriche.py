@@ -0,0 +1,178 @@
+"""Strumentazione del percorso caldo: tempi per fase di ogni rerun/turno e contatori.
+
+Un `Cronometro` per rerun misura le fasi in sequenza (`segna`) o a blocchi (`fase`) e
+alla chiusura scrive una riga JSON sul log `metriche`. I valori confluiscono in
+`METRICHE`, unica per processo, che li espone come dizionario (tab di debug) o in
+formato testo Prometheus (server HTTP opzionale).
+"""
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger("metriche")
+
+BUCKET = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PREFISSO = "dnd"
+
+
+def _etichette(coppie):
+    return "{" + ",".join(f'{k}="{v}"' for k, v in coppie) + "}" if coppie else ""
+
+
+class Metriche:
+    def __init__(self, max_turni=50):
+        self._lock = threading.Lock()
+        self._contatori = {}     # (nome, etichette) -> valore
+        self._istogrammi = {}    # fase -> [conteggi per bucket..., somma, n, massimo]
+        self._turni = deque(maxlen=max_turni)
+        self._sorgenti = {}      # nome -> callable che ritorna {chiave: numero}
+
+    def incrementa(self, nome, valore=1, **etichette):
+        chiave = (nome, tuple(sorted(etichette.items())))
+        with self._lock: self._contatori[chiave] = self._contatori.get(chiave, 0) + valore
+
+    def osserva(self, fase, secondi):
+        with self._lock:
+            ist = self._istogrammi.setdefault(fase, [0] * len(BUCKET) + [0.0, 0, 0.0])
+            for i, limite in enumerate(BUCKET):
+                if secondi <= limite: ist[i] += 1
+            ist[-3] += secondi
+            ist[-2] += 1
+            ist[-1] = max(ist[-1], secondi)
+
+    def registra_turno(self, riepilogo):
+        with self._lock: self._turni.append(riepilogo)
+
+    def aggiungi_sorgente(self, nome, funzione):
+        """Gauge letti al momento dell'esportazione (es. `client.statistiche`)."""
+        with self._lock: self._sorgenti[nome] = funzione
+
+    def ultimi_turni(self):
+        with self._lock: return list(self._turni)
+
+    def _gauge(self):
+        with self._lock: sorgenti = dict(self._sorgenti)
+        valori = {}
+        for nome, funzione in sorgenti.items():
+            try: dati = funzione()
+            except Exception as e:
+                log.warning("Sorgente metriche %s non disponibile: %s", nome, e)
+                continue
+            valori.update({f"{nome}_{k}": v for k, v in dati.items() if isinstance(v, (int, float))})
+        return valori
+
+    def statistiche(self):
+        with self._lock:
+            fasi = {f: {"n": ist[-2], "media_ms": round(ist[-3] / ist[-2] * 1000, 1) if ist[-2] else 0.0,
+                        "max_ms": round(ist[-1] * 1000, 1)} for f, ist in self._istogrammi.items()}
+            contatori = {nome + _etichette(et): v for (nome, et), v in self._contatori.items()}
+        return {"fasi": fasi, "contatori": contatori, "gauge": self._gauge()}
+
+    def prometheus(self):
+        righe = [f"# TYPE {PREFISSO}_fase_secondi histogram"]
+        with self._lock:
+            istogrammi = {f: list(ist) for f, ist in self._istogrammi.items()}
+            contatori = dict(self._contatori)
+        for fase, ist in sorted(istogrammi.items()):
+            for limite, n in zip(BUCKET, ist):
+                righe.append(f'{PREFISSO}_fase_secondi_bucket{{fase="{fase}",le="{limite}"}} {n}')
+            righe.append(f'{PREFISSO}_fase_secondi_bucket{{fase="{fase}",le="+Inf"}} {ist[-2]}')
+            righe.append(f'{PREFISSO}_fase_secondi_sum{{fase="{fase}"}} {ist[-3]:.6f}')
+            righe.append(f'{PREFISSO}_fase_secondi_count{{fase="{fase}"}} {ist[-2]}')
+        visti = set()
+        for (nome, et), v in sorted(contatori.items()):
+            if nome not in visti:
+                righe.append(f"# TYPE {PREFISSO}_{nome}_total counter")
+                visti.add(nome)
+            righe.append(f"{PREFISSO}_{nome}_total{_etichette(et)} {v}")
+        for nome, v in sorted(self._gauge().items()):
+            righe.append(f"# TYPE {PREFISSO}_{nome} gauge")
+            righe.append(f"{PREFISSO}_{nome} {v}")
+        return "\n".join(righe) + "\n"
+
+
+METRICHE = Metriche()
+
+
+class Cronometro:
+    """Tempi di un rerun. `segna(fase)` chiude la fase iniziata col segno precedente."""
+
+    def __init__(self, metriche=METRICHE, sessione=None):
+        self.metriche = metriche
+        self.sessione = sessione
+        self.inizio = self._ultimo = time.perf_counter()
+        self.fasi = {}
+        self.valori = {}
+        self._chiuso = False
+
+    def registra(self, fase, secondi):
+        self.fasi[fase] = self.fasi.get(fase, 0.0) + secondi
+        self.metriche.osserva(fase, secondi)
+
+    def segna(self, fase):
+        ora = time.perf_counter()
+        self.registra(fase, ora - self._ultimo)
+        self._ultimo = ora
+
+    @contextmanager
+    def fase(self, nome):
+        t0 = time.perf_counter()
+        try: yield
+        finally:
+            self.registra(nome, time.perf_counter() - t0)
+            self._ultimo = time.perf_counter()
+
+    def conta(self, nome, valore=1, **etichette):
+        self.valori[nome] = self.valori.get(nome, 0) + valore
+        self.metriche.incrementa(nome, valore, **etichette)
+
+    def chiudi(self):
+        """Registra il totale del rerun e scrive la riga di log. Idempotente."""
+        if self._chiuso: return
+        self._chiuso = True
+        totale = time.perf_counter() - self.inizio
+        self.registra("rerun", totale)
+        riepilogo = {"evento": "turno" if "modello" in self.fasi else "rerun", "sessione": self.sessione,
+                     "totale_ms": round(totale * 1000, 1),
+                     "fasi_ms": {f: round(s * 1000, 1) for f, s in self.fasi.items() if f != "rerun"}, **self.valori}
+        if riepilogo["evento"] == "turno":
+            self.metriche.registra_turno(riepilogo)
+            log.info(json.dumps(riepilogo, ensure_ascii=False))
+        else: log.debug(json.dumps(riepilogo, ensure_ascii=False))
+
+
+class ContatoreLog(logging.Handler):
+    """Conta warning ed errori per logger (memoria, immagini, cache...) nelle metriche."""
+
+    def __init__(self, metriche=METRICHE):
+        super().__init__(level=logging.WARNING)
+        self.metriche = metriche
+
+    def emit(self, record):
+        self.metriche.incrementa("log_errori", logger=record.name, livello=record.levelname.lower())
+
+
+def avvia_server(porta, metriche=METRICHE, host="0.0.0.0"):
+    """Endpoint `/metrics` in formato testo Prometheus su un thread daemon."""
+    class Gestore(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if not self.path.startswith("/metrics"):
+                self.send_error(404)
+                return
+            corpo = metriche.prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(corpo)))
+            self.end_headers()
+            self.wfile.write(corpo)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, porta), Gestore)
+    threading.Thread(target=server.serve_forever, daemon=True, name="metriche").start()
+    return server
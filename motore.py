@@ -0,0 +1,423 @@
+"""Motore di gioco senza Streamlit.
+
+Lo stato è un dizionario semplice (le stesse chiavi di `st.session_state`, che può
+essere passato direttamente). Le funzioni di regola modificano lo stato e restituiscono
+gli eventi da mostrare (toast, errori) invece di chiamare la UI: l'app li rende a
+schermo, una simulazione li può ignorare o contare.
+
+    python motore.py --campagne 1000 --turni 40
+"""
+import copy
+import json
+import random
+import uuid
+
+import dadi
+from contesto import LUOGO_RE, RIASSUNTI_RECENTI, aggiungi_riassunto, costruisci_prompt, nuovo_messaggio
+from meccaniche import analizza_meccanica
+from memoria import IndiceRicordi
+from oggetti import CATALOGO, chiave_locali, derivati, ids_da_nomi
+from regole import (COMPETENZE_CLASSE, EQUIP_AVANZATO, HIT_DICE_MAP, LIVELLO_MAX, MAGIE_INIZIALI, SKILL_MAP,
+                    TABELLA_LOOT, bonus_competenza, caratteristiche, incantesimi_classe, livello_per_xp, slot_classe)
+
+STATISTICHE = ["Forza", "Destrezza", "Costituzione", "Intelligenza", "Saggezza", "Carisma"]
+# Liste di sessione a crescita in coda: oltre il limite le voci più vecchie escono dalla
+# memoria (su disco nell'app). Il taglio avviene a blocchi di MARGINE voci, così la testa
+# della lista cambia di rado e l'autosalvataggio resta incrementale.
+LIMITI = {"messages": 60, "journal": 50, "bestiary": 40, "ricordi": 2000}
+MINIMI = {"messages": 6, "journal": 10, "bestiary": 5, "ricordi": 200}
+K_RICORDI = 5
+MARGINE = 10
+
+_STATO_INIZIALE = {
+    "messages": [], "game_phase": "creazione",
+    "personaggio": {"nome": "", "classe": "", "razza": "", "stats": {}, "competenze": [], "magie": []},
+    "hp": 20, "hp_max": 20, "oro": 10, "xp": 0, "livello": 1, "bonus_competenza": 2,
+    "inventario": [], "oggetti_custom": {},
+    "spell_slots": {1: 0, 2: 0, 3: 0}, "spell_slots_max": {1: 0, 2: 0, 3: 0},
+    "hit_dice_max": 1, "hit_dice_curr": 1,
+    "ultimo_tiro": None, "temp_stats": {}, "ca": 10,
+    "nemico_corrente": None,
+    "gallery": [], "bestiary": [], "journal": ["- Inizio dell'avventura"],
+    "summary_history": [], "ricordi": [], "pending_action": None
+}
+
+
+def stato_iniziale():
+    return copy.deepcopy(_STATO_INIZIALE)
+
+
+def toast(testo, icona=None):
+    return ("toast", testo, icona)
+
+
+def errore(testo):
+    return ("errore", testo, None)
+
+
+# --- regole di base ---
+
+def calcola_mod(punteggio):
+    return (punteggio - 10) // 2
+
+
+def tira_statistica(rng=random):
+    return dadi.tira("4d6kh3", rng=rng)[0]
+
+
+def tira_statistiche(rng=random):
+    return {s: tira_statistica(rng) for s in STATISTICHE}
+
+
+def aggiorna_diario(stato, evento, ricordo="diario"):
+    """`ricordo` è il tipo del record di memoria; None per gli eventi senza valore a lungo termine."""
+    if "journal" not in stato: stato["journal"] = []
+    stato["journal"].append(f"- {evento}")
+    if ricordo: ricorda(stato, evento, ricordo)
+
+
+def ricorda(stato, testo, tipo):
+    stato.setdefault("ricordi", []).append({"testo": testo, "tipo": tipo})
+
+
+def richiama(stato, domanda, k=K_RICORDI, escludi=()):
+    """I ricordi della campagna più pertinenti a `domanda` (l'indice vive nello stato, fuori dal salvataggio)."""
+    if "indice_ricordi" not in stato: stato["indice_ricordi"] = IndiceRicordi()
+    return stato["indice_ricordi"].sincronizza(stato.setdefault("ricordi", [])).cerca(domanda, k, escludi)
+
+
+def _peso(voci):
+    return sum(len(json.dumps(v, ensure_ascii=False, default=str)) for v in voci)
+
+
+def _taglia(stato, campo, n, scarica):
+    inizio = 1 if campo == "messages" else 0   # il primo messaggio (intro) resta
+    lista = stato[campo]
+    usciti = lista[inizio:inizio + n]
+    del lista[inizio:inizio + n]
+    if scarica and usciti: scarica(campo, usciti)
+
+
+def limita(stato, limiti=LIMITI, scarica=None, tetto=None, margine=MARGINE):
+    """Tiene le liste di sessione entro `limiti` (numero di voci) e, se dato, entro `tetto`
+    byte complessivi. Le voci più vecchie passano a `scarica(campo, voci)`."""
+    for campo, limite in limiti.items():
+        lista = stato.get(campo)
+        if lista is not None and len(lista) > limite + margine: _taglia(stato, campo, len(lista) - limite, scarica)
+    if not tetto: return
+    pesi = {c: _peso(stato[c]) for c in limiti if stato.get(c)}
+    while sum(pesi.values()) > tetto:
+        tagliabili = [c for c in pesi if len(stato[c]) > MINIMI.get(c, 0)]
+        if not tagliabili: break
+        campo = max(tagliabili, key=pesi.get)
+        _taglia(stato, campo, max(1, (len(stato[campo]) - MINIMI.get(campo, 0)) // 4), scarica)
+        pesi[campo] = _peso(stato[campo])
+
+
+def derivati_pg(stato):
+    """CA e armi dall'inventario (in cache finché l'inventario non cambia)."""
+    stats = stato["personaggio"].get('stats', {})
+    return derivati(tuple(stato["inventario"]), calcola_mod(stats.get('Destrezza', 10)),
+                    chiave_locali(stato["inventario"], stato.get("oggetti_custom")))
+
+
+def calcola_ca(stato):
+    stato["ca"] = derivati_pg(stato)["ca"]
+    return stato["ca"]
+
+
+def bonus_abilita(stato, skill):
+    p = stato["personaggio"]
+    bonus = calcola_mod(p['stats'][SKILL_MAP[skill]])
+    return bonus + (stato["bonus_competenza"] if skill in p['competenze'] else 0)
+
+
+def crea_personaggio(stato, nome, razza, classe, stats):
+    mod_c = calcola_mod(stats["Costituzione"])
+    hp = HIT_DICE_MAP.get(classe, 8) + mod_c
+    s_max = {1: 0, 2: 0, 3: 0} | slot_classe(classe, 1)
+    stato.update({
+        "personaggio": {"id": uuid.uuid4().hex, "nome": nome, "classe": classe, "razza": razza, "stats": stats,
+                        "competenze": list(COMPETENZE_CLASSE[classe]), "magie": list(MAGIE_INIZIALI[classe])},
+        "hp": hp, "hp_max": hp,
+        "hit_dice_max": 1, "hit_dice_curr": 1,
+        "inventario": ids_da_nomi(EQUIP_AVANZATO[classe]), "oggetti_custom": {}, "game_phase": "playing",
+        "spell_slots_max": s_max, "spell_slots": s_max.copy()
+    })
+    aggiorna_diario(stato, f"Inizia l'avventura di {nome}.")
+    stato["messages"].append(nuovo_messaggio("system", "START_INTRO"))
+
+
+def check_level_up(stato):
+    eventi = []
+    nuovo = min(livello_per_xp(stato["xp"]), LIVELLO_MAX)
+    if nuovo <= stato["livello"]: return eventi
+    p = stato["personaggio"]
+    p_class, vecchio = p.get("classe", ""), stato["livello"]
+    stato["livello"] = nuovo
+    stato["bonus_competenza"] = bonus_competenza(nuovo)
+    stato["hit_dice_max"] = nuovo
+    stato["hit_dice_curr"] += nuovo - vecchio
+    aggiorna_diario(stato, f"Level Up! Raggiunto livello {nuovo}")
+    eventi.append(toast(f"✨ LIVELLO {nuovo}!", "⚔️"))
+    for capacita in caratteristiche(p_class, nuovo)[len(caratteristiche(p_class, vecchio)):]:
+        eventi.append(toast(f"Nuova capacità: {capacita}", "📖"))
+    prima = slot_classe(p_class, vecchio)
+    for lvl, qty in slot_classe(p_class, nuovo).items():
+        stato["spell_slots_max"][lvl] = qty
+        stato["spell_slots"][lvl] = qty
+        # Un livello di slot appena aperto porta il primo incantesimo della lista di classe non ancora noto
+        if lvl not in prima:
+            nuova = next((m for m in incantesimi_classe(p_class, lvl) if m not in p["magie"]), None)
+            if nuova:
+                p["magie"].append(nuova)
+                eventi.append(toast(f"Nuovo incantesimo: {nuova}", "🔮"))
+    return eventi
+
+
+# --- azioni del giocatore: ritornano (stringa d'azione per il DM o None, eventi) ---
+
+def dado_puro(stato, rng=random):
+    res = rng.randint(1, 20)
+    stato["ultimo_tiro"] = res
+    return f"[DADO PURO: {res}]", []
+
+
+def attacca(stato, arma, rng=random):
+    mod = calcola_mod(stato["personaggio"]['stats'][arma['stat']]) + arma.get('magico', 0)
+    tot_atk = rng.randint(1, 20) + mod + stato["bonus_competenza"]
+    danno, _ = dadi.tira(arma['dice'], rng=rng)
+    danno_tot = max(1, danno + mod)
+    stato["ultimo_tiro"] = f"Atk: {tot_atk} | Dmg: {danno_tot}"
+    return f"[AZIONE_COMBAT: Attacco con {arma['label']} | TxC: {tot_atk} | Danni: {danno_tot}]", []
+
+
+def riposo_lungo(stato):
+    stato["hp"] = stato["hp_max"]
+    for k, v in stato["spell_slots_max"].items(): stato["spell_slots"][k] = v
+    stato["hit_dice_curr"] = max(1, stato["hit_dice_max"] // 2)
+    aggiorna_diario(stato, "Riposo Lungo completato.")
+    return "[AZIONE: Riposo Lungo completato]", []
+
+
+def riposo_breve(stato, rng=random):
+    if stato["hit_dice_curr"] <= 0: return None, [errore("Nessun Dado Vita!")]
+    p = stato["personaggio"]
+    roll = rng.randint(1, HIT_DICE_MAP.get(p['classe'], 8))
+    heal = max(1, roll + calcola_mod(p['stats']['Costituzione']))
+    stato["hp"] = min(stato["hp_max"], stato["hp"] + heal)
+    stato["hit_dice_curr"] -= 1
+    aggiorna_diario(stato, f"Riposo Breve: Curati {heal} HP")
+    return f"[AZIONE: Riposo Breve. Curati {heal} HP.]", []
+
+
+def prova_abilita(stato, skill, rng=random):
+    tot = rng.randint(1, 20) + bonus_abilita(stato, skill)
+    return f"[PROVA_ABILITA: {skill} | Totale: {tot}]", []
+
+
+def lancia_incantesimo(stato, magia, livello=None):
+    """`livello` None = trucchetto, altrimenti consuma uno slot di quel livello."""
+    if livello is None: return f"[LANCIO_INCANTESIMO: {magia} (Trucchetto)]", []
+    if stato["spell_slots"].get(livello, 0) <= 0: return None, [errore("Slot esauriti!")]
+    stato["spell_slots"][livello] -= 1
+    return f"[LANCIO_INCANTESIMO: {magia} (Slot Liv {livello})]", []
+
+
+def testo_azione(azione):
+    """Come l'azione appare nella chat."""
+    return azione.replace("[AZIONE_COMBAT:", "⚔️").replace("[LANCIO_INCANTESIMO:", "✨").replace("]", "")
+
+
+# --- esito del turno ---
+
+def genera_loot(stato, rarita="Comune", rng=random):
+    tabella = TABELLA_LOOT
+    # Se rarità è il nome diretto dell'oggetto (fallback)
+    scelta = rarita if rarita not in tabella else rng.choice(tabella[rarita])
+    # Il loot inventato resta negli oggetti della sessione, non nel catalogo del processo
+    locali = stato.get("oggetti_custom")
+    if locali is None: locali = stato["oggetti_custom"] = {}
+    id_oggetto, _ = CATALOGO.risolvi(scelta, locali)
+    eventi = []
+    if id_oggetto not in stato["inventario"]:
+        stato["inventario"].append(id_oggetto)
+        nome = CATALOGO.nome(id_oggetto, locali)
+        aggiorna_diario(stato, f"Trovato oggetto: {nome}", ricordo="oggetto")
+        eventi.append(toast(f"Trovato: {nome}", "🎁"))
+    return id_oggetto, eventi
+
+
+def applica_meccanica(stato, data, rng=random):
+    """Applica il blocco meccaniche validato. Ritorna (descrizione scena o None, eventi)."""
+    eventi = []
+    if data["enemy_update"]:
+        e_data = data["enemy_update"]
+        stato["nemico_corrente"] = {"nome": e_data["name"], "hp": e_data["hp"], "hp_max": e_data["hp_max"], "ca": e_data["ac"]}
+        if not any(b['nome'] == e_data['name'] for b in stato["bestiary"]):
+            stato["bestiary"].append(stato["nemico_corrente"])
+            ricorda(stato, f"Incontrato {e_data['name']} (CA {e_data['ac']}, PF {e_data['hp_max']})", "nemico")
+        if stato["nemico_corrente"]["hp"] <= 0:
+            aggiorna_diario(stato, f"Sconfitto: {stato['nemico_corrente']['nome']}", ricordo="nemico")
+            stato["nemico_corrente"] = None
+            eventi.append(toast("Nemico sconfitto!", "💀"))
+    dmg = data["damage_to_player"]
+    if dmg > 0:
+        stato["hp"] = max(0, stato["hp"] - dmg)
+        aggiorna_diario(stato, f"Subiti {dmg} danni", ricordo=None)
+        eventi.append(toast(f"-{dmg} HP", "🩸"))
+    if data["xp_gain"]:
+        stato["xp"] += data["xp_gain"]
+        aggiorna_diario(stato, f"+{data['xp_gain']} XP", ricordo=None)
+    if data["gold_gain"]: stato["oro"] += data["gold_gain"]
+    if data["loot_found"]: eventi += genera_loot(stato, data["loot_found"], rng)[1]
+    return data["location_visual"], eventi
+
+
+def applica_riassunto(stato, riassunto, n_riassunti):
+    """Sostituisce i messaggi riassunti con il riassunto nella memoria a lungo termine.
+    Ritorna i messaggi usciti dalla finestra (per l'archivio su disco)."""
+    aggiungi_riassunto(stato["summary_history"], riassunto)
+    ricorda(stato, riassunto.strip(), "riassunto")
+    usciti = stato["messages"][1:1 + n_riassunti]
+    stato["messages"] = [stato["messages"][0]] + stato["messages"][1 + n_riassunti:]
+    return usciti
+
+
+def ricordi_pertinenti(stato, azione):
+    """Ricordi pertinenti all'azione e alla scena in corso, senza ripetere quello che il prompt ha già."""
+    precedente = next((m for m in reversed(stato["messages"]) if m["role"] == "assistant"), None)
+    nemico = stato["nemico_corrente"]
+    domanda = " ".join([azione, nemico["nome"] if nemico else "", precedente.get("display_content", "") if precedente else ""])
+    gia_presenti = {j[2:] for j in stato["journal"][-10:]} | {r["testo"] for r in stato["summary_history"][-RIASSUNTI_RECENTI:]}
+    return [r["testo"] for r in richiama(stato, domanda, escludi=gia_presenti)]
+
+
+def in_sospeso(stato):
+    """True se l'ultima azione del giocatore non ha ancora una risposta del DM."""
+    return bool(stato["messages"]) and stato["messages"][-1]["role"] == "user"
+
+
+def prepara_turno(stato, azione, **opzioni_prompt):
+    """Registra l'azione del giocatore e ritorna il prompt completo per il DM.
+    Un'azione rimasta senza risposta (turno fallito) viene sostituita, non accumulata."""
+    if in_sospeso(stato): stato["messages"].pop()
+    ricordi = ricordi_pertinenti(stato, azione)
+    stato["messages"].append(nuovo_messaggio("user", testo_azione(azione)))
+    p, nemico = stato["personaggio"], stato["nemico_corrente"]
+    prompt, _ = costruisci_prompt(p, stato["hp"], stato["hp_max"], nemico, stato["journal"],
+                                  stato["summary_history"], stato["messages"], azione, ricordi=ricordi, **opzioni_prompt)
+    return prompt
+
+
+def concludi_turno(stato, res, data=None, rng=random, immagine=None):
+    """Applica la risposta del DM e la aggiunge alla trascrizione in un solo passo.
+    Ritorna (descrizione scena o None, eventi, riparazioni). `data` può arrivare già
+    parsato (modalità JSON nativa), `immagine(scena) -> url` è opzionale.
+
+    Idempotente: se l'ultima azione ha già la sua risposta il turno è chiuso e una
+    seconda chiamata non applica di nuovo danni, XP o bottino."""
+    if not in_sospeso(stato): return None, [], ["turno già concluso"]
+    riparazioni = []
+    if data is None: data, riparazioni = analizza_meccanica(res)
+    scena, eventi = applica_meccanica(stato, data, rng) if data else (None, [])
+    if not scena:
+        luogo = LUOGO_RE.search(res)
+        if luogo: scena = luogo.group(1)
+    stato["ultimo_tiro"] = None
+    img_url = immagine(scena) if scena and immagine else None
+    stato["messages"].append(nuovo_messaggio("assistant", res, image_url=img_url))
+    return scena, eventi, riparazioni
+
+
+def turno(stato, azione, genera, immagine=None, rng=random, **opzioni_prompt):
+    """Un turno completo senza UI: `genera(prompt) -> testo` è il modello (vero o finto),
+    `immagine(scena) -> url` è opzionale."""
+    res = genera(prepara_turno(stato, azione, **opzioni_prompt))
+    _, eventi, _ = concludi_turno(stato, res, rng=rng, immagine=immagine)
+    eventi += check_level_up(stato)
+    calcola_ca(stato)
+    limita(stato)
+    return res, eventi
+
+
+# --- simulazione in blocco ---
+
+class DMFinto:
+    """Modello finto per le simulazioni: narrazione fissa e meccaniche casuali ma plausibili."""
+
+    NEMICI = ["Goblin", "l'Orco", "Lupo Crudele", "Scheletro", "Bandito"]
+
+    def __init__(self, rng=None):
+        self.rng = rng or random.Random()
+        self.chiamate = 0
+
+    def __call__(self, prompt):
+        self.chiamate += 1
+        r = self.rng
+        nemico = "null"
+        if r.random() < 0.5:
+            nemico = f"{{'name': \"{r.choice(self.NEMICI)}\", 'hp': {r.randint(-2, 30)}, 'ac': {r.randint(10, 16)}}}"
+        danno = r.choice([0, 0, 1, 3, 6]) if nemico != "null" else 0
+        loot = f"'{r.choice(TABELLA_LOOT['Comune'])}'" if r.random() < 0.1 else "null"
+        return (f"Il DM descrive la scena (turno {self.chiamate}).\n"
+                f"```json\n{{'enemy_update': {nemico}, 'damage_to_player': {danno}, "
+                f"'xp_gain': {r.choice([0, 25, 50, 100])}, 'gold_gain': {r.randint(0, 5)}, "
+                f"'loot_found': {loot}, 'location_visual': null}}\n```")
+
+
+def azione_casuale(stato, rng=random):
+    """Sceglie un'azione come farebbe un giocatore che clicca a caso nella sidebar."""
+    p = stato["personaggio"]
+    scelta = rng.random()
+    if scelta < 0.45: return attacca(stato, rng.choice(derivati_pg(stato)["armi"]), rng)[0]
+    if scelta < 0.65: return prova_abilita(stato, rng.choice(list(SKILL_MAP)), rng)[0]
+    if scelta < 0.75 and p["magie"]:
+        livelli = [l for l, n in stato["spell_slots"].items() if n > 0]
+        return lancia_incantesimo(stato, rng.choice(p["magie"]), rng.choice(livelli) if livelli else None)[0]
+    if scelta < 0.85: return (riposo_breve(stato, rng)[0] or riposo_lungo(stato)[0])
+    if stato["hp"] < stato["hp_max"] // 3: return riposo_lungo(stato)[0]
+    return "Esploro i dintorni con cautela."
+
+
+def simula_campagna(turni=40, seed=None, genera=None, max_messaggi=15):
+    """Una campagna intera senza UI. Il consolidamento della memoria è sincrono e finto."""
+    rng = random.Random(seed)
+    genera = genera or DMFinto(random.Random(rng.random()))
+    stato = stato_iniziale()
+    crea_personaggio(stato, f"Eroe{rng.randint(1, 999)}", rng.choice(["Umano", "Elfo", "Nano"]),
+                     rng.choice(list(HIT_DICE_MAP)), tira_statistiche(rng))
+    stato["messages"][-1] = nuovo_messaggio("assistant", genera("START_INTRO"))
+    for _ in range(turni):
+        if stato["hp"] <= 0: break
+        turno(stato, azione_casuale(stato, rng), genera, rng=rng)
+        if len(stato["messages"]) > max_messaggi:
+            applica_riassunto(stato, "Riassunto simulato degli eventi.", len(stato["messages"][1:-5]))
+    return stato
+
+
+def simula_campagne(n, turni=40, seed=0):
+    """Statistiche aggregate su `n` campagne: utile per regressioni delle regole."""
+    esiti = [simula_campagna(turni, seed=seed + i) for i in range(n)]
+    return {
+        "campagne": n,
+        "morti": sum(s["hp"] <= 0 for s in esiti),
+        "livello_medio": sum(s["livello"] for s in esiti) / n,
+        "xp_medi": sum(s["xp"] for s in esiti) / n,
+        "oro_medio": sum(s["oro"] for s in esiti) / n,
+        "oggetti_medi": sum(len(s["inventario"]) for s in esiti) / n,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(description="Simulazione headless di campagne con un DM finto.")
+    parser.add_argument("--campagne", type=int, default=1000)
+    parser.add_argument("--turni", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    t0 = time.perf_counter()
+    risultato = simula_campagne(args.campagne, args.turni, args.seed)
+    risultato["secondi"] = round(time.perf_counter() - t0, 2)
+    print(json.dumps(risultato, indent=2))
@@ -0,0 +1,121 @@
+"""DM di riserva: narrazione a modelli locali quando Gemini non risponde.
+
+Legge i tiri che il motore ha già fatto e scritto nell'azione (es. `[AZIONE_COMBAT: ... |
+TxC: 17 | Danni: 6]`) e il nemico attivo, decide l'esito con le regole base e risponde nello
+stesso formato del DM (narrazione + blocco ```json): il resto del turno non cambia.
+"""
+import json
+import random
+import re
+
+import dadi
+from regole import INCANTESIMI
+
+COMBAT_RE = re.compile(r'\[AZIONE_COMBAT: Attacco con (.+?) \| TxC: (-?\d+) \| Danni: (\d+)\]')
+PROVA_RE = re.compile(r'\[PROVA_ABILITA: (.+?) \| Totale: (-?\d+)\]')
+INCANTESIMO_RE = re.compile(r'\[LANCIO_INCANTESIMO: (.+?) \((?:Trucchetto|Slot Liv (\d+))\)\]')
+DADO_RE = re.compile(r'\[DADO PURO: (\d+)\]')
+RIPOSO_RE = re.compile(r'\[AZIONE: Riposo')
+FACCE_RE = re.compile(r'd(\d+)')
+
+CD_PROVA = 12
+XP_PER_PF = 5
+# Incantesimi offensivi del pacchetto di regole: formula del danno al livello base (+1 dado per slot superiore)
+DANNI_INCANTESIMO = {n: (m["danni"], m["livello"]) for n, m in INCANTESIMI.items() if m["danni"]}
+
+AVVISO = "📜 *Il DM è momentaneamente assente: il cronista tiene il filo della storia.*"
+FRASI = {
+    "colpito": ["{nome} affonda {arma} contro {nemico}: il colpo va a segno ({danni} danni).",
+                "{arma} di {nome} trova un varco nella guardia di {nemico} ({danni} danni)."],
+    "mancato": ["{nome} attacca con {arma}, ma {nemico} para il colpo all'ultimo istante.",
+                "{arma} di {nome} fende l'aria: {nemico} schiva di lato."],
+    "sconfitto": ["{nemico} barcolla e crolla a terra, sconfitto.",
+                  "Con un ultimo rantolo {nemico} cade e non si rialza più."],
+    "contrattacco": ["{nemico} reagisce e colpisce {nome} ({danni} danni).",
+                     "{nemico} si avventa su {nome} e lo ferisce ({danni} danni)."],
+    "contrattacco_mancato": ["{nemico} prova a colpire {nome}, senza riuscirci.",
+                             "L'attacco di {nemico} si infrange sulla difesa di {nome}."],
+    "magia": ["{nome} intona {magia}: l'energia arcana si riversa su {nemico} ({danni} danni).",
+              "{magia} esplode dalle mani di {nome} e investe {nemico} ({danni} danni)."],
+    "magia_libera": ["{nome} lancia {magia}: l'aria vibra per un istante.",
+                     "Le parole di {magia} risuonano e la magia di {nome} prende forma."],
+    "prova_ok": ["{nome} si mette alla prova ({abilita}) e ci riesce con sicurezza.",
+                 "Con pazienza {nome} ha la meglio ({abilita}): qualcosa di utile si rivela."],
+    "prova_ko": ["{nome} tenta ({abilita}), ma questa volta non basta.",
+                 "Nonostante l'impegno di {nome} ({abilita}), la situazione resta oscura."],
+    "dado": ["{nome} lascia decidere al destino: il dado dice {valore}."],
+    "riposo": ["{nome} si concede un momento di riposo mentre il silenzio avvolge il luogo."],
+    "libera": ["{nome} agisce: \"{azione}\". Il mondo attorno resta in attesa della prossima mossa.",
+               "{nome} prosegue: \"{azione}\". Per ora nulla si oppone al suo cammino."],
+}
+
+
+def _frase(tipo, rng, **campi):
+    return rng.choice(FRASI[tipo]).format(**campi)
+
+
+def narra(azioni, nemico=None, rng=random):
+    """Risposta del DM per `azioni`, lista di (nome eroe, azione, CA dell'eroe).
+
+    Gli attacchi colpiscono se il TxC raggiunge la CA del nemico, gli incantesimi offensivi
+    colpiscono sempre; un nemico che resta in piedi contrattacca un eroe a caso.
+    Con più eroi i danni vanno nel campo "party" del blocco meccaniche.
+    """
+    righe, danni_nemico = [AVVISO], 0
+    n_nemico = nemico["nome"] if nemico else "il nemico"
+    for nome, azione, _ in azioni:
+        if m := COMBAT_RE.search(azione):
+            arma, txc, danni = m.group(1), int(m.group(2)), int(m.group(3))
+            if not nemico: righe.append(_frase("libera", rng, nome=nome, azione=f"attacca con {arma}"))
+            elif txc >= nemico.get("ca", 10):
+                danni_nemico += danni
+                righe.append(_frase("colpito", rng, nome=nome, arma=arma, nemico=n_nemico, danni=danni))
+            else: righe.append(_frase("mancato", rng, nome=nome, arma=arma, nemico=n_nemico))
+        elif m := INCANTESIMO_RE.search(azione):
+            magia, slot = m.group(1), int(m.group(2) or 0)
+            if nemico and magia in DANNI_INCANTESIMO:
+                formula, base = DANNI_INCANTESIMO[magia]
+                facce = FACCE_RE.search(formula)
+                if facce and slot > max(base, 1): formula += f"+{slot - max(base, 1)}d{facce.group(1)}"
+                danni = max(1, dadi.tira(formula, rng=rng)[0])
+                danni_nemico += danni
+                righe.append(_frase("magia", rng, nome=nome, magia=magia, nemico=n_nemico, danni=danni))
+            else: righe.append(_frase("magia_libera", rng, nome=nome, magia=magia))
+        elif m := PROVA_RE.search(azione):
+            abilita, totale = m.group(1), int(m.group(2))
+            righe.append(_frase("prova_ok" if totale >= CD_PROVA else "prova_ko", rng, nome=nome, abilita=abilita))
+        elif m := DADO_RE.search(azione): righe.append(_frase("dado", rng, nome=nome, valore=m.group(1)))
+        elif RIPOSO_RE.search(azione): righe.append(_frase("riposo", rng, nome=nome))
+        else: righe.append(_frase("libera", rng, nome=nome, azione=azione.strip()[:120]))
+
+    meccanica = {"enemy_update": None, "damage_to_player": 0, "xp_gain": 0, "gold_gain": 0,
+                 "loot_found": None, "location_visual": None}
+    if nemico:
+        hp = nemico["hp"] - danni_nemico
+        meccanica["enemy_update"] = {"name": nemico["nome"], "hp": hp, "hp_max": nemico.get("hp_max", nemico["hp"]),
+                                     "ac": nemico.get("ca", 10)}
+        if hp <= 0:
+            righe.append(_frase("sconfitto", rng, nemico=n_nemico))
+            meccanica["xp_gain"] = meccanica["enemy_update"]["hp_max"] * XP_PER_PF
+            meccanica["gold_gain"] = rng.randint(0, meccanica["enemy_update"]["hp_max"] // 2)
+        elif azioni:
+            bersaglio, _, ca = rng.choice(azioni)
+            attacco, formula = dadi.offesa_stimata(nemico)
+            danni = 0
+            if rng.randint(1, 20) + attacco >= ca: danni = max(1, dadi.tira(formula, rng=rng)[0])
+            if danni: righe.append(_frase("contrattacco", rng, nemico=n_nemico, nome=bersaglio, danni=danni))
+            else: righe.append(_frase("contrattacco_mancato", rng, nemico=n_nemico, nome=bersaglio))
+            if len(azioni) == 1: meccanica["damage_to_player"] = danni
+            else: meccanica["party"] = {bersaglio: {"damage_to_player": danni, "loot_found": None}}
+    return "\n\n".join(righe) + f"\n```json\n{json.dumps(meccanica, ensure_ascii=False)}\n```"
+
+
+def narra_turno(stato, azione, rng=random):
+    """Il turno di una partita singola."""
+    return narra([(stato["personaggio"]["nome"], azione, stato["ca"])], stato["nemico_corrente"], rng)
+
+
+def intro(p):
+    return (f"{AVVISO}\n\n{p['nome']}, {p['razza']} {p['classe']}, giunge alle porte di un villaggio avvolto dalla nebbia. "
+            "Le lanterne tremolano, una campana suona lontana e la strada si divide tra la locanda e il bosco. "
+            "L'avventura comincia qui.")
@@ -0,0 +1,225 @@
+"""Catalogo degli oggetti: una scheda strutturata per oggetto, costruita una volta per processo.
+
+L'inventario contiene solo gli ID del catalogo. Le statistiche derivate (CA, armi,
+bonus d'attacco) si calcolano da una tupla di ID e restano in cache finché
+l'inventario non cambia. Il loot inventato dal DM passa per una ricerca fuzzy.
+"""
+import difflib
+import re
+import threading
+import unicodedata
+from functools import lru_cache
+
+from regole import ARCHETIPI_OGGETTO, EQUIP_AVANZATO, MAX_DES_ARMATURA, TABELLA_LOOT
+
+NOTA_RE = re.compile(r'\(([^)]*)\)')
+QUANTITA_RE = re.compile(r'\s+x(\d+)\s*$', re.IGNORECASE)
+MAGICO_RE = re.compile(r'\s*\+(\d+)\s*$')
+# Almeno un dado e almeno una faccia: "1d0" e "0d6" non sono formule per `dadi.compila`
+DADO_RE = re.compile(r'^(?:[1-9]\d*)?d[1-9]\d*$')
+CA_RE = re.compile(r'^CA\s*(\d+)$', re.IGNORECASE)
+BONUS_CA_RE = re.compile(r'^\+(\d+)\s*CA$', re.IGNORECASE)
+PAROLA_RE = re.compile(r'\w+')
+TIPI = frozenset({"arma", "armatura", "scudo", "anello", "consumabile", "vario"})
+STAT_ARMI = frozenset({"Forza", "Destrezza"})
+
+# Archetipi dal nome più lungo al più corto: "Spada Lunga" vince su "Spada"
+_ARCHETIPI = sorted(((re.compile(rf'\b{re.escape(k)}\b', re.IGNORECASE), v) for k, v in ARCHETIPI_OGGETTO.items()),
+                    key=lambda kv: -len(kv[0].pattern))
+
+
+def _base(id_oggetto):
+    """ID senza il suffisso del bonus magico: 'spada-+1' -> 'spada'."""
+    return re.sub(r'-\+\d+$', '', id_oggetto)
+
+
+def _parole(chiave):
+    """Le parole significative di uno slug: 'pozione-di-guarigione' -> {'pozione', 'guarigione'}."""
+    return {p for p in chiave.split("-") if len(p) >= 4}
+
+
+def _coperte(parole, altre, soglia):
+    """Ogni parola di `parole` ha una parola simile (refusi compresi) in `altre`."""
+    return all(difflib.get_close_matches(p, list(altre), n=1, cutoff=soglia) for p in parole)
+
+
+def slug(nome):
+    testo = unicodedata.normalize("NFKD", nome).encode("ascii", "ignore").decode().lower()
+    return re.sub(r'[^a-z0-9+]+', '-', testo).strip('-')
+
+
+def analizza_nome(testo):
+    """'Daga (1d4) x2' -> (scheda, quantità). Le note tra parentesi prevalgono sull'archetipo."""
+    quantita = 1
+    m = QUANTITA_RE.search(testo)
+    if m:
+        quantita = int(m.group(1))
+        testo = testo[:m.start()]
+    note = [n.strip() for n in NOTA_RE.findall(testo)]
+    nome = NOTA_RE.sub('', testo).strip()
+    base, magico = nome, 0
+    m = MAGICO_RE.search(nome)
+    if m:
+        magico = int(m.group(1))
+        base = nome[:m.start()]
+    scheda = {"id": slug(nome), "nome": nome, "tipo": "vario", "magico": magico}
+    for pattern, archetipo in _ARCHETIPI:
+        if pattern.search(base):
+            scheda.update(archetipo)
+            break
+    for nota in note:
+        if DADO_RE.match(nota): scheda.update(tipo="arma", dado=nota)
+        elif CA_RE.match(nota): scheda["ca"] = int(CA_RE.match(nota).group(1))
+        elif BONUS_CA_RE.match(nota): scheda["bonus_ca"] = int(BONUS_CA_RE.match(nota).group(1))
+    if scheda["tipo"] == "arma": scheda.setdefault("stat", "Forza")
+    return scheda, quantita
+
+
+class Catalogo:
+    def __init__(self):
+        self._schede = {}
+        self._parole = {}    # parola -> set di id, per la ricerca fuzzy
+        self._lock = threading.Lock()
+
+    def registra(self, scheda):
+        with self._lock:
+            if scheda["id"] in self._schede: return self._schede[scheda["id"]]
+            self._schede[scheda["id"]] = scheda
+            for parola in PAROLA_RE.findall(slug(scheda["nome"]).replace("-", " ")):
+                if len(parola) >= 4: self._parole.setdefault(parola, set()).add(scheda["id"])
+            return scheda
+
+    def ids(self):
+        return list(self._schede)
+
+    def __contains__(self, id_oggetto):
+        return id_oggetto in self._schede
+
+    def scheda(self, id_oggetto, locali=None):
+        """`locali`: schede della sola sessione (oggetti di un salvataggio caricato). Non
+        coprono mai una scheda del catalogo con lo stesso ID."""
+        return (self._schede.get(id_oggetto) or (locali or {}).get(id_oggetto)
+                or {"id": id_oggetto, "nome": id_oggetto, "tipo": "vario", "magico": 0})
+
+    def nome(self, id_oggetto, locali=None):
+        return self.scheda(id_oggetto, locali)["nome"]
+
+    def cerca(self, testo, soglia=0.8):
+        """ID dell'oggetto del catalogo più simile a `testo`, o None. Il bonus magico ("+N")
+        non è mai approssimato: la somiglianza conta solo sul nome base, e solo tra gli
+        oggetti con lo stesso bonus ("Spada +2" non diventa "Spada +1")."""
+        nome = NOTA_RE.sub('', QUANTITA_RE.sub('', testo)).strip()
+        chiave = slug(nome)
+        if chiave in self._schede: return chiave
+        m = MAGICO_RE.search(nome)
+        bonus, base = (int(m.group(1)), slug(nome[:m.start()])) if m else (0, chiave)
+        with self._lock:
+            candidati = {_base(i): i for i, s in self._schede.items() if s.get("magico", 0) == bonus}
+        parole = _parole(base)
+        # Simile non basta: una parola in più ("Superiore") fa un altro oggetto
+        for vicino in difflib.get_close_matches(base, list(candidati), n=3, cutoff=soglia):
+            if _coperte(parole, _parole(vicino), soglia) and _coperte(_parole(vicino), parole, soglia): return candidati[vicino]
+        # Sovrapposizione di parole: "Conservante, la Borsa" -> borsa-conservante. Le parole
+        # significative devono coincidere in entrambi i sensi: "Pozione di Guarigione Superiore"
+        # contiene tutte quelle della pozione comune, ma è un altro oggetto.
+        # Non per gli oggetti magici: "Spada Lunga +1" contiene tutte le parole di "Spada +1"
+        if bonus: return None
+        punteggi = {}
+        for parola in parole:
+            for id_oggetto in self._parole.get(parola, ()):
+                if not self._schede[id_oggetto].get("magico", 0): punteggi[id_oggetto] = punteggi.get(id_oggetto, 0) + 1
+        if not punteggi: return None
+        migliore = max(punteggi, key=lambda i: (punteggi[i], -len(i)))
+        return migliore if _parole(_base(migliore)) == parole else None
+
+    def risolvi(self, testo, locali=None):
+        """Nome libero (anche dal DM) -> (id, quantità). Se non esiste, la scheda nuova
+        viene dedotta dagli archetipi: con `locali` (le schede della sessione) finisce lì,
+        altrimenti viene registrata nel catalogo del processo."""
+        scheda, quantita = analizza_nome(testo)
+        trovato = self.cerca(testo)
+        if trovato: return trovato, quantita
+        if locali is None: return self.registra(scheda)["id"], quantita
+        return locali.setdefault(scheda["id"], scheda)["id"], quantita
+
+
+def _costruisci():
+    catalogo = Catalogo()
+    for voci in list(EQUIP_AVANZATO.values()) + list(TABELLA_LOOT.values()):
+        for voce in voci: catalogo.registra(analizza_nome(voce)[0])
+    return catalogo
+
+CATALOGO = _costruisci()
+_BASE = frozenset(CATALOGO.ids())
+
+
+def valida_scheda(scheda):
+    """Scheda arrivata da fuori (un salvataggio caricato) -> copia con i soli campi noti.
+    ValueError se un campo manca o ha il tipo sbagliato: `derivati` li legge senza default."""
+    if not isinstance(scheda, dict): raise ValueError("scheda non valida")
+    for campo in ("id", "nome"):
+        if not isinstance(scheda.get(campo), str) or not scheda[campo].strip(): raise ValueError(f"'{campo}' mancante")
+    if scheda.get("tipo") not in TIPI: raise ValueError(f"tipo sconosciuto: {scheda.get('tipo')!r}")
+    pulita = {"id": scheda["id"], "nome": scheda["nome"], "tipo": scheda["tipo"], "magico": scheda.get("magico", 0)}
+    for campo in ("ca", "bonus_ca"):
+        if campo in scheda: pulita[campo] = scheda[campo]
+    for campo in ("magico", "ca", "bonus_ca"):
+        if campo in pulita and (not isinstance(pulita[campo], int) or isinstance(pulita[campo], bool)):
+            raise ValueError(f"'{campo}' non è un intero")
+    if pulita["tipo"] == "arma":
+        if not isinstance(scheda.get("dado"), str) or not DADO_RE.match(scheda["dado"]): raise ValueError("dado dell'arma non valido")
+        if scheda.get("stat", "Forza") not in STAT_ARMI: raise ValueError("caratteristica dell'arma non valida")
+        pulita.update(dado=scheda["dado"], stat=scheda.get("stat", "Forza"))
+    if pulita["tipo"] == "armatura" and "categoria" in scheda:
+        if scheda["categoria"] not in MAX_DES_ARMATURA: raise ValueError("categoria di armatura non valida")
+        pulita["categoria"] = scheda["categoria"]
+    return pulita
+
+
+def chiave_locali(inventario, locali):
+    """Le schede di sessione che servono a `inventario`, in forma hashable per la cache di `derivati`."""
+    if not locali: return ()
+    return tuple(sorted((i, tuple(sorted(locali[i].items()))) for i in set(inventario) if i in locali))
+
+
+def ids_da_nomi(nomi, catalogo=CATALOGO, locali=None):
+    """Lista di nomi (es. EQUIP_AVANZATO, vecchi salvataggi) -> lista di ID, quantità espanse.
+    `locali` come in `Catalogo.risolvi`."""
+    ids = []
+    for nome in nomi:
+        id_oggetto, quantita = catalogo.risolvi(nome, locali)
+        ids.extend([id_oggetto] * quantita)
+    return ids
+
+
+def schede_custom(inventario, locali=None, catalogo=CATALOGO):
+    """Schede degli oggetti fuori dal catalogo base, da salvare insieme all'inventario."""
+    return {i: catalogo.scheda(i, locali) for i in inventario if i not in _BASE}
+
+
+def etichette(inventario, locali=None, catalogo=CATALOGO):
+    """ID -> 'Nome xN' raggruppando i duplicati, nell'ordine dell'inventario."""
+    conteggio = {}
+    for i in inventario: conteggio[i] = conteggio.get(i, 0) + 1
+    return [f"{catalogo.nome(i, locali)} x{n}" if n > 1 else catalogo.nome(i, locali) for i, n in conteggio.items()]
+
+
+@lru_cache(maxsize=1024)
+def derivati(inventario, mod_des, locali=()):
+    """Statistiche derivate da una tupla di ID: {"ca", "armi"}. In cache per inventario.
+    `locali` viene da `chiave_locali`: di solito vuoto, così la cache resta condivisa."""
+    locali = {i: dict(campi) for i, campi in locali}
+    schede = [CATALOGO.scheda(i, locali) for i in dict.fromkeys(inventario)]
+    armature = [s for s in schede if s["tipo"] == "armatura"]
+    if armature:
+        migliore = max(armature, key=lambda s: s.get("ca", 10) + s["magico"])
+        max_des = MAX_DES_ARMATURA.get(migliore.get("categoria"), None)
+        des = mod_des if max_des is None else 0 if max_des == 0 else min(mod_des, max_des)   # le pesanti ignorano la Des
+        ca = migliore.get("ca", 10) + migliore["magico"] + des
+    else: ca = 10 + mod_des
+    ca += max((s.get("bonus_ca", 0) + s["magico"] for s in schede if s["tipo"] == "scudo"), default=0)
+    ca += sum(s.get("bonus_ca", 0) + s["magico"] for s in schede if s["tipo"] == "anello")
+    armi = [{"id": s["id"], "label": s["nome"], "stat": s["stat"], "dice": s["dado"], "magico": s["magico"]}
+            for s in schede if s["tipo"] == "arma"]
+    if not armi: armi.append({"id": "pugno", "label": "Pugno", "stat": "Forza", "dice": "1d4", "magico": 0})
+    return {"ca": ca, "armi": armi}
@@ -0,0 +1,94 @@
+"""Orchestrazione del turno: la narrazione ha la precedenza, il resto corre di lato.
+
+La narrazione viene consumata nel thread dello script (serve a `st.write_stream`); i
+lavori secondari (riassunto anticipato, download dell'immagine della scena) partono nei
+pool di background appena possibile e il turno non li aspetta mai. Ogni turno ha una
+scadenza e può essere annullato: un'azione nuova del giocatore chiude quello in volo.
+"""
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as AttesaScaduta
+
+from contesto import LUOGO_RE
+
+# La scena nel blocco JSON, riconoscibile appena il valore è chiuso: la virgoletta di chiusura è
+# dello stesso tipo di quella d'apertura ed è seguita da `,` o `}` ("la grotta dell'orco" resta intera)
+LOCATION_RE = re.compile(r'''["']location_visual["']\s*:\s*(?P<q>["'])(?P<scena>(?:\\.|(?!(?P=q)\s*[,}])[^\\\n]){3,})(?P=q)\s*[,}]''')
+ESCAPE_RE = re.compile(r'\\(.)')
+
+
+def scena_nel_testo(testo):
+    """La scena annunciata finora nel testo del modello (segnaposto [[LUOGO:]] o campo JSON), o None."""
+    m = LUOGO_RE.search(testo)
+    if m: return m.group(1).strip() or None
+    m = LOCATION_RE.search(testo)
+    if m: return ESCAPE_RE.sub(r'\1', m.group("scena")).strip() or None
+    return None
+
+# Worker per le chiamate senza streaming: il thread dello script resta libero di annullare
+_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="turno")
+
+
+class TurnoAnnullato(Exception):
+    pass
+
+
+class TurnoScaduto(TimeoutError):
+    pass
+
+
+class Turno:
+    def __init__(self, timeout=90.0, intervallo=0.1):
+        self.timeout = timeout
+        self.intervallo = intervallo
+        self.inizio = time.monotonic()
+        self.scena = None      # scena riconosciuta durante lo stream
+        self.anticipo = None   # quello che ha restituito `su_scena` (es. l'URL dell'immagine)
+        self.chiuso = False
+        self._annullato = threading.Event()
+
+    def annulla(self):
+        self._annullato.set()
+
+    @property
+    def annullato(self):
+        return self._annullato.is_set()
+
+    def controlla(self):
+        if self._annullato.is_set(): raise TurnoAnnullato("Turno annullato da una nuova azione")
+        if time.monotonic() - self.inizio > self.timeout: raise TurnoScaduto(f"Nessuna risposta entro {self.timeout:g}s")
+
+    def flusso(self, chunks, su_scena=None):
+        """Passa i chunk del modello controllando annullamento e scadenza. Alla prima scena
+        riconoscibile nel testo chiama `su_scena(descrizione)` senza aspettare la fine."""
+        testo = ""
+        try:
+            for chunk in chunks:
+                self.controlla()
+                if su_scena and self.scena is None:
+                    try: testo += chunk.text
+                    except ValueError: pass
+                    scena = scena_nel_testo(testo)
+                    if scena:
+                        self.scena = scena
+                        self.anticipo = su_scena(self.scena)
+                yield chunk
+        finally:
+            # Chiudere il generatore del client libera subito il suo slot di concorrenza
+            if hasattr(chunks, "close"): chunks.close()
+
+    def chiama(self, funzione, *args, battito=None, **kwargs):
+        """Chiamata bloccante in un worker. Il turno smette di aspettarla se viene annullato
+        o scade; `battito(secondi)` viene chiamato a ogni controllo (in Streamlit ogni scrittura
+        è anche il punto in cui lo script può essere interrotto da un'azione nuova)."""
+        futuro = _POOL.submit(funzione, *args, **kwargs)
+        while True:
+            try: return futuro.result(timeout=self.intervallo)
+            except AttesaScaduta:
+                self.controlla()
+                if battito: battito(time.monotonic() - self.inizio)
+
+    def chiudi(self):
+        self.chiuso = True
@@ -0,0 +1,312 @@
+"""Modalità party: più sessioni sullo stesso mondo, una sola chiamata al DM per round.
+
+Un `Tavolo` vive nel processo (uno per codice, nel `Registro`) e tiene il mondo condiviso
+(trascrizione, diario, nemico, bestiario, memoria) più un eroe per giocatore. Le azioni
+inviate entro la `finestra` del round diventano un solo prompt; l'esito viene applicato
+sotto il lock del tavolo e ogni sessione lo ritrova al suo prossimo rerun, insieme ai
+propri eventi (danni, bottino, livelli).
+"""
+import copy
+import logging
+import random
+import string
+import threading
+import time
+from collections.abc import MutableMapping
+
+import motore
+import narratore
+from client_modello import ModelloNonDisponibile
+from contesto import ISTRUZIONI, LUOGO_RE, costruisci_prompt, nuovo_messaggio
+from meccaniche import analizza_meccanica
+
+log = logging.getLogger(__name__)
+
+# Campi di ogni eroe; il resto dello stato (trascrizione, diario, nemico...) è del tavolo
+CAMPI_EROE = frozenset({
+    "game_phase", "personaggio", "hp", "hp_max", "oro", "xp", "livello", "bonus_competenza", "inventario",
+    "spell_slots", "spell_slots_max", "hit_dice_max", "hit_dice_curr", "ca", "ultimo_tiro", "temp_stats",
+    "pending_action", "oggetti_custom",
+})
+CAMPI_MONDO = ("messages", "journal", "nemico_corrente", "bestiary", "gallery", "summary_history", "ricordi")
+SOGLIA_RIASSUNTO = 15
+ALFABETO = "".join(c for c in string.ascii_uppercase if c not in "IO")
+
+ISTRUZIONI_PARTY = ISTRUZIONI + (
+    "\n4. Il gruppo agisce insieme: narra il round rispondendo all'azione di ogni eroe.\n"
+    "5. Danni e bottino vanno a ciascun eroe per nome nel campo 'party' del JSON:\n"
+    "  'party': {'Nome': {'damage_to_player': int, 'loot_found': 'nome_oggetto' (o null)}}\n"
+    "   'xp_gain' e 'gold_gain' sono il totale del gruppo."
+)
+
+
+class ErroreTavolo(ValueError):
+    pass
+
+
+class Vista(MutableMapping):
+    """Lo stato come lo vede un giocatore: i campi dell'eroe sono suoi, il resto è del tavolo.
+    Si usa come `st.session_state` (anche per attributi) e il motore non vede differenze.
+    Ogni accesso prende il lock del tavolo; le regole che leggono e riscrivono più campi
+    passano da `Tavolo.applica`, che tiene il lock per tutta la funzione."""
+
+    def __init__(self, eroe, mondo, lock):
+        object.__setattr__(self, "_eroe", eroe)
+        object.__setattr__(self, "_mondo", mondo)
+        object.__setattr__(self, "_lock", lock)
+
+    def _dove(self, chiave):
+        return self._eroe if chiave in CAMPI_EROE else self._mondo
+
+    def __getitem__(self, chiave):
+        with self._lock: return self._dove(chiave)[chiave]
+
+    def __setitem__(self, chiave, valore):
+        with self._lock: self._dove(chiave)[chiave] = valore
+
+    def __delitem__(self, chiave):
+        with self._lock: del self._dove(chiave)[chiave]
+
+    def __iter__(self):
+        with self._lock: chiavi = list(self._eroe) + [k for k in self._mondo if k not in CAMPI_EROE]
+        yield from chiavi
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __getattr__(self, nome):
+        try: return self[nome]
+        except KeyError: raise AttributeError(nome) from None
+
+    def __setattr__(self, nome, valore):
+        self[nome] = valore
+
+
+class Tavolo:
+    """Mondo condiviso, eroi dei giocatori e round aperto. Tutto passa dal `lock`."""
+
+    def __init__(self, codice, mondo, finestra=8.0, consolidatore=None, limiti=motore.LIMITI, scarica=None):
+        self.codice = codice
+        self.mondo = mondo
+        self.finestra = finestra
+        self.consolidatore = consolidatore
+        self.limiti = limiti
+        self.scarica = scarica    # scarica(campo, voci) per le voci che escono dalla memoria
+        self.lock = threading.RLock()
+        self.eroi = {}            # giocatore -> campi dell'eroe
+        self.azioni = {}          # giocatore -> azione del round aperto, in ordine d'arrivo
+        self.apertura = None      # istante della prima azione del round aperto
+        self.in_corso = False
+        self.round = 0
+        self.versione = 0         # cresce a ogni cambiamento visibile: le sessioni si ridisegnano
+        self._eventi = {}         # giocatore -> eventi non ancora mostrati
+
+    def vista(self, giocatore):
+        return Vista(self.eroi[giocatore], self.mondo, self.lock)
+
+    def applica(self, giocatore, regola, *args, **kwargs):
+        """`regola(vista, ...)` tutta sotto il lock: una lettura-modifica-scrittura (hp, slot,
+        livello) non si intreccia col round che un'altra sessione sta concludendo."""
+        with self.lock: return regola(self.vista(giocatore), *args, **kwargs)
+
+    def istantanea(self, giocatore):
+        """Copia coerente e indipendente di ciò che vede `giocatore` (per l'autosalvataggio, fuori dal lock)."""
+        with self.lock: return copy.deepcopy(dict(self.vista(giocatore)))
+
+    def nomi(self):
+        with self.lock: return {g: e["personaggio"]["nome"] for g, e in self.eroi.items()}
+
+    def membri(self):
+        """(giocatore, nome, classe, hp, hp_max) per ogni eroe al tavolo."""
+        with self.lock:
+            return [(g, e["personaggio"]["nome"], e["personaggio"]["classe"], e["hp"], e["hp_max"]) for g, e in self.eroi.items()]
+
+    def situazione(self):
+        """(chi ha agito, chi manca, secondi alla chiusura) per il round aperto."""
+        with self.lock:
+            nomi = self.nomi()
+            return [nomi[g] for g in self.azioni if g in nomi], [n for g, n in nomi.items() if g not in self.azioni], self.rimanente()
+
+    def unisciti(self, giocatore, stato):
+        """Porta al tavolo l'eroe di `stato` (una partita già avviata). Ritorna la sua vista."""
+        eroe = copy.deepcopy({k: stato[k] for k in CAMPI_EROE if k in stato})
+        eroe["pending_action"] = None
+        with self.lock:
+            if giocatore not in self.eroi:
+                motore.aggiorna_diario(self.mondo, f"{eroe['personaggio']['nome']} si unisce al gruppo.", ricordo=None)
+            self.eroi[giocatore] = eroe
+            self.versione += 1
+            return self.vista(giocatore)
+
+    def lascia(self, giocatore):
+        """Toglie l'eroe dal tavolo. Ritorna lo stato per continuare da soli (con una copia del mondo)."""
+        with self.lock:
+            eroe = self.eroi.pop(giocatore, None)
+            self.azioni.pop(giocatore, None)
+            self._eventi.pop(giocatore, None)
+            if eroe is None: return None
+            motore.aggiorna_diario(self.mondo, f"{eroe['personaggio']['nome']} lascia il gruppo.", ricordo=None)
+            self.versione += 1
+            return {**eroe, **copy.deepcopy({k: self.mondo[k] for k in CAMPI_MONDO})}
+
+    def invia(self, giocatore, azione):
+        """Azione per il round aperto: una per giocatore, l'ultima sostituisce la precedente."""
+        with self.lock:
+            if giocatore not in self.eroi: raise ErroreTavolo("Non sei più seduto a questo tavolo")
+            self.azioni[giocatore] = azione
+            if self.apertura is None: self.apertura = time.monotonic()
+            self.versione += 1
+
+    def rimanente(self):
+        """Secondi alla chiusura del round aperto (None se nessuno ha ancora agito)."""
+        with self.lock:
+            if self.apertura is None: return None
+            return max(0.0, self.finestra - (time.monotonic() - self.apertura))
+
+    def pronto(self):
+        """Il round si chiude quando hanno agito tutti o quando scade la finestra."""
+        with self.lock:
+            if self.in_corso or not self.azioni: return False
+            return len(self.azioni) >= len(self.eroi) or self.rimanente() == 0
+
+    def eventi(self, giocatore):
+        """Eventi del motore destinati a `giocatore`, consegnati una volta sola."""
+        with self.lock: return self._eventi.pop(giocatore, [])
+
+    def esegui_round(self, genera, immagine=None, rng=random, **opzioni_prompt):
+        """Chiude il round se è pronto e lo gioca con una sola chiamata `genera(prompt) -> testo`.
+
+        Ritorna la risposta del DM, oppure None se il round non era pronto o lo sta già
+        giocando un'altra sessione. Se il modello non è disponibile il round lo narra il DM
+        di riserva; per ogni altro errore le azioni tornano nel round aperto e l'eccezione
+        risale a chi ha chiamato.
+        """
+        with self.lock:
+            if not self.pronto(): return None
+            azioni, self.azioni, self.apertura = self.azioni, {}, None
+            self.in_corso = True
+            messaggio, prompt = self._prepara(azioni, **opzioni_prompt)
+        # La chiamata al DM avviene fuori dal lock: nel frattempo gli altri possono già agire
+        try: res = genera(prompt)
+        except ModelloNonDisponibile as e:
+            log.warning("Round %d del tavolo %s con il DM di riserva: %s", self.round + 1, self.codice, e)
+            with self.lock:
+                partecipanti = [(self.eroi[g]["personaggio"]["nome"], a, self.eroi[g]["ca"]) for g, a in azioni.items() if g in self.eroi]
+                res = narratore.narra(partecipanti, self.mondo["nemico_corrente"], rng)
+        except BaseException:   # anche l'interruzione dello script Streamlit
+            with self.lock:
+                self.azioni = {**azioni, **self.azioni}
+                if self.apertura is None: self.apertura = time.monotonic()
+                self.in_corso = False
+            raise
+        with self.lock:
+            try: self._concludi(azioni, messaggio, res, immagine, rng)
+            finally:
+                self.in_corso = False
+                self.round += 1
+                self.versione += 1
+        return res
+
+    def _prepara(self, azioni, istruzioni=ISTRUZIONI_PARTY, note=None, **opzioni_prompt):
+        nomi = self.nomi()
+        azione = "\n".join(f"{nomi[g]}: {a}" for g, a in azioni.items() if g in nomi)
+        messaggio = nuovo_messaggio("user", "\n\n".join(f"{nomi[g]}: {motore.testo_azione(a)}" for g, a in azioni.items() if g in nomi))
+        eroi = list(self.eroi.values())
+        scheda = "Eroi: " + "; ".join(f"{e['personaggio']['nome']} ({e['personaggio']['classe']} L{e['livello']}, "
+                                      f"HP {e['hp']}/{e['hp_max']})" for e in eroi) + "."
+        gruppo = {"nome": ", ".join(nomi.values()), "classe": "(gruppo)"}
+        prompt, _ = costruisci_prompt(gruppo, sum(e["hp"] for e in eroi), sum(e["hp_max"] for e in eroi),
+                                      self.mondo["nemico_corrente"], self.mondo["journal"], self.mondo["summary_history"],
+                                      self.mondo["messages"] + [messaggio], azione, istruzioni=istruzioni,
+                                      note=f"{scheda} {note}" if note else scheda,
+                                      ricordi=motore.ricordi_pertinenti(self.mondo, azione), **opzioni_prompt)
+        return messaggio, prompt
+
+    def _concludi(self, azioni, messaggio, res, immagine, rng):
+        """Applica l'esito del round: la parte condivisa al mondo, danni e bottino a ciascun eroe."""
+        data, riparazioni = analizza_meccanica(res)
+        if riparazioni: log.info("Meccanica del round riparata/scartata: %s", riparazioni)
+        nomi = {g: e["personaggio"]["nome"] for g, e in self.eroi.items()}
+        eventi = {g: self._eventi.setdefault(g, []) for g in nomi}
+        scena = None
+        if data:
+            condivisa = dict(data, damage_to_player=0, xp_gain=0, gold_gain=0, loot_found=None)
+            scena, comuni = motore.applica_meccanica(self.mondo, condivisa, rng)
+            for ev in eventi.values(): ev.extend(comuni)
+            # Danni e bottino al primo livello valgono per il primo che ha agito, se la sua voce
+            # in "party" non li specifica già
+            per_eroe = {n.casefold(): dict(e) for n, e in (data.get("party") or {}).items()}
+            primo = next((g for g in azioni if g in nomi), None)
+            if primo:
+                effetti = per_eroe.setdefault(nomi[primo].casefold(), {})
+                for campo in ("damage_to_player", "loot_found"):
+                    if not effetti.get(campo): effetti[campo] = data[campo]
+            if data["xp_gain"]: motore.aggiorna_diario(self.mondo, f"+{data['xp_gain']} XP al gruppo", ricordo=None)
+            for g, nome in nomi.items():
+                vista, effetti = self.vista(g), per_eroe.get(nome.casefold(), {})
+                danno = effetti.get("damage_to_player", 0)
+                if danno > 0:
+                    vista["hp"] = max(0, vista["hp"] - danno)
+                    motore.aggiorna_diario(self.mondo, f"{nome} subisce {danno} danni", ricordo=None)
+                    eventi[g].append(motore.toast(f"-{danno} HP", "🩸"))
+                if effetti.get("loot_found"): eventi[g].extend(motore.genera_loot(vista, effetti["loot_found"], rng)[1])
+                # XP e oro si dividono tra tutti gli eroi al tavolo
+                vista["xp"] += data["xp_gain"] // len(nomi)
+                vista["oro"] += data["gold_gain"] // len(nomi)
+                eventi[g].extend(motore.check_level_up(vista))
+                motore.calcola_ca(vista)
+        if not scena:
+            luogo = LUOGO_RE.search(res)
+            if luogo: scena = luogo.group(1)
+        img_url = immagine(scena) if scena and immagine else None
+        for e in self.eroi.values(): e["ultimo_tiro"] = None
+        self.mondo["messages"].append(messaggio)
+        self.mondo["messages"].append(nuovo_messaggio("assistant", res, image_url=img_url))
+        self._memoria()
+
+    def _memoria(self):
+        """Riassunto e limiti della trascrizione condivisa, come in una partita singola."""
+        cons = self.consolidatore
+        if cons:
+            esito = cons.raccogli()
+            if esito and esito[0]: self._scarica("messages", motore.applica_riassunto(self.mondo, *esito))
+            if len(self.mondo["messages"]) > SOGLIA_RIASSUNTO and not cons.occupato: cons.avvia(self.mondo["messages"][1:-5])
+        # Con un riassunto in volo la trascrizione non si tocca: gli indici devono restare validi
+        limiti = {k: v for k, v in self.limiti.items() if k != "messages" or not (cons and cons.occupato)}
+        motore.limita(self.mondo, limiti, self._scarica)
+
+    def _scarica(self, campo, voci):
+        if self.scarica and voci: self.scarica(campo, voci)
+
+
+class Registro:
+    """I tavoli aperti nel processo, per codice. Un tavolo rimasto vuoto viene chiuso."""
+
+    def __init__(self):
+        self._tavoli = {}
+        self._lock = threading.Lock()
+
+    def apri(self, giocatore, stato, codice=None, **opzioni):
+        """Nuovo tavolo con il mondo della partita `stato` di chi lo apre."""
+        with self._lock:
+            codice = (codice or "").strip().upper() or self._codice()
+            if codice in self._tavoli: raise ErroreTavolo(f"Il tavolo {codice} esiste già")
+            tavolo = self._tavoli[codice] = Tavolo(codice, copy.deepcopy({k: stato[k] for k in CAMPI_MONDO}), **opzioni)
+        tavolo.unisciti(giocatore, stato)
+        return tavolo
+
+    def trova(self, codice):
+        with self._lock: return self._tavoli.get((codice or "").strip().upper())
+
+    def lascia(self, codice, giocatore):
+        tavolo = self.trova(codice)
+        if tavolo is None: return None
+        stato = tavolo.lascia(giocatore)
+        with self._lock:
+            if not tavolo.eroi: self._tavoli.pop(tavolo.codice, None)
+        return stato
+
+    def _codice(self):
+        while True:
+            codice = "".join(random.choices(ALFABETO, k=4))
+            if codice not in self._tavoli: return codice
@@ -0,0 +1,215 @@
+"""Dati e regole 5e. Modulo importato una volta per processo: le tabelle non vengono
+ricostruite a ogni rerun di Streamlit.
+
+Classi, livelli, slot, incantesimi e tesori vengono dai pacchetti di regole in `pacchetti/`
+(JSON a righe compatte, vedi `srd.json`); più pacchetti si sommano nell'ordine dato, le voci
+con lo stesso nome sostituiscono le precedenti. All'avvio vengono compilati in tabelle
+indicizzate (soglie XP per bisect, incantesimi per livello, capacità cumulative per classe)
+e il risultato compilato resta su disco: finché i pacchetti non cambiano, l'avvio è un
+solo `pickle.load`.
+
+    REGOLE_PACCHETTI=pacchetti/srd.json:mio_mondo.json   (default: tutti i .json in pacchetti/)
+    REGOLE_CACHE_DIR=.cache_regole
+"""
+import bisect
+import glob
+import hashlib
+import json
+import logging
+import os
+import pickle
+import threading
+
+log = logging.getLogger(__name__)
+
+QUI = os.path.dirname(os.path.abspath(__file__))
+CARTELLA = os.path.join(QUI, "pacchetti")
+# Da cambiare quando cambia la forma del compilato: invalida le cache su disco
+COMPILATORE = 1
+LIVELLO_MAX_INCANTESIMI = 9
+
+
+class ErroreRegole(ValueError):
+    pass
+
+
+def _righe(tabella):
+    """{"colonne": [...], "righe": [[...], ...]} -> lista di dict."""
+    return [dict(zip(tabella["colonne"], riga)) for riga in tabella.get("righe", [])]
+
+
+def unisci(pacchetti):
+    """Somma i pacchetti grezzi: righe e voci con lo stesso nome vengono sostituite."""
+    dati = {"abilita": {}, "livelli": {}, "slot": {}, "classi": {}, "caratteristiche": {}, "incantesimi": {}, "loot": {}}
+    for pacchetto in pacchetti:
+        for stat, skills in pacchetto.get("abilita", {}).items(): dati["abilita"].setdefault(stat, []).extend(
+            s for s in skills if s not in dati["abilita"].get(stat, []))
+        for chiave in ("livelli", "slot", "loot"): dati[chiave].update(pacchetto.get(chiave, {}))
+        for chiave in ("classi", "incantesimi"):
+            if chiave in pacchetto: dati[chiave].update({r["nome"]: r for r in _righe(pacchetto[chiave])})
+        for classe, per_livello in pacchetto.get("caratteristiche", {}).items():
+            dati["caratteristiche"].setdefault(classe, {}).update(per_livello)
+    return dati
+
+
+def compila(dati):
+    """Dati uniti -> tabelle pronte per il gioco (solo tipi base: il compilato va in pickle)."""
+    soglie = tuple(dati["livelli"].get("xp", ()))
+    if not soglie or soglie[0] != 0 or list(soglie) != sorted(soglie):
+        raise ErroreRegole("livelli.xp deve partire da 0 ed essere crescente")
+    n_livelli = len(soglie)
+    competenza = tuple(dati["livelli"].get("competenza", [2 + (l - 1) // 4 for l in range(1, n_livelli + 1)]))
+    if len(competenza) != n_livelli: raise ErroreRegole("livelli.competenza e livelli.xp hanno lunghezze diverse")
+
+    # slot[tipo][livello - 1] = {livello incantesimo: quantità}
+    slot = {}
+    for tipo, righe in dati["slot"].items():
+        if len(righe) != n_livelli: raise ErroreRegole(f"slot.{tipo}: servono {n_livelli} righe")
+        slot[tipo] = tuple({l: q for l, q in enumerate(riga, 1) if q} for riga in righe)
+
+    classi = {}
+    for nome, c in dati["classi"].items():
+        if c.get("incantatore") and c["incantatore"] not in slot:
+            raise ErroreRegole(f"Classe {nome}: tabella slot '{c['incantatore']}' assente")
+        # Capacità cumulative per livello: un accesso per indice invece di scorrere la tabella
+        nuove = dati["caratteristiche"].get(nome, {})
+        cumulate, finora = [], ()
+        for l in range(1, n_livelli + 1):
+            finora += tuple(nuove.get(str(l), ()))
+            cumulate.append(finora)
+        classi[nome] = {"dado_vita": c["dado_vita"], "incantatore": c.get("incantatore"), "icona": c.get("icona", "👤"),
+                        "competenze": tuple(c.get("competenze", ())), "equipaggiamento": tuple(c.get("equipaggiamento", ())),
+                        "magie": tuple(c.get("magie", ())), "caratteristiche": tuple(cumulate)}
+
+    incantesimi, per_livello = {}, [[] for _ in range(LIVELLO_MAX_INCANTESIMI + 1)]
+    for nome, m in dati["incantesimi"].items():
+        if not 0 <= m["livello"] <= LIVELLO_MAX_INCANTESIMI: raise ErroreRegole(f"Incantesimo {nome}: livello {m['livello']}")
+        incantesimi[nome] = {"livello": m["livello"], "danni": m.get("danni"), "classi": frozenset((m.get("classi") or "").split())}
+        per_livello[m["livello"]].append(nome)
+
+    return {"soglie_xp": soglie, "competenza": competenza, "slot": slot, "classi": classi,
+            "incantesimi": incantesimi, "per_livello": tuple(tuple(n) for n in per_livello),
+            "skill": {s: stat for stat, skills in dati["abilita"].items() for s in skills},
+            "loot": {r: tuple(v) for r, v in dati["loot"].items()}}
+
+
+def percorsi_pacchetti():
+    scelti = os.environ.get("REGOLE_PACCHETTI")
+    if scelti: return [p for p in scelti.split(os.pathsep) if p]
+    return sorted(glob.glob(os.path.join(CARTELLA, "*.json")))
+
+
+def carica(percorsi=None, cartella_cache=None):
+    """Regole compilate dai pacchetti, dalla cache su disco se i pacchetti non sono cambiati.
+    La chiave usa percorso assoluto, dimensione e mtime di ogni pacchetto: niente da leggere
+    per sapere se è valida. La cache sta accanto al modulo (come `pacchetti/`), qualunque
+    sia la cartella da cui si avvia l'app; REGOLE_CACHE_DIR relativo parte da lì."""
+    percorsi = percorsi or percorsi_pacchetti()
+    if not percorsi: raise ErroreRegole(f"Nessun pacchetto di regole in {CARTELLA}")
+    cartella_cache = os.path.join(QUI, cartella_cache or os.environ.get("REGOLE_CACHE_DIR", ".cache_regole"))
+    impronta = [COMPILATORE]
+    for p in percorsi:
+        info = os.stat(p)
+        impronta.append((os.path.abspath(p), info.st_size, info.st_mtime_ns))
+    chiave = hashlib.sha256(repr(impronta).encode("utf-8")).hexdigest()[:24]
+    percorso = os.path.join(cartella_cache, f"regole_{chiave}.pickle")
+    try:
+        with open(percorso, "rb") as f: return pickle.load(f)
+    except FileNotFoundError: pass
+    except Exception as e: log.warning("Cache delle regole illeggibile (%s), ricompilo: %s", type(e).__name__, e)
+
+    pacchetti = []
+    for p in percorsi:
+        with open(p, encoding="utf-8") as f: pacchetti.append(json.load(f))
+    regole = compila(unisci(pacchetti))
+    try:
+        os.makedirs(cartella_cache, exist_ok=True)
+        tmp = f"{percorso}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f: pickle.dump(regole, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, percorso)
+    except OSError as e: log.warning("Cache delle regole non scrivibile: %s", e)
+    log.info("Regole compilate da %d pacchetti (%d classi, %d incantesimi)", len(percorsi),
+             len(regole["classi"]), len(regole["incantesimi"]))
+    return regole
+
+
+_R = carica()
+
+CLASSI = _R["classi"]
+INCANTESIMI = _R["incantesimi"]
+# INCANTESIMI_PER_LIVELLO[l] = nomi degli incantesimi di livello l (0 = trucchetti), in ordine di pacchetto
+INCANTESIMI_PER_LIVELLO = _R["per_livello"]
+SOGLIE_XP = _R["soglie_xp"]
+LIVELLO_MAX = len(SOGLIE_XP)
+
+# Le tabelle di sempre, ricavate dal compilato
+SKILL_MAP = _R["skill"]
+COMPETENZE_CLASSE = {n: list(c["competenze"]) for n, c in CLASSI.items()}
+EQUIP_AVANZATO = {n: list(c["equipaggiamento"]) for n, c in CLASSI.items()}
+MAGIE_INIZIALI = {n: list(c["magie"]) for n, c in CLASSI.items()}
+HIT_DICE_MAP = {n: c["dado_vita"] for n, c in CLASSI.items()}
+XP_LEVELS = {l: xp for l, xp in enumerate(SOGLIE_XP, 1)}
+SPELL_SLOTS_TABLE = {l: s for l, s in enumerate(_R["slot"].get("pieno", ()), 1)}
+TABELLA_LOOT = {r: list(v) for r, v in _R["loot"].items()}
+
+
+def livello_per_xp(xp):
+    return max(1, bisect.bisect_right(SOGLIE_XP, xp))
+
+
+def bonus_competenza(livello):
+    return _R["competenza"][min(max(livello, 1), LIVELLO_MAX) - 1]
+
+
+def slot_classe(classe, livello):
+    """{livello incantesimo: slot} per la classe a quel livello ({} se non lancia incantesimi)."""
+    tipo = CLASSI.get(classe, {}).get("incantatore")
+    if not tipo: return {}
+    return dict(_R["slot"][tipo][min(max(livello, 1), LIVELLO_MAX) - 1])
+
+
+def caratteristiche(classe, livello):
+    """Capacità di classe ottenute fino a `livello` compreso."""
+    if classe not in CLASSI: return ()
+    return CLASSI[classe]["caratteristiche"][min(max(livello, 1), LIVELLO_MAX) - 1]
+
+
+def livello_incantesimo(nome):
+    """0 = trucchetto. Gli incantesimi che il pacchetto non conosce (es. inventati dal DM) sono di 1° livello."""
+    return INCANTESIMI[nome]["livello"] if nome in INCANTESIMI else 1
+
+
+def incantesimi_classe(classe, livello):
+    """Incantesimi di un certo livello nella lista della classe."""
+    return [n for n in INCANTESIMI_PER_LIVELLO[livello] if classe in INCANTESIMI[n]["classi"]]
+
+
+# Archetipi degli oggetti: il catalogo riconosce un oggetto dal nome base più lungo che contiene
+ARCHETIPI_OGGETTO = {
+    "Armatura di Piastre": {"tipo": "armatura", "categoria": "pesante", "ca": 18},
+    "Piastre": {"tipo": "armatura", "categoria": "pesante", "ca": 18},
+    "Cotta di Maglia": {"tipo": "armatura", "categoria": "pesante", "ca": 16},
+    "Corazza a Scaglie": {"tipo": "armatura", "categoria": "media", "ca": 14},
+    "Giaco di Maglia": {"tipo": "armatura", "categoria": "media", "ca": 13},
+    "Armatura di Cuoio": {"tipo": "armatura", "categoria": "leggera", "ca": 11},
+    "Cuoio": {"tipo": "armatura", "categoria": "leggera", "ca": 11},
+    "Scudo": {"tipo": "scudo", "bonus_ca": 2},
+    "Anello di Protezione": {"tipo": "anello", "bonus_ca": 1},
+    "Spada Lunga": {"tipo": "arma", "dado": "1d8", "stat": "Forza"},
+    "Spada Corta": {"tipo": "arma", "dado": "1d6", "stat": "Forza"},
+    "Spada": {"tipo": "arma", "dado": "1d8", "stat": "Forza"},
+    "Ascia": {"tipo": "arma", "dado": "1d8", "stat": "Forza"},
+    "Martello": {"tipo": "arma", "dado": "1d8", "stat": "Forza"},
+    "Mazza": {"tipo": "arma", "dado": "1d6", "stat": "Forza"},
+    "Bastone": {"tipo": "arma", "dado": "1d6", "stat": "Forza"},
+    "Daga": {"tipo": "arma", "dado": "1d4", "stat": "Destrezza"},
+    "Arco Lungo": {"tipo": "arma", "dado": "1d8", "stat": "Destrezza"},
+    "Arco Corto": {"tipo": "arma", "dado": "1d6", "stat": "Destrezza"},
+    "Arco": {"tipo": "arma", "dado": "1d6", "stat": "Destrezza"},
+    "Balestra": {"tipo": "arma", "dado": "1d8", "stat": "Destrezza"},
+    "Fionda": {"tipo": "arma", "dado": "1d4", "stat": "Destrezza"},
+    "Pozione": {"tipo": "consumabile"},
+    "Pergamena": {"tipo": "consumabile"},
+}
+# Dex massima aggiunta alla CA per categoria di armatura (None = nessun limite)
+MAX_DES_ARMATURA = {"leggera": None, "media": 2, "pesante": 0}
@@ -0,0 +1,328 @@
+"""Formato di salvataggio versionato e autosalvataggio incrementale.
+
+File scaricabile: intestazione `DNDS` + versione (1 byte) + JSON compresso con zlib.
+I vecchi `hero_evolved.json` (versione 0, `json.dumps(..., default=str)`) vengono
+riconosciuti e migrati. Il caricamento accetta solo i campi noti, con i tipi attesi.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import uuid
+import zlib
+
+from contesto import migra_riassunti
+from oggetti import CATALOGO, ids_da_nomi, schede_custom, valida_scheda
+
+MAGIC = b"DNDS"
+RUMORE_DIARIO_RE = re.compile(r'^- (Subiti \d+ danni|\+\d+ XP)$')
+VERSIONE = 3
+
+# campo -> tipi ammessi
+CAMPI = {
+    "game_phase": (str,), "personaggio": (dict,),
+    "hp": (int,), "hp_max": (int,), "oro": (int,), "xp": (int,), "livello": (int,), "bonus_competenza": (int,),
+    "inventario": (list,), "spell_slots": (dict,), "spell_slots_max": (dict,),
+    "hit_dice_max": (int,), "hit_dice_curr": (int,), "ca": (int,),
+    "nemico_corrente": (dict, type(None)),
+    "messages": (list,), "gallery": (list,), "bestiary": (list,), "journal": (list,), "summary_history": (list,),
+    "ricordi": (list,),
+    "oggetti_custom": (dict,),
+}
+# Liste e dict che la UI scorre: tipo degli elementi e chiavi obbligatorie con i loro tipi
+ELEMENTI = {
+    "inventario": (str, {}), "journal": (str, {}),
+    "messages": (dict, {"role": (str,), "content": (str,)}),
+    "gallery": (dict, {"url": (str,), "desc": (str, type(None))}),
+    "bestiary": (dict, {"nome": (str,), "hp": (int,), "hp_max": (int,)}),
+    "summary_history": (dict, {"testo": (str,)}),
+    "ricordi": (dict, {"testo": (str,)}),
+}
+CHIAVI_PERSONAGGIO = {"nome": (str,), "classe": (str,), "razza": (str,), "stats": (dict,), "competenze": (list,), "magie": (list,)}
+CHIAVI_NEMICO = {"nome": (str,), "hp": (int,), "hp_max": (int,), "ca": (int,)}
+# Liste che crescono in coda: l'autosalvataggio registra solo le voci nuove
+LISTE_IN_CODA = ("messages", "journal", "gallery", "bestiary", "ricordi")
+
+
+class ErroreSalvataggio(ValueError):
+    pass
+
+
+def estrai(stato):
+    """Solo i campi di gioco: niente oggetti di sessione, niente stato transitorio."""
+    dati = {k: stato[k] for k in CAMPI if k in stato}
+    # Gli oggetti inventati dal DM non sono nel catalogo base: viaggiano col salvataggio
+    if "inventario" in dati: dati["oggetti_custom"] = schede_custom(dati["inventario"], stato.get("oggetti_custom"))
+    return dati
+
+
+# --- migrazioni: ognuna porta i dati dalla versione N alla N+1 ---
+
+def _v0_a_v1(dati):
+    # default=str trasformava le chiavi degli slot in stringhe; prima ancora erano un int solo
+    for k in ("spell_slots", "spell_slots_max"):
+        if isinstance(dati.get(k), int): dati[k] = {1: dati[k]}
+    dati["summary_history"] = migra_riassunti(dati.get("summary_history", ""))
+    if isinstance(dati.get("personaggio"), dict): dati["personaggio"].setdefault("id", uuid.uuid4().hex)
+    return dati
+
+def _v1_a_v2(dati):
+    # L'inventario passa da nomi liberi ("Daga (1d4) x2") a ID del catalogo
+    locali = {}
+    dati["inventario"] = ids_da_nomi(dati.get("inventario", []), locali=locali)
+    dati["oggetti_custom"] = schede_custom(dati["inventario"], locali)
+    return dati
+
+def _v2_a_v3(dati):
+    # Memoria della campagna a record: si ricostruisce da riassunti, diario e bestiario
+    ricordi = [{"testo": r["testo"], "tipo": "riassunto"} for r in dati.get("summary_history", []) if isinstance(r, dict)]
+    ricordi += [{"testo": j[2:] if j.startswith("- ") else j, "tipo": "diario"} for j in dati.get("journal", [])
+                if isinstance(j, str) and not RUMORE_DIARIO_RE.match(j)]
+    ricordi += [{"testo": f"Incontrato {b['nome']}", "tipo": "nemico"} for b in dati.get("bestiary", []) if isinstance(b, dict) and b.get("nome")]
+    dati["ricordi"] = ricordi
+    return dati
+
+MIGRAZIONI = {0: _v0_a_v1, 1: _v1_a_v2, 2: _v2_a_v3}
+
+
+def migra(dati, versione, fino=VERSIONE):
+    if versione > VERSIONE: raise ErroreSalvataggio(f"Salvataggio di una versione più recente ({versione})")
+    while versione < fino:
+        dati = MIGRAZIONI[versione](dati)
+        versione += 1
+    return dati
+
+
+def _tipo_ok(valore, tipi):
+    return isinstance(valore, tipi) and not (isinstance(valore, bool) and bool not in tipi)
+
+
+def _controlla_chiavi(voce, chiavi, dove):
+    for chiave, tipi in chiavi.items():
+        if not _tipo_ok(voce.get(chiave), tipi): raise ErroreSalvataggio(f"{dove}: '{chiave}' mancante o non valido")
+
+
+def valida(dati):
+    if not isinstance(dati, dict): raise ErroreSalvataggio("Il salvataggio non è un oggetto")
+    pulito = {}
+    for campo, tipi in CAMPI.items():
+        if campo not in dati: continue
+        if not isinstance(dati[campo], tipi) or isinstance(dati[campo], bool):
+            raise ErroreSalvataggio(f"Campo '{campo}' non valido ({type(dati[campo]).__name__})")
+        pulito[campo] = dati[campo]
+    for campo in ("personaggio", "game_phase"):
+        if campo not in pulito: raise ErroreSalvataggio(f"Campo obbligatorio mancante: {campo}")
+    # Un livello più in giù: quello che la UI disegna non deve esplodere al primo rerun
+    for campo, (tipo, chiavi) in ELEMENTI.items():
+        for i, voce in enumerate(pulito.get(campo, [])):
+            if not _tipo_ok(voce, (tipo,)): raise ErroreSalvataggio(f"Voce {i} di '{campo}' non valida ({type(voce).__name__})")
+            _controlla_chiavi(voce, chiavi, f"Voce {i} di '{campo}'")
+    pers = pulito["personaggio"]
+    _controlla_chiavi(pers, CHIAVI_PERSONAGGIO, "Personaggio")
+    if not all(_tipo_ok(v, (int,)) for v in pers["stats"].values()): raise ErroreSalvataggio("Personaggio: statistiche non valide")
+    if not all(isinstance(v, str) for v in pers["competenze"] + pers["magie"]):
+        raise ErroreSalvataggio("Personaggio: competenze o magie non valide")
+    if pulito.get("nemico_corrente") is not None: _controlla_chiavi(pulito["nemico_corrente"], CHIAVI_NEMICO, "Nemico")
+    # Gli oggetti del file restano della sessione che lo carica: il catalogo del processo è
+    # condiviso, e un ID che esiste già non viene mai sostituito
+    locali = {}
+    for chiave, scheda in pulito.get("oggetti_custom", {}).items():
+        try: scheda = valida_scheda(scheda)
+        except ValueError as e: raise ErroreSalvataggio(f"Oggetto '{chiave}' non valido: {e}")
+        if scheda["id"] not in CATALOGO: locali[scheda["id"]] = scheda
+    pulito["oggetti_custom"] = locali
+    for k in ("spell_slots", "spell_slots_max"):
+        if k in pulito:
+            try: pulito[k] = {int(liv): int(n) for liv, n in pulito[k].items()}
+            except (TypeError, ValueError): raise ErroreSalvataggio(f"Slot incantesimo non validi in '{k}'")
+    return pulito
+
+
+def serializza(stato):
+    corpo = json.dumps(estrai(stato), ensure_ascii=False, separators=(",", ":"))
+    return MAGIC + bytes([VERSIONE]) + zlib.compress(corpo.encode("utf-8"), 6)
+
+
+def deserializza(raw):
+    """Bytes del file caricato -> dict di stato validato e migrato all'ultima versione."""
+    try:
+        if raw[:4] == MAGIC:
+            if len(raw) < 6: raise ErroreSalvataggio("File troncato")
+            versione = raw[4]
+            dati = json.loads(zlib.decompress(raw[5:]).decode("utf-8"))
+        else:
+            versione, dati = 0, json.loads(raw.decode("utf-8"))
+    except (ValueError, IndexError, zlib.error) as e:
+        if isinstance(e, ErroreSalvataggio): raise
+        raise ErroreSalvataggio(f"File illeggibile: {e}")
+    if not isinstance(dati, dict): raise ErroreSalvataggio("Il salvataggio non è un oggetto")
+    return valida(migra(dati, versione))
+
+
+# --- autosalvataggio locale, append-only per personaggio ---
+
+def _impronta(valore):
+    return json.dumps(valore, sort_keys=True, default=str)
+
+
+def _impronte(dati):
+    # Per le liste in coda basta (lunghezza, primo, ultimo): niente dump dell'intera lista
+    return {campo: (len(v), _impronta(v[0]) if v else None, _impronta(v[-1]) if v else None)
+            if campo in LISTE_IN_CODA else _impronta(v) for campo, v in dati.items()}
+
+
+def _chiave_proprietario(proprietario):
+    return hashlib.sha256(str(proprietario).encode("utf-8")).hexdigest()[:12]
+
+
+def _slug(testo):
+    return re.sub(r'[^a-z0-9]+', '-', testo.lower()).strip('-') or "eroe"
+
+
+class ArchivioLocale:
+    """Un log JSONL per personaggio: ogni riga contiene solo i campi cambiati (o le voci
+    aggiunte in coda alle liste). Oltre `max_righe` il log viene compattato in uno snapshot.
+    Il nome del file comincia con l'impronta del proprietario: `elenco` mostra a ciascuno
+    solo le proprie partite."""
+
+    def __init__(self, cartella, max_righe=200):
+        self.cartella = cartella
+        self.max_righe = max_righe
+        os.makedirs(cartella, exist_ok=True)
+        self._ultimo = {}   # percorso -> impronte dell'ultimo stato scritto
+        self._righe = {}
+        self._lock = threading.Lock()
+
+    def percorso(self, personaggio, proprietario):
+        return os.path.join(self.cartella, f"{_chiave_proprietario(proprietario)}-{_slug(personaggio.get('nome', ''))}"
+                                           f"-{personaggio.get('id', 'x')[:8]}.log")
+
+    def _delta(self, path, dati):
+        """Ritorna (campi da reimpostare, voci da aggiungere in coda, nuove impronte)."""
+        prec = self._ultimo.get(path, {})
+        imposta, in_coda, firme = {}, {}, _impronte(dati)
+        for campo, valore in dati.items():
+            vecchia = prec.get(campo)
+            if vecchia == firme[campo]: continue
+            if campo in LISTE_IN_CODA and vecchia:
+                n_prec, primo, ultimo = vecchia
+                # Crescita in coda solo se il vecchio prefisso è intatto (primo e ultimo invariati)
+                if len(valore) > n_prec and (n_prec == 0 or _impronta(valore[0]) == primo and _impronta(valore[n_prec - 1]) == ultimo):
+                    in_coda[campo] = valore[n_prec:]
+                    continue
+            imposta[campo] = valore
+        return imposta, in_coda, firme
+
+    def autosalva(self, stato, proprietario):
+        dati = estrai(stato)
+        pers = dati.get("personaggio") or {}
+        if not pers.get("nome"): return
+        with self._lock: self._autosalva(self.percorso(pers, proprietario), dati)
+
+    def _autosalva(self, path, dati):
+        if path not in self._ultimo and os.path.exists(path): self._compatta(path, dati)
+        imposta, in_coda, impronte = self._delta(path, dati)
+        if not imposta and not in_coda: return
+        riga = {"v": VERSIONE}
+        if imposta: riga["set"] = imposta
+        if in_coda: riga["append"] = in_coda
+        with open(path, "a", encoding="utf-8") as f: f.write(json.dumps(riga, ensure_ascii=False) + "\n")
+        self._ultimo[path] = impronte
+        self._righe[path] = self._righe.get(path, 0) + 1
+        if self._righe[path] > self.max_righe: self._compatta(path, dati)
+
+    def _compatta(self, path, dati):
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f: f.write(json.dumps({"v": VERSIONE, "set": dati}, ensure_ascii=False) + "\n")
+        os.replace(tmp, path)
+        self._ultimo[path] = _impronte(dati)
+        self._righe[path] = 1
+
+    def carica(self, path):
+        """Ricompone il log. Ogni riga vale per la versione con cui è stata scritta: lo stato
+        accumulato sale di versione quando arriva una riga più nuova, e una riga più vecchia
+        viene migrata da sola (tenendo solo i campi che porta)."""
+        dati, versione = {}, 0
+        with open(path, encoding="utf-8") as f:
+            for riga in f:
+                if not riga.strip(): continue
+                try: rec = json.loads(riga)
+                except ValueError: break   # riga troncata da un crash: ci fermiamo all'ultima buona
+                if not isinstance(rec, dict): break
+                v = rec.get("v", VERSIONE)
+                imposta, in_coda = rec.get("set", {}), rec.get("append", {})
+                if v > versione:
+                    dati, versione = migra(dati, versione, v), v
+                elif v < versione:
+                    parziale = migra({**imposta, **{c: list(voci) for c, voci in in_coda.items()}}, v, versione)
+                    imposta = {c: parziale[c] for c in imposta if c in parziale}
+                    in_coda = {c: parziale[c] for c in in_coda if c in parziale}
+                dati.update(imposta)
+                for campo, voci in in_coda.items(): dati.setdefault(campo, []).extend(voci)
+        return valida(migra(dati, versione))
+
+    def elenco(self, proprietario):
+        """Gli autosalvataggi di `proprietario`, dal più recente."""
+        prefisso = _chiave_proprietario(proprietario) + "-"
+        return sorted((f for f in os.listdir(self.cartella) if f.startswith(prefisso) and f.endswith(".log")),
+                      key=lambda f: os.path.getmtime(os.path.join(self.cartella, f)), reverse=True)
+
+    def carica_di(self, nome, proprietario):
+        """Carica un autosalvataggio solo se appartiene a `proprietario`."""
+        if nome not in self.elenco(proprietario): raise ErroreSalvataggio("Autosalvataggio non trovato")
+        return self.carica(os.path.join(self.cartella, nome))
+
+
+# --- storico fuori memoria: le voci uscite dai buffer di sessione ---
+
+class Storico:
+    """Un file JSONL per personaggio e lista (diario, trascrizione...), solo in coda.
+    Gli offset delle righe restano in memoria, così le pagine si leggono con un seek."""
+
+    def __init__(self, cartella):
+        self.cartella = cartella
+        os.makedirs(cartella, exist_ok=True)
+        self._offset = {}   # percorso -> offset di inizio di ogni riga
+        self._lock = threading.Lock()
+
+    def percorso(self, personaggio, campo):
+        return os.path.join(self.cartella, f"{_slug(personaggio.get('nome', ''))}-{personaggio.get('id', 'x')[:8]}.{campo}.jsonl")
+
+    def _indice(self, path):
+        if path not in self._offset:
+            offset, pos = [], 0
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    for riga in f:
+                        offset.append(pos)
+                        pos += len(riga)
+            self._offset[path] = offset
+        return self._offset[path]
+
+    def scarica(self, personaggio, campo, voci):
+        path = self.percorso(personaggio, campo)
+        with self._lock:
+            offset = self._indice(path)
+            with open(path, "ab") as f:
+                for voce in voci:
+                    offset.append(f.tell())
+                    f.write(json.dumps(voce, ensure_ascii=False, default=str).encode("utf-8") + b"\n")
+
+    def conta(self, personaggio, campo):
+        with self._lock: return len(self._indice(self.percorso(personaggio, campo)))
+
+    def ultime(self, personaggio, campo, n):
+        """Le ultime `n` voci archiviate, in ordine cronologico."""
+        path = self.percorso(personaggio, campo)
+        with self._lock:
+            offset = self._indice(path)
+            if not offset or n <= 0: return []
+            with open(path, "rb") as f:
+                f.seek(offset[max(0, len(offset) - n)])
+                righe = f.read().splitlines()
+        voci = []
+        for riga in righe:
+            try: voci.append(json.loads(riga))
+            except ValueError: continue
+        return voci